@@ -1,27 +1,67 @@
-from fastapi import Depends, HTTPException, status 
+import time
+from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from auth.jwt_handler import verify_access_token 
+from sqlmodel.ext.asyncio.session import AsyncSession
+from auth.cache import TTLCache
+from auth.jwt_handler import verify_access_token
+from database.config import get_settings
+from database.database import get_async_session
+from models.all_models import User
 from services.auth.cookieauth import OAuth2PasswordBearerWithCookie
+from services.crud import user as UserService
+
+settings = get_settings()
+
+# Decoded tokens and resolved users, shared by all requests of the process.
+# Cached users are detached snapshots: read them, but never add them to a
+# session - balance-changing code reloads the user and calls invalidate_user.
+token_cache = TTLCache(maxsize=10_000, ttl=settings.TOKEN_CACHE_TTL_S)
+user_cache = TTLCache(maxsize=10_000, ttl=settings.USER_CACHE_TTL_S)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/user/signin")
 
 async def authenticate(token: str=Depends(oauth2_scheme)) -> str:
     if not token:
-        raise HTTPException( 
-        status_code=status.HTTP_403_FORBIDDEN, 
+        raise HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
         detail="Sign in for access"
         )
-    decoded_token = verify_access_token(token) 
+    decoded_token = verify_access_token(token)
     return decoded_token["user"]
 
 oauth2_scheme_cookie = OAuth2PasswordBearerWithCookie(tokenUrl="/home/token")
 
 async def authenticate_cookie(token: str=Depends(oauth2_scheme_cookie)) -> str:
     if not token:
-        raise HTTPException( 
-        status_code=status.HTTP_403_FORBIDDEN, 
+        raise HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
         detail="Sign in for access"
         )
     token = token.removeprefix('Bearer ')
-    decoded_token = verify_access_token(token) 
-    return decoded_token["user"]
\ No newline at end of file
+    email = token_cache.get(token)
+    if email is None:
+        decoded_token = verify_access_token(token)
+        email = decoded_token["user"]
+        # Never keep a token in the cache past its own expiry
+        token_cache.set(token, email, ttl=decoded_token["expires"] - time.time())
+    return email
+
+async def current_user(user_email: str=Depends(authenticate_cookie),
+                       session: AsyncSession=Depends(get_async_session)) -> User:
+    user = user_cache.get(("email", user_email))
+    if user is None:
+        user = await UserService.get_user_by_email_async(user_email, session)
+        if user is None:
+            raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="User does not exist"
+            )
+        # Detach it, so that commits and rollbacks of this request's session never touch the cached copy
+        session.expunge(user)
+        user_cache.set(("email", user.email), user)
+        user_cache.set(("id", user.id), user)
+    return user
+
+def invalidate_user(user: User) -> None:
+    user_cache.pop(("email", user.email))
+    user_cache.pop(("id", user.id))
@@ -10,6 +10,32 @@ class Settings(BaseSettings):
     DB_NAME: Optional[str] = None
     COOKIE_NAME: Optional[str] = None
     SECRET_KEY: Optional[str] = None
+    WORKER_BATCH_SIZE: int = 1
+    WORKER_BATCH_WAIT_MS: int = 50
+    FEATURE_SNAPSHOT_PATH: Optional[str] = None
+    FEATURE_SNAPSHOT_REFRESH_S: int = 3600
+    MODEL_CACHE_MAX_MB: int = 2048
+    PRELOAD_MODEL_IDS: Optional[str] = None
+    PREDICT_SYNC_TIMEOUT_S: float = 5.0
+    TOKEN_CACHE_TTL_S: int = 300
+    USER_CACHE_TTL_S: int = 30
+    METRICS_KS: str = "10,20,40"
+    METRICS_PROCESSES: int = 1
+    SPLIT_CACHE_DIR: Optional[str] = "./split_cache"
+    SPLIT_CACHE_MAX_MB: int = 20480
+    SWEEP_PROCESSES: int = 2
+    RANKER_THREADS: int = 4
+    RECOMMENDATIONS_DIR: Optional[str] = "./recommendations"
+    MATERIALIZE_TOP_K: int = 100
+    MATERIALIZE_MEMORY_MB: int = 512
+    ANN_INDEX: bool = True
+    ANN_RECALL_TARGET: float = 0.95
+    TRAINING_CPU_BUDGET: int = 0  # 0 uses every CPU of the machine
+    TRAINING_MEMORY_BUDGET_MB: int = 8192
+    TRAINING_MAX_CONCURRENT: int = 4
+    TRAINING_JOB_THREADS: int = 4
+    TRAINING_PREFETCH: int = 32
+    TRAINING_CHECKPOINT_ITERATIONS: int = 5  # 0 disables ALS factor checkpoints
     
     @property
     def DATABASE_URL_asyncpg(self):
@@ -1,13 +1,47 @@
+import os
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import inspect
 from sqlmodel import SQLModel, Session, create_engine 
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from .config import get_settings
 
 engine = create_engine(url=get_settings().DATABASE_URL_psycopg, 
                        echo=True, pool_size=5, max_overflow=10)
 
+async_engine = create_async_engine(url=get_settings().DATABASE_URL_asyncpg,
+                                   echo=True, pool_size=20, max_overflow=20)
+async_session_maker = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
 def get_session():
     with Session(engine) as session:
         yield session
+
+async def get_async_session():
+    async with async_session_maker() as session:
+        yield session
         
-def init_db():
-    SQLModel.metadata.drop_all(engine)
-    SQLModel.metadata.create_all(engine)
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "alembic.ini")
+
+def init_db() -> bool:
+    """Upgrade the schema to the latest migration. Returns False when it was already current"""
+    config = Config(ALEMBIC_INI)
+    config.attributes["configure_logger"] = False
+    head = ScriptDirectory.from_config(config).get_current_head()
+
+    with engine.begin() as connection:
+        current = MigrationContext.configure(connection).get_current_revision()
+        if current == head:
+            return False
+
+        if current is None and inspect(connection).has_table("user"):
+            # Tables left by the old create_all boot path, which dropped them on every start anyway
+            SQLModel.metadata.drop_all(connection)
+
+        config.attributes["connection"] = connection
+        command.upgrade(config, "head")
+    print(f"Database schema upgraded from {current} to {head}")
+    return True
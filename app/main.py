@@ -3,22 +3,35 @@ from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
+from starlette.concurrency import run_in_threadpool
 from services.auth.loginform import LoginForm
 import uvicorn
-from auth.authenticate import authenticate_cookie
+from auth.authenticate import authenticate_cookie, current_user, invalidate_user
 from auth.hash_password import HashPassword
 from auth.jwt_handler import create_access_token
 from database.config import get_settings
-from database.database import init_db, get_session, engine
+from database.database import init_db, get_async_session, engine
 from services.crud import user as UserService
 from services.crud import transaction as TransactionService
 from services.crud import ml as MlService
 from services.crud import training as TrainingService
+from services.crud import billing as BillingService
 from sqlmodel import Session
-from models.all_models import TokenResponse, User, MLModel, MLTask, RabbitmqResult, TrainingJob
-import pika
+from sqlmodel.ext.asyncio.session import AsyncSession
+from models.all_models import RecommendBatchRequest, TokenResponse, User, MLModel, TrainingJob
+from services.queue.publisher import PublishError, QueuePublisher, get_connection_params
+from services.queue.rpc import ReplyConsumer
+from services.serving.recommendations import RecommendationStore
+from services.serving.recommender import FACTOR_MODEL_TYPES, SERVING_MODEL_TYPES, get_recommender
+from services.training.materialize import job_set_name
+from services.training.popular import SEGMENTS
+from services.training.scheduler import PRIORITIES, job_key
+from services.training.sweep import expand_space
+from auth.cache import TTLCache
+import datetime
 import json
 import uuid
+from typing import Optional, Sequence
 
 
 app = FastAPI()
@@ -35,15 +48,25 @@ app.add_middleware(
 def on_startup():
     init_db()
     with Session(engine) as session:
-        user = User(username='test_user', password="123", email="test@example.com")
-        hashed_password = hash_password.create_hash(user.password)
-        user.password = hashed_password 
-        UserService.create_user(user, session)
-        print('Test user created')
+        if UserService.get_user_by_email("test@example.com", session) is None:
+            user = User(username='test_user', password="123", email="test@example.com")
+            hashed_password = hash_password.create_hash(user.password)
+            user.password = hashed_password 
+            UserService.create_user(user, session)
+            print('Test user created')
 
-        model = MLModel(model_path='./ml_models/model.pkl')
-        MlService.create_model(model, session)
-        print('Test model created')
+        if MlService.get_model_by_id(1, session) is None:
+            model = MLModel(model_path='./ml_models/decision_forest_model.pkl')
+            MlService.create_model(model, session)
+            print('Test model created')
+
+    reply_consumer.start()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    publisher.close()
+    reply_consumer.close()
 
 settings = get_settings()
 hash_password = HashPassword()
@@ -51,8 +74,19 @@ templates = Jinja2Templates(directory="view")
 
 RABBITMQ_HOST = "rabbitmq"
 QUEUE_NAME = "ml_tasks"
+PREDICTION_COST = 20
+TRAINING_QUEUE_NAME = "training_tasks"
 DB_NAME = "ml_results.db"
 
+# Completed jobs never change, so their owner and artifact path are cached for /recommend
+serving_jobs = TTLCache(maxsize=1_000, ttl=300)
+MAX_RECOMMEND_K = 1000
+MAX_RECOMMEND_BATCH = 10_000
+
+publisher = QueuePublisher(get_connection_params(RABBITMQ_HOST))
+recommendation_store = RecommendationStore(settings.RECOMMENDATIONS_DIR) if settings.RECOMMENDATIONS_DIR else None
+reply_consumer = ReplyConsumer(get_connection_params(RABBITMQ_HOST))
+
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
@@ -70,12 +104,13 @@ async def index(request: Request):
 
 
 @app.post("/token")
-async def login_for_access_token(response: Response, form_data: OAuth2PasswordRequestForm=Depends(), session=Depends(get_session)) -> dict[str, str]:    
-    user_exist = UserService.get_user_by_email(form_data.username, session)
+async def login_for_access_token(response: Response, form_data: OAuth2PasswordRequestForm=Depends(), session: AsyncSession=Depends(get_async_session)) -> dict[str, str]:    
+    user_exist = await UserService.get_user_by_email_async(form_data.username, session)
     if user_exist is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User does not exist")
     
-    if hash_password.verify_hash(form_data.password, user_exist.password):
+    # bcrypt is CPU-bound, keep it off the event loop
+    if await run_in_threadpool(hash_password.verify_hash, form_data.password, user_exist.password):
         access_token = create_access_token(user_exist.email)
         response.set_cookie(
             key=settings.COOKIE_NAME, 
@@ -101,7 +136,7 @@ async def login_get(request: Request):
 
 
 @app.post("/auth/login", response_class=HTMLResponse)
-async def login_post(request: Request, session=Depends(get_session)):
+async def login_post(request: Request, session: AsyncSession=Depends(get_async_session)):
     form = LoginForm(request)
     await form.load_data()
     if await form.is_valid():
@@ -138,19 +173,19 @@ async def sign_new_user(request: Request,
                         username=Form(...),
                         email=Form(...),
                         password=Form(...),
-                        session=Depends(get_session)) -> dict:
+                        session: AsyncSession=Depends(get_async_session)) -> dict:
     
     user = User(username=username, password=password, email=email)
-    user_exist = UserService.get_user_by_email(user.email, session)
+    user_exist = await UserService.get_user_by_email_async(user.email, session)
     
     if user_exist:
         raise HTTPException( 
         status_code=status.HTTP_409_CONFLICT, 
         detail="User with email provided exists already.")
     
-    hashed_password = hash_password.create_hash(user.password)
+    hashed_password = await run_in_threadpool(hash_password.create_hash, user.password)
     user.password = hashed_password 
-    UserService.create_user(user, session)
+    await UserService.create_user_async(user, session)
 
     context = {
         "request": request
@@ -159,13 +194,13 @@ async def sign_new_user(request: Request,
 
 
 @app.post("/signin", response_model=TokenResponse)
-async def sign_user_in(user: OAuth2PasswordRequestForm = Depends(), session=Depends(get_session)) -> dict: 
-    user_exist = UserService.get_user_by_email(user.username, session)
+async def sign_user_in(user: OAuth2PasswordRequestForm = Depends(), session: AsyncSession=Depends(get_async_session)) -> dict: 
+    user_exist = await UserService.get_user_by_email_async(user.username, session)
     
     if user_exist is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User does not exist")
     
-    if hash_password.verify_hash(user.password, user_exist.password):
+    if await run_in_threadpool(hash_password.verify_hash, user.password, user_exist.password):
         access_token = create_access_token(user_exist.email)
         return {"access_token": access_token, "token_type": "Bearer"}
     
@@ -176,8 +211,7 @@ async def sign_user_in(user: OAuth2PasswordRequestForm = Depends(), session=Depe
 
 
 @app.get("/get_balance/")
-def get_balance(request: Request, user_email: str = Depends(authenticate_cookie), session=Depends(get_session)):
-    user = UserService.get_user_by_email(user_email, session)
+async def get_balance(request: Request, user: User = Depends(current_user)):
     context = {
         "user": user,
         "request": request
@@ -186,71 +220,69 @@ def get_balance(request: Request, user_email: str = Depends(authenticate_cookie)
 
 
 @app.post("/deposit/")
-def deposit(request: Request, amount: float = Form(...), user_email: str = Depends(authenticate_cookie), session=Depends(get_session)):
-    user = UserService.get_user_by_email(user_email, session)
+async def deposit(request: Request, amount: float = Form(...), user: User = Depends(current_user), session: AsyncSession=Depends(get_async_session)):
+    try:
+        user = await BillingService.deposit(user.id, amount, session)
+    except BillingService.InvalidAmountError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    invalidate_user(user)
     context = {
         "user": user,
         "request": request
     }
-    if user:
-        TransactionService.add_balance(user, amount, session)
     return templates.TemplateResponse("balance.html", context)
 
 
-@app.get("/get_task_history/")
-def get_task_history(request: Request, user_email: str = Depends(authenticate_cookie), session=Depends(get_session)):
-    user = UserService.get_user_by_email(user_email, session)
-    context = {
-        "history": MlService.get_task_history(user, session),
+def history_params(limit: int = 20, cursor: Optional[str] = None,
+                   date_from: Optional[datetime.date] = None, date_to: Optional[datetime.date] = None) -> dict:
+    return {"limit": limit, "cursor": cursor, "date_from": date_from, "date_to": date_to}
+
+
+def history_context(request: Request, page: dict) -> dict:
+    return {
+        "history": page["items"],
+        "summary": page["summary"],
+        "next_url": request.url.include_query_params(cursor=page["next_cursor"]) if page["next_cursor"] else None,
         "request": request
     }
-    return templates.TemplateResponse("task_history.html", context)
+
+
+@app.get("/get_task_history/")
+async def get_task_history(request: Request, params: dict = Depends(history_params), user: User = Depends(current_user), session: AsyncSession=Depends(get_async_session)):
+    page = await MlService.get_task_history_page_async(user, session, **params)
+    return templates.TemplateResponse("task_history.html", history_context(request, page))
+
+
+@app.get("/api/task_history/")
+async def api_task_history(params: dict = Depends(history_params), user: User = Depends(current_user), session: AsyncSession=Depends(get_async_session)):
+    return await MlService.get_task_history_page_async(user, session, **params)
 
 
 @app.get("/get_transaction_history/")
-def get_transaction_history(request: Request, user_email: str = Depends(authenticate_cookie), session=Depends(get_session)):
-    user = UserService.get_user_by_email(user_email, session)
-    context = {
-        "history": TransactionService.get_transaction_history(user, session),
-        "request": request
-    }
-    return templates.TemplateResponse("transaction_history.html", context)
-
-
-def send_to_queue(task: dict):
-    connection_params = pika.ConnectionParameters(
-        host=RABBITMQ_HOST,
-        port=5672,
-        virtual_host='/',
-        credentials=pika.PlainCredentials(
-            username='rmuser',
-            password='rmpassword'
-        ),
-        heartbeat=30,
-        blocked_connection_timeout=2
-    )
-    connection = pika.BlockingConnection(connection_params)
-    channel = connection.channel()
-    channel.queue_declare(queue=QUEUE_NAME, durable=True)
-    
-    request_id = str(uuid.uuid4())
+async def get_transaction_history(request: Request, params: dict = Depends(history_params), user: User = Depends(current_user), session: AsyncSession=Depends(get_async_session)):
+    page = await TransactionService.get_transaction_history_page_async(user, session, **params)
+    return templates.TemplateResponse("transaction_history.html", history_context(request, page))
+
+
+@app.get("/api/transaction_history/")
+async def api_transaction_history(params: dict = Depends(history_params), user: User = Depends(current_user), session: AsyncSession=Depends(get_async_session)):
+    return await TransactionService.get_transaction_history_page_async(user, session, **params)
+
+
+async def send_to_queue(task: dict, request_id: str, wait: bool = False):
+    """Publish a prediction task; with wait=True also return the worker's reply if it comes in time"""
     task["request_id"] = request_id
-    print(f'сгенерирован request_id: {request_id}')
-    
-    channel.basic_publish(
-        exchange='', 
-        routing_key=QUEUE_NAME, 
-        body=json.dumps(task), 
-        properties=pika.BasicProperties(delivery_mode=2)
-    )
-    
-    connection.close()
-    return request_id
+
+    if wait:
+        return await reply_consumer.request(publisher, QUEUE_NAME, task, request_id,
+                                            timeout=settings.PREDICT_SYNC_TIMEOUT_S)
+
+    await publisher.publish_async(QUEUE_NAME, task)
+    return None
 
 
 @app.get("/make_prediction/")
-def make_prediction(request: Request, user_email: str = Depends(authenticate_cookie), session=Depends(get_session)):
-    user = UserService.get_user_by_email(user_email, session)
+async def make_prediction(request: Request, user: User = Depends(current_user)):
     context = {
         "user": user,
         "request": request
@@ -259,33 +291,48 @@ def make_prediction(request: Request, user_email: str = Depends(authenticate_coo
 
 
 @app.post("/predict/")
-def predict(request: Request, 
-            model_id = Form(...),
-            user_email: str = Depends(authenticate_cookie), 
-            session: Session = Depends(get_session)):
+async def predict(request: Request, 
+            model_id: int = Form(...),
+            wait: bool = Form(default=False),
+            user: User = Depends(current_user), 
+            session: AsyncSession = Depends(get_async_session)):
     
-    user = UserService.get_user_by_email(user_email, session)
-    task = MLTask(
-        user_id=user.id,
-        model_id=model_id,
-    )
-    task = MlService.create_task(task, session)
-    request_id = send_to_queue(task.model_dump())
-    MlService.create_rabbitmq_result(RabbitmqResult(task_id=task.task_id, request_id=request_id), session)
+    request_id = str(uuid.uuid4())
+    print(f'сгенерирован request_id: {request_id}')
+    try:
+        # Charge first: the task is only enqueued once it has been paid for
+        user, task = await BillingService.charge_for_task(user.id, model_id, PREDICTION_COST, request_id, session)
+    except BillingService.InsufficientFundsError:
+        context = {
+            "user": user,
+            "request": request,
+            "error": "Insufficient funds"
+        }
+        return templates.TemplateResponse("prediction.html", context, status_code=status.HTTP_402_PAYMENT_REQUIRED)
+    invalidate_user(user)
+
+    try:
+        reply = await send_to_queue(task.model_dump(), request_id, wait=wait)
+    except PublishError:
+        refunded = await BillingService.refund_task(task, session)
+        if refunded is not None:
+            invalidate_user(refunded)
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Prediction queue is unavailable")
+        # The broker delivered the message after all and the worker already processed the task
+        reply = None
 
     context = {
         "user": user,
         "request": request,
-        "request_id": request_id
+        "request_id": request_id,
+        "prediction_res": MlService.format_prediction(reply) if reply else None
     }
-    TransactionService.withdraw_balance(user, 20, session)
     return templates.TemplateResponse("prediction.html", context)
 
 
 @app.post("/get_prediction/")
-def get_prediction(request: Request, request_id: str = Form(...), user_email: str = Depends(authenticate_cookie), session=Depends(get_session)):
-    user = UserService.get_user_by_email(user_email, session)
-    prediction = MlService.get_prediction(request_id, session)
+async def get_prediction(request: Request, request_id: str = Form(...), user: User = Depends(current_user), session: AsyncSession=Depends(get_async_session)):
+    prediction = await MlService.get_prediction_async(request_id, session)
     
     context = {
         "user": user,
@@ -299,47 +346,99 @@ def get_prediction(request: Request, request_id: str = Form(...), user_email: st
 
 # Training endpoints
 @app.get("/training/")
-def training_page(request: Request, user_email: str = Depends(authenticate_cookie), session=Depends(get_session)):
-    user = UserService.get_user_by_email(user_email, session)
+async def training_page(request: Request, params: dict = Depends(history_params), user: User = Depends(current_user), session: AsyncSession=Depends(get_async_session)):
     training_service = TrainingService.TrainingService()
     
     # Get user's training jobs
-    jobs = session.query(TrainingJob).filter(TrainingJob.user_id == user.id).order_by(TrainingJob.created_at.desc()).all()
+    page = await training_service.get_user_training_jobs_page_async(user.id, session, **params)
     
     context = {
         "user": user,
         "request": request,
-        "jobs": jobs
+        "jobs": page["items"],
+        "summary": page["summary"],
+        "next_url": request.url.include_query_params(cursor=page["next_cursor"]) if page["next_cursor"] else None
     }
     return templates.TemplateResponse("training.html", context)
 
 
+@app.get("/api/training_jobs/")
+async def api_training_jobs(params: dict = Depends(history_params), user: User = Depends(current_user), session: AsyncSession=Depends(get_async_session)):
+    training_service = TrainingService.TrainingService()
+    return await training_service.get_user_training_jobs_page_async(user.id, session, **params)
+
+
 @app.post("/start_training/")
-def start_training(request: Request, 
+async def start_training(request: Request, 
                   model_type: str = Form(...),
                   data_path: str = Form(...),
                   iterations: int = Form(default=10),
                   factors: int = Form(default=60),
-                  user_email: str = Depends(authenticate_cookie), 
-                  session: Session = Depends(get_session)):
+                  search: str = Form(default="grid"),
+                  search_space: Optional[str] = Form(default=None),
+                  n_trials: int = Form(default=10),
+                  metric: str = Form(default="recall_at_40"),
+                  base_job_id: Optional[int] = Form(default=None),
+                  incremental_iterations: int = Form(default=2),
+                  half_life_days: Optional[float] = Form(default=None),
+                  segment: Optional[str] = Form(default=None),
+                  priority: str = Form(default="interactive"),
+                  user: User = Depends(current_user), 
+                  session: AsyncSession = Depends(get_async_session)):
     
-    user = UserService.get_user_by_email(user_email, session)
     training_service = TrainingService.TrainingService()
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {', '.join(PRIORITIES)}")
     
     # Create training job
-    hyperparams = json.dumps({
-        "iterations": iterations,
-        "factors": factors
-    }) if model_type == "als" else None
+    hyperparams = None
+    if model_type == "popular":
+        if half_life_days is not None and half_life_days <= 0:
+            raise HTTPException(status_code=400, detail="half_life_days must be positive")
+        if segment and segment not in SEGMENTS:
+            raise HTTPException(status_code=400, detail=f"segment must be one of {', '.join(SEGMENTS)}")
+        hyperparams = json.dumps({
+            "half_life_days": half_life_days,
+            "segment": segment or None
+        })
+    elif model_type in ("als", "two_stage"):
+        hyperparams = json.dumps({
+            "iterations": iterations,
+            "factors": factors
+        })
+    elif model_type == "als_sweep":
+        try:
+            space = json.loads(search_space) if search_space and search_space.strip() else None
+            expand_space(space, search, n_trials)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid search space: {e}")
+        hyperparams = json.dumps({
+            "search": search,
+            "space": space,
+            "n_trials": n_trials,
+            "metric": metric
+        })
+    elif model_type == "als_incremental":
+        base_job = await training_service.get_training_job_async(base_job_id, session) if base_job_id else None
+        if not base_job or base_job.user_id != user.id:
+            raise HTTPException(status_code=400, detail="Base training job not found")
+        if base_job.status != "completed" or base_job.model_type not in FACTOR_MODEL_TYPES:
+            raise HTTPException(status_code=400, detail="The base job must be a completed ALS job")
+        hyperparams = json.dumps({
+            "base_job_id": base_job_id,
+            "iterations": incremental_iterations
+        })
     
     job = TrainingJob(
         user_id=user.id,
         model_type=model_type,
         data_path=data_path,
-        hyperparams=hyperparams
+        hyperparams=hyperparams,
+        priority=priority,
+        job_key=job_key(model_type, data_path, json.loads(hyperparams) if hyperparams else None)
     )
     
-    job = training_service.create_training_job(job, session)
+    job = await training_service.create_training_job_async(job, session)
     
     # Send to training queue
     training_task = {
@@ -349,7 +448,7 @@ def start_training(request: Request,
         "hyperparams": json.loads(hyperparams) if hyperparams else None
     }
     
-    send_training_to_queue(training_task)
+    await send_training_to_queue(training_task)
     
     context = {
         "user": user,
@@ -359,39 +458,37 @@ def start_training(request: Request,
     return templates.TemplateResponse("training.html", context)
 
 
-def send_training_to_queue(task: dict):
+async def send_training_to_queue(task: dict):
     """Send training task to RabbitMQ queue"""
-    connection_params = pika.ConnectionParameters(
-        host=RABBITMQ_HOST,
-        port=5672,
-        virtual_host='/',
-        credentials=pika.PlainCredentials(
-            username='rmuser',
-            password='rmpassword'
-        ),
-        heartbeat=30,
-        blocked_connection_timeout=2
-    )
-    connection = pika.BlockingConnection(connection_params)
-    channel = connection.channel()
-    channel.queue_declare(queue="training_tasks", durable=True)
-    
-    channel.basic_publish(
-        exchange='', 
-        routing_key="training_tasks", 
-        body=json.dumps(task), 
-        properties=pika.BasicProperties(delivery_mode=2)
-    )
-    
-    connection.close()
+    await publisher.publish_async(TRAINING_QUEUE_NAME, task)
+
+
+@app.get("/queue_stats/")
+def get_queue_stats(user: User = Depends(current_user)):
+    return publisher.stats()
+
+
+@app.get("/split_cache/")
+async def get_split_cache_stats(user: User = Depends(current_user)):
+    split_cache = TrainingService.TrainingService().split_cache
+    if split_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **(await run_in_threadpool(split_cache.stats))}
+
+
+@app.post("/split_cache/invalidate/")
+async def invalidate_split_cache(data_path: Optional[str] = Form(default=None), user: User = Depends(current_user)):
+    """Drop the cached splits of data_path, or every cached split when it is not given"""
+    split_cache = TrainingService.TrainingService().split_cache
+    removed = await run_in_threadpool(split_cache.invalidate, data_path) if split_cache is not None else 0
+    return {"removed": removed}
 
 
 @app.get("/training_status/{job_id}")
-def get_training_status(job_id: int, user_email: str = Depends(authenticate_cookie), session=Depends(get_session)):
-    user = UserService.get_user_by_email(user_email, session)
+async def get_training_status(job_id: int, user: User = Depends(current_user), session: AsyncSession=Depends(get_async_session)):
     training_service = TrainingService.TrainingService()
     
-    job = training_service.get_training_job(job_id, session)
+    job = await training_service.get_training_job_async(job_id, session)
     
     if not job or job.user_id != user.id:
         raise HTTPException(status_code=404, detail="Training job not found")
@@ -399,12 +496,141 @@ def get_training_status(job_id: int, user_email: str = Depends(authenticate_cook
     return {
         "job_id": job.job_id,
         "status": job.status,
+        "priority": job.priority,
+        "merged_into": job.merged_into,
+        "cancel_requested": job.cancel_requested,
+        "last_phase": job.last_phase,
         "metrics": json.loads(job.metrics) if job.metrics else None,
+        "telemetry": json.loads(job.telemetry) if job.telemetry else None,
         "model_path": job.model_path,
         "created_at": job.created_at,
         "updated_at": job.updated_at
     }
 
 
+@app.post("/cancel_training/{job_id}")
+async def cancel_training(job_id: int, user: User = Depends(current_user), session: AsyncSession=Depends(get_async_session)):
+    """Cancel a pending job at once, or ask a running one to stop at its next phase or ALS iteration"""
+    training_service = TrainingService.TrainingService()
+    job = await training_service.get_training_job_async(job_id, session)
+    if not job or job.user_id != user.id:
+        raise HTTPException(status_code=404, detail="Training job not found")
+    if job.status in TrainingService.FINAL_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Training job {job_id} is already {job.status}")
+    job = await training_service.cancel_training_job_async(job, session)
+    return {"job_id": job.job_id, "status": job.status, "cancel_requested": job.cancel_requested}
+
+
+async def serving_job(job_id: int, user: User, session: AsyncSession,
+                      model_types: Sequence[str] = SERVING_MODEL_TYPES) -> dict:
+    """Owner, type and artifact of a completed job that can serve recommendations"""
+    job = serving_jobs.get(job_id)
+    if job is None:
+        training_job = await TrainingService.TrainingService().get_training_job_async(job_id, session)
+        if not training_job:
+            raise HTTPException(status_code=404, detail="Training job not found")
+        job = {"user_id": training_job.user_id, "model_type": training_job.model_type,
+               "status": training_job.status, "model_path": training_job.model_path}
+        if job["status"] == "completed":
+            serving_jobs.set(job_id, job)
+    if job["user_id"] != user.id:
+        raise HTTPException(status_code=404, detail="Training job not found")
+    if job["status"] != "completed" or not job["model_path"]:
+        raise HTTPException(status_code=400, detail=f"Training job {job_id} is {job['status']}")
+    if job["model_type"] not in model_types:
+        raise HTTPException(status_code=400, detail=f"{job['model_type']} models do not serve this endpoint")
+    return job
+
+
+async def fallback_recommender(fallback_job_id: Optional[int], user: User, session: AsyncSession):
+    """Recommender of the popular job serving users a model does not know, if one was requested"""
+    if fallback_job_id is None:
+        return None
+    job = await serving_job(fallback_job_id, user, session, model_types=("popular",))
+    return await run_in_threadpool(get_recommender, job["model_path"])
+
+
+def recommendation_response(recommendation, fallback: bool = False) -> Optional[dict]:
+    if recommendation is None:
+        return None
+    items, scores = recommendation
+    response = {"nodes": items.tolist(), "scores": scores.tolist()}
+    if fallback:
+        response["fallback"] = True
+    return response
+
+
+@app.get("/recommend/{job_id}")
+async def recommend(job_id: int, user_id: int, k: int = 40, filter_seen: bool = True, exact: bool = False,
+                    fallback_job_id: Optional[int] = None, user: User = Depends(current_user),
+                    session: AsyncSession=Depends(get_async_session)):
+    """Top-k nodes of one user from a completed ALS or popular job.
+
+    The top-k an ALS job materialized at the end of training is read when
+    it covers the request, the factors are scored otherwise. Users the model
+    does not know get the lists of the popular job fallback_job_id, when
+    given, instead of a 404.
+    """
+    if not 0 < k <= MAX_RECOMMEND_K:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {MAX_RECOMMEND_K}")
+    job = await serving_job(job_id, user, session)
+    if recommendation_store is not None and filter_seen and job["model_type"] in FACTOR_MODEL_TYPES:
+        materialized = await run_in_threadpool(recommendation_store.get, job_set_name(job_id), user_id, k)
+        if materialized is not None:
+            return {"job_id": job_id, "user_id": user_id, **recommendation_response(materialized)}
+    recommender = await run_in_threadpool(get_recommender, job["model_path"])
+    recommendation = (await run_in_threadpool(recommender.recommend, [user_id], k, filter_seen, exact))[0]
+    # The fallback model is only loaded for users the model does not know
+    fallback = await fallback_recommender(fallback_job_id, user, session) if recommendation is None else None
+    if fallback is not None:
+        return {"job_id": job_id, "user_id": user_id,
+                **recommendation_response(fallback.recommend([user_id], k)[0], fallback=True)}
+    if recommendation is None:
+        raise HTTPException(status_code=404, detail=f"User {user_id} is unknown to the model")
+    return {"job_id": job_id, "user_id": user_id, **recommendation_response(recommendation)}
+
+
+@app.post("/recommend/{job_id}/batch")
+async def recommend_batch(job_id: int, body: RecommendBatchRequest, user: User = Depends(current_user),
+                          session: AsyncSession=Depends(get_async_session)):
+    """Top-k nodes of many users in one matrix product; unknown users map to null or to the fallback job"""
+    if not 0 < body.k <= MAX_RECOMMEND_K:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {MAX_RECOMMEND_K}")
+    if len(body.user_ids) > MAX_RECOMMEND_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_RECOMMEND_BATCH} users per batch")
+    job = await serving_job(job_id, user, session)
+    recommender = await run_in_threadpool(get_recommender, job["model_path"])
+    recommendations = await run_in_threadpool(recommender.recommend, body.user_ids, body.k, body.filter_seen,
+                                              body.exact)
+    unknown = [position for position, recommendation in enumerate(recommendations) if recommendation is None]
+    fallback = await fallback_recommender(body.fallback_job_id, user, session) if unknown else None
+    fallbacks = {}
+    if fallback is not None:
+        fallbacks = dict(zip(unknown, fallback.recommend([body.user_ids[position] for position in unknown], body.k)))
+    return {
+        "job_id": job_id,
+        "recommendations": {
+            str(user_id): recommendation_response(fallbacks[position], fallback=True) if position in fallbacks
+            else recommendation_response(recommendation)
+            for position, (user_id, recommendation) in enumerate(zip(body.user_ids, recommendations))
+        },
+    }
+
+
+
+@app.get("/similar_nodes/{node}")
+async def similar_nodes(node: int, job_id: int, k: int = 20, exact: bool = False,
+                        user: User = Depends(current_user), session: AsyncSession=Depends(get_async_session)):
+    """Nodes closest to node in the item factors of a completed ALS job, through its ANN index"""
+    if not 0 < k <= MAX_RECOMMEND_K:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {MAX_RECOMMEND_K}")
+    job = await serving_job(job_id, user, session, model_types=FACTOR_MODEL_TYPES)
+    recommender = await run_in_threadpool(get_recommender, job["model_path"])
+    similar = (await run_in_threadpool(recommender.similar, [node], k, exact))[0]
+    if similar is None:
+        raise HTTPException(status_code=404, detail=f"Node {node} is unknown to the model")
+    return {"job_id": job_id, "node": node, **recommendation_response(similar)}
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port="8080")
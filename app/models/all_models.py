@@ -1,9 +1,9 @@
 import bcrypt
 from pydantic import BaseModel
 from sqlmodel import Field, SQLModel, Relationship
+from sqlalchemy import Index
 import datetime
 from typing import List, Optional
-import joblib
 
 
 def get_current_date():
@@ -14,7 +14,7 @@ class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     username: str
     password: str
-    email: str
+    email: str = Field(index=True)
     balance: float = Field(default=0.0)
     is_admin: bool = Field(default=False)
     tasks: List["MLTask"] = Relationship(back_populates="user")
@@ -40,14 +40,23 @@ class TokenResponse(BaseModel):
     access_token: str 
     token_type: str
     
+class RecommendBatchRequest(BaseModel):
+    user_ids: List[int]
+    k: int = 40
+    filter_seen: bool = True
+    exact: bool = False
+    fallback_job_id: Optional[int] = None
+
 class UserSignIn(SQLModel): 
     email: str 
     password: str
 
 
 class Transaction(SQLModel, table=True):
+    __table_args__ = (Index("ix_transaction_user_id_created_at", "user_id", "created_at", "id"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    user_id: int = Field(foreign_key="user.id")
+    user_id: int = Field(foreign_key="user.id", index=True)
     amount: float
     transaction_type: str
     transaction_status: str
@@ -58,19 +67,24 @@ class Transaction(SQLModel, table=True):
 
 class Prediction(SQLModel, table=True):
     prediction_id: Optional[int] = Field(default=None, primary_key=True)
-    task_id: int = Field(foreign_key="mltask.task_id")
+    task_id: int = Field(foreign_key="mltask.task_id", index=True)
     output: Optional[int] = Field(default=None)
+    feature_version: Optional[str] = Field(default=None)  # version of the feature snapshot used
     timestamp: str = Field(default_factory=get_current_date)
 
     task: "MLTask" = Relationship(back_populates="predictions")
 
 
 class MLTask(SQLModel, table=True):
+    __table_args__ = (Index("ix_mltask_user_id_timestamp", "user_id", "timestamp", "task_id"),)
+
     task_id: Optional[int] = Field(default=None, primary_key=True)
-    user_id: int = Field(foreign_key="user.id")
+    user_id: int = Field(foreign_key="user.id", index=True)
     model_id: int = Field(foreign_key="mlmodel.model_id")
     timestamp: str = Field(default_factory=get_current_date)
     cost: float = 20
+    # paid -> processed by the worker, or paid -> refunded when it could not be enqueued
+    status: str = Field(default="paid")
     user: User = Relationship(back_populates="tasks")
     model: "MLModel" = Relationship(back_populates="tasks")
     predictions: List["Prediction"] = Relationship(back_populates="task")
@@ -80,20 +94,21 @@ class MLTask(SQLModel, table=True):
 class MLModel(SQLModel, table=True):
     model_id: Optional[int] = Field(default=None, primary_key=True)
     model_path: str
-    __model = None
     tasks: List[MLTask] = Relationship(back_populates="model")
 
     def load_model(self):
+        # Loaded estimators live in the process-wide registry, so every
+        # MLModel instance with the same model_id shares one deserialized copy
+        from services.serving.model_registry import get_model_registry
         try:
-            self.__model = joblib.load(open(self.model_path, 'rb'))
+            return get_model_registry().get(self.model_id, self.model_path)
         except Exception as e:
             print(f"Ошибка при загрузке модели: {e}")
-            self.__model = None
+            return None
 
     def predict(self, input_data: List) -> "Prediction":
-        if self.__model is None:
-            self.load_model()
-        prediction = self.__model.predict(input_data)
+        model = self.load_model()
+        prediction = model.predict(input_data)
 
         return prediction
 
@@ -101,19 +116,27 @@ class MLModel(SQLModel, table=True):
 class RabbitmqResult(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     task_id: int = Field(foreign_key="mltask.task_id")
-    request_id: str
+    request_id: str = Field(unique=True, index=True)
 
     task: "MLTask" = Relationship(back_populates="rabbitmqresults")
 
 
 class TrainingJob(SQLModel, table=True):
+    __table_args__ = (Index("ix_trainingjob_user_id_created_at", "user_id", "created_at", "job_id"),)
+
     job_id: Optional[int] = Field(default=None, primary_key=True)
-    user_id: int = Field(foreign_key="user.id")
+    user_id: int = Field(foreign_key="user.id", index=True)
     model_type: str  # "popular" or "als"
     data_path: str
     hyperparams: Optional[str] = Field(default=None)  # JSON string
-    status: str = Field(default="pending")  # pending, loading_data, preprocessing, training, completed, failed
+    status: str = Field(default="pending")  # pending, loading_data, preprocessing, training, completed, failed, cancelled
+    priority: str = Field(default="interactive")  # interactive or batch
+    job_key: Optional[str] = Field(default=None, index=True)  # Hash of model type, data path and hyperparams
+    merged_into: Optional[int] = Field(default=None)  # Job whose run produces this job's result
+    cancel_requested: bool = Field(default=False)
+    last_phase: Optional[str] = Field(default=None)  # Last completed phase, where a restarted job resumes
     metrics: Optional[str] = Field(default=None)  # JSON string
+    telemetry: Optional[str] = Field(default=None)  # JSON string: per-phase timings, memory and sizes
     model_path: Optional[str] = Field(default=None)
     created_at: str = Field(default_factory=get_current_date)
     updated_at: str = Field(default_factory=get_current_date)
@@ -0,0 +1,84 @@
+from typing import Optional, Tuple
+from sqlalchemy import update
+from models.all_models import MLTask, RabbitmqResult, Transaction, User
+
+
+class InsufficientFundsError(Exception):
+    pass
+
+
+class InvalidAmountError(Exception):
+    pass
+
+
+async def charge_for_task(user_id: int, model_id: int, cost: float, request_id: str, session) -> Tuple[User, MLTask]:
+    """Charge the user and record the task, its ledger row and request mapping in one transaction.
+
+    The balance check and the decrement happen in a single conditional UPDATE,
+    so concurrent requests cannot overdraw the account.
+    """
+    result = await session.execute(
+        update(User)
+        .where(User.id == user_id, User.balance >= cost)
+        .values(balance=User.balance - cost)
+        .returning(User)
+    )
+    user = result.scalar_one_or_none()
+    if user is None:
+        await session.rollback()
+        raise InsufficientFundsError(f"Balance is below the task cost {cost}")
+
+    task = MLTask(user_id=user_id, model_id=model_id, cost=cost)
+    session.add(task)
+    await session.flush()
+    session.add_all([
+        Transaction(user_id=user_id, amount=cost, transaction_type='withdraw', transaction_status='success'),
+        RabbitmqResult(task_id=task.task_id, request_id=request_id),
+    ])
+    await session.commit()
+    return user, task
+
+
+async def refund_task(task: MLTask, session) -> Optional[User]:
+    """Give the cost back when a charged task could not be enqueued.
+
+    The task is marked refunded in the same transaction, and only while it is
+    still unprocessed, so a message the broker delivered after all is skipped
+    by the worker. Returns None when the worker already processed the task.
+    """
+    task_id, user_id, cost = task.task_id, task.user_id, task.cost
+    result = await session.execute(
+        update(MLTask)
+        .where(MLTask.task_id == task_id, MLTask.status == "paid")
+        .values(status="refunded")
+        .returning(MLTask.task_id)
+    )
+    if result.scalar_one_or_none() is None:
+        await session.rollback()
+        return None
+    result = await session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(balance=User.balance + cost)
+        .returning(User)
+    )
+    session.add(Transaction(user_id=user_id, amount=cost, transaction_type='refund', transaction_status='success'))
+    user = result.scalar_one()
+    await session.commit()
+    return user
+
+
+async def deposit(user_id: int, amount: float, session) -> User:
+    if amount <= 0:
+        raise InvalidAmountError("Deposit amount must be positive")
+
+    result = await session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(balance=User.balance + amount)
+        .returning(User)
+    )
+    user = result.scalar_one()
+    session.add(Transaction(user_id=user_id, amount=amount, transaction_type='deposit', transaction_status='success'))
+    await session.commit()
+    return user
@@ -1,4 +1,9 @@
 from models.all_models import MLModel, MLTask, Prediction, RabbitmqResult, User
+from typing import List, Optional, Set
+from sqlmodel import select
+from sqlalchemy import func, update
+from services.crud.pagination import filter_dates, keyset_page, page_response
+import datetime
 
 
 def create_model(new_model: MLModel, session) -> None:
@@ -7,6 +12,10 @@ def create_model(new_model: MLModel, session) -> None:
     session.refresh(new_model)
 
 
+def get_model_by_id(model_id: int, session) -> Optional[MLModel]:
+    return session.get(MLModel, model_id)
+
+
 def create_task(new_task: MLTask, session) -> None:
     session.add(new_task) 
     session.commit() 
@@ -14,12 +23,36 @@ def create_task(new_task: MLTask, session) -> None:
     return new_task
 
 
+def claim_tasks(task_ids: List[int], session) -> Set[int]:
+    """Mark paid tasks processed and return their ids; refunded tasks are left out.
+
+    Not committed: the claim is committed together with the predictions, so
+    a failed batch leaves its tasks paid for the redelivery.
+    """
+    result = session.execute(
+        update(MLTask)
+        .where(MLTask.task_id.in_(task_ids), MLTask.status == "paid")
+        .values(status="processed")
+        .returning(MLTask.task_id)
+    )
+    return set(result.scalars().all())
+
+
 def create_prediction(new_prediction: Prediction, session) -> None:
     session.add(new_prediction) 
     session.commit() 
     session.refresh(new_prediction)
 
 
+def create_predictions(new_predictions: List[Prediction], session) -> List[dict]:
+    """Insert predictions in one transaction and return their values, read before commit expires them"""
+    session.add_all(new_predictions)
+    session.flush()
+    results = [p.model_dump() for p in new_predictions]
+    session.commit()
+    return results
+
+
 def create_rabbitmq_result(new_rabbitmq_result: RabbitmqResult, session) -> None:
     session.add(new_rabbitmq_result) 
     session.commit() 
@@ -38,4 +71,53 @@ def get_prediction(request_id, session):
     prediction = session.query(Prediction).filter(Prediction.task_id == task.task_id).first()
     if prediction is None:
         return "There is no such a prediction"
-    return f"prediction_id: {prediction.prediction_id}, task_id: {prediction.task_id}, timestamp: {prediction.timestamp}, result: {prediction.output}"
+    return format_prediction(prediction.model_dump())
+
+
+def format_prediction(prediction: dict) -> str:
+    return f"prediction_id: {prediction['prediction_id']}, task_id: {prediction['task_id']}, timestamp: {prediction['timestamp']}, result: {prediction['output']}"
+
+
+async def create_task_async(new_task: MLTask, session) -> MLTask:
+    session.add(new_task)
+    await session.commit()
+    await session.refresh(new_task)
+    return new_task
+
+
+async def create_rabbitmq_result_async(new_rabbitmq_result: RabbitmqResult, session) -> None:
+    session.add(new_rabbitmq_result)
+    await session.commit()
+
+
+async def get_task_history_page_async(user: User, session, limit: Optional[int] = None, cursor: Optional[str] = None,
+                                     date_from: Optional[datetime.date] = None, date_to: Optional[datetime.date] = None) -> dict:
+    statement = filter_dates(select(MLTask).where(MLTask.user_id == user.id), MLTask.timestamp, date_from, date_to)
+    tasks, next_cursor = await keyset_page(session, statement, MLTask.timestamp, MLTask.task_id, limit, cursor)
+
+    summary = filter_dates(
+        select(func.count(), func.coalesce(func.sum(MLTask.cost), 0), func.min(MLTask.timestamp), func.max(MLTask.timestamp))
+        .where(MLTask.user_id == user.id),
+        MLTask.timestamp, date_from, date_to
+    )
+    count, total_cost, first, last = (await session.exec(summary)).one()
+    return page_response(
+        [{"task_id": t.task_id, "model id": t.model_id, "timestamp": t.timestamp, "cost": t.cost} for t in tasks],
+        next_cursor,
+        {"tasks": count, "total_cost": total_cost, "first": first, "last": last}
+    )
+
+
+async def get_prediction_async(request_id, session):
+    result = await session.exec(
+        select(RabbitmqResult, Prediction)
+        .outerjoin(Prediction, Prediction.task_id == RabbitmqResult.task_id)
+        .where(RabbitmqResult.request_id == request_id)
+    )
+    row = result.first()
+    if row is None:
+        return "There is no this request"
+    _, prediction = row
+    if prediction is None:
+        return "There is no such a prediction"
+    return format_prediction(prediction.model_dump())
@@ -0,0 +1,56 @@
+import base64
+import datetime
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(timestamp: str, row_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([timestamp, row_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(timestamp), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def page_size(limit: Optional[int]) -> int:
+    return max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+
+
+def filter_dates(statement, timestamp_col, date_from: Optional[datetime.date], date_to: Optional[datetime.date]):
+    """Timestamps are stored as ISO strings, so whole-day bounds compare lexicographically"""
+    if date_from is not None:
+        statement = statement.where(timestamp_col >= date_from.isoformat())
+    if date_to is not None:
+        statement = statement.where(timestamp_col < (date_to + datetime.timedelta(days=1)).isoformat())
+    return statement
+
+
+async def keyset_page(session, statement, timestamp_col, id_col,
+                      limit: Optional[int] = None, cursor: Optional[str] = None) -> Tuple[List[Any], Optional[str]]:
+    """One page of rows ordered newest first by (timestamp, id), and the cursor of the next page"""
+    limit = page_size(limit)
+    if cursor:
+        statement = statement.where(tuple_(timestamp_col, id_col) < tuple_(*decode_cursor(cursor)))
+    statement = statement.order_by(timestamp_col.desc(), id_col.desc()).limit(limit + 1)
+
+    rows = (await session.exec(statement)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, timestamp_col.key), getattr(last, id_col.key))
+    return rows, next_cursor
+
+
+def page_response(items: List[Dict[str, Any]], next_cursor: Optional[str], summary: Dict[str, Any]) -> Dict[str, Any]:
+    return {"items": items, "next_cursor": next_cursor, "summary": summary}
@@ -1,20 +1,59 @@
-from sqlmodel import Session
+from sqlmodel import Session, select
+from sqlalchemy import func
+from services.crud.pagination import filter_dates, keyset_page, page_response
 from models.all_models import MLModel, MLTask, TrainingJob
+from database.config import get_settings
+from services.training.ann import build_ann_index
+from services.training.artifact import FACTOR_MODEL_TYPES, als_factors, is_artifact, load_artifact, save_artifact
+from services.training.checkpoint import CHECKPOINT_DIR, Checkpoint
+from services.training.encoding import InteractionEncoding, encode_interactions
+from services.training.materialize import job_set_name, materialize_top_k
+from services.training.metrics import METRIC_NAMES, list_metrics, ranking_metrics
+from services.training.popular import SEGMENTS, interaction_weights, node_segments, ranked_lists, user_segments
+from services.training.split_cache import DATA_FILES, SplitCache, dataset_fingerprint
+from services.training.sweep import expand_space, run_sweep
+from services.training.telemetry import Telemetry, TrainingCancelled
+from services.training.two_stage import (FEATURES, add_features, candidate_batches, cookie_category_features,
+                                         feature_matrix, node_categories, top_k, user_fold)
 import polars as pl
-# import implicit
-from scipy.sparse import csr_matrix
 import numpy as np
-import joblib
+import pyarrow.parquet as pq
+from scipy.sparse import csr_matrix
 import os
-from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+import shutil
+import tempfile
+from datetime import date, datetime, timedelta
+from typing import Callable, List, Dict, Any, Optional, Sequence
 import json
+import time
+
+# Columns of the clickstream kept for training, everything else is never read
+TRAIN_COLUMNS = ('cookie', 'node', 'event', 'event_date')
+# The two-stage ranker also builds features from items and surfaces
+TWO_STAGE_COLUMNS = TRAIN_COLUMNS + ('item', 'surface')
+# Statuses after which a job never changes again
+FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+# Phases of train_model in order; a restarted job skips those up to its last_phase
+PHASES = ('preprocessing', 'training', 'saving', 'indexing', 'materializing')
 
 
 class TrainingService:
     def __init__(self):
         self.models_dir = "./ml_models"
         os.makedirs(self.models_dir, exist_ok=True)
+        settings = get_settings()
+        self.metric_ks = sorted({int(k) for k in settings.METRICS_KS.split(',') if k.strip()} | {40})
+        self.metric_processes = settings.METRICS_PROCESSES
+        self.sweep_processes = settings.SWEEP_PROCESSES
+        self.ranker_threads = settings.RANKER_THREADS
+        self.recommendations_dir = settings.RECOMMENDATIONS_DIR
+        self.materialize_k = settings.MATERIALIZE_TOP_K
+        self.materialize_memory_mb = settings.MATERIALIZE_MEMORY_MB
+        self.ann_index = settings.ANN_INDEX
+        self.ann_recall_target = settings.ANN_RECALL_TARGET
+        self.checkpoint_iterations = settings.TRAINING_CHECKPOINT_ITERATIONS
+        self.split_cache = SplitCache(settings.SPLIT_CACHE_DIR, settings.SPLIT_CACHE_MAX_MB * 2 ** 20) \
+            if settings.SPLIT_CACHE_DIR else None
     
     def create_training_job(self, job: TrainingJob, session: Session) -> TrainingJob:
         session.add(job)
@@ -25,8 +64,32 @@ class TrainingService:
     def get_training_job(self, job_id: int, session: Session) -> Optional[TrainingJob]:
         return session.query(TrainingJob).filter(TrainingJob.job_id == job_id).first()
     
+    async def create_training_job_async(self, job: TrainingJob, session) -> TrainingJob:
+        session.add(job)
+        await session.commit()
+        await session.refresh(job)
+        return job
+
+    async def get_training_job_async(self, job_id: int, session) -> Optional[TrainingJob]:
+        return await session.get(TrainingJob, job_id)
+
+    async def get_user_training_jobs_page_async(self, user_id: int, session, limit: Optional[int] = None,
+                                                cursor: Optional[str] = None, date_from: Optional[date] = None,
+                                                date_to: Optional[date] = None) -> Dict[str, Any]:
+        statement = filter_dates(select(TrainingJob).where(TrainingJob.user_id == user_id),
+                                 TrainingJob.created_at, date_from, date_to)
+        jobs, next_cursor = await keyset_page(session, statement, TrainingJob.created_at, TrainingJob.job_id, limit, cursor)
+
+        summary = filter_dates(
+            select(TrainingJob.status, func.count()).where(TrainingJob.user_id == user_id).group_by(TrainingJob.status),
+            TrainingJob.created_at, date_from, date_to
+        )
+        by_status = dict((await session.exec(summary)).all())
+        return page_response(jobs, next_cursor, {"jobs": sum(by_status.values()), "by_status": by_status})
+    
     def update_training_job(self, job_id: int, status: str, session: Session, 
-                           metrics: Optional[Dict] = None, model_path: Optional[str] = None) -> TrainingJob:
+                           metrics: Optional[Dict] = None, model_path: Optional[str] = None,
+                           telemetry: Optional[Dict] = None) -> TrainingJob:
         job = self.get_training_job(job_id, session)
         if job:
             job.status = status
@@ -34,16 +97,99 @@ class TrainingService:
                 job.metrics = json.dumps(metrics)
             if model_path:
                 job.model_path = model_path
+            if telemetry:
+                job.telemetry = json.dumps(telemetry)
             job.updated_at = datetime.utcnow().isoformat()
             session.commit()
             session.refresh(job)
         return job
     
-    def load_data(self, data_path: str) -> Dict[str, pl.DataFrame]:
-        """Load training data from parquet files"""
+    def update_training_telemetry(self, job_id: int, telemetry: Dict, session: Session) -> None:
+        """Store a telemetry snapshot without touching the job's status"""
+        job = self.get_training_job(job_id, session)
+        if job:
+            job.telemetry = json.dumps(telemetry)
+            job.updated_at = datetime.utcnow().isoformat()
+            session.commit()
+    
+    def update_last_phase(self, job_id: int, phase: str, session: Session) -> None:
+        job = self.get_training_job(job_id, session)
+        if job:
+            job.last_phase = phase
+            job.updated_at = datetime.utcnow().isoformat()
+            session.commit()
+    
+    def merge_training_job(self, job_id: int, leader_id: int, session: Session) -> None:
+        """Attach a job to the identical run of leader_id instead of training it again"""
+        job = self.get_training_job(job_id, session)
+        if job:
+            job.merged_into = leader_id
+            job.updated_at = datetime.utcnow().isoformat()
+            session.commit()
+    
+    def run_cancelled(self, leader_id: int, session: Session) -> bool:
+        """True when the leader and every job merged into it asked to be cancelled"""
+        statement = select(func.count()).select_from(TrainingJob).where(
+            (TrainingJob.job_id == leader_id) | (TrainingJob.merged_into == leader_id),
+            TrainingJob.cancel_requested == False  # noqa: E712
+        )
+        return session.exec(statement).one() == 0
+    
+    def finish_merged_jobs(self, leader_id: int, job_ids: Sequence[int], session: Session) -> None:
+        """Copy the outcome of the leader's run to the jobs merged into it.
+
+        Jobs that asked to be cancelled, the leader included, end cancelled
+        even if the run went on for the others.
+        """
+        leader = self.get_training_job(leader_id, session)
+        session.refresh(leader)
+        status = leader.status if leader.status in FINAL_STATUSES else "failed"
+        outcome = (leader.metrics, leader.model_path, leader.telemetry)
+        now = datetime.utcnow().isoformat()
+        for job in session.exec(select(TrainingJob).where(TrainingJob.job_id.in_(list(job_ids)))).all():
+            if job.cancel_requested:
+                job.status = "cancelled"
+            elif job.job_id != leader_id:
+                job.status = status
+                job.metrics, job.model_path, job.telemetry = outcome
+            else:
+                job.status = status
+            job.updated_at = now
+        session.commit()
+    
+    def resource_profile(self, model_type: str, session: Session) -> Optional[Dict[str, float]]:
+        """Peak RSS and clickstream rows of the latest completed job of model_type with telemetry"""
+        statement = select(TrainingJob).where(
+            TrainingJob.model_type == model_type, TrainingJob.status == "completed", TrainingJob.telemetry != None  # noqa: E711
+        ).order_by(TrainingJob.job_id.desc()).limit(1)
+        job = session.exec(statement).first()
+        if job is None:
+            return None
+        telemetry = json.loads(job.telemetry)
+        rows = telemetry.get('counters', {}).get('input_rows', {}).get('clickstream.pq')
+        if not rows or not telemetry.get('peak_rss_mb'):
+            return None
+        return {'peak_rss_mb': telemetry['peak_rss_mb'], 'rows': rows}
+    
+    async def cancel_training_job_async(self, job: TrainingJob, session) -> TrainingJob:
+        """Ask a job to stop. A job that has not started is cancelled at once, a running one at its next check"""
+        job.cancel_requested = True
+        if job.status == "pending":
+            job.status = "cancelled"
+        job.updated_at = datetime.utcnow().isoformat()
+        await session.commit()
+        await session.refresh(job)
+        return job
+    
+    def load_data(self, data_path: str) -> Dict[str, pl.LazyFrame]:
+        """Scan training data from parquet files.
+
+        Nothing is read here: the frames are lazy, so filters and column
+        selections of preprocess_data are pushed down into the parquet reader.
+        """
         try:
-            clickstream = pl.read_parquet(f'{data_path}/clickstream.pq')
-            events = pl.read_parquet(f'{data_path}/events.pq')
+            clickstream = pl.scan_parquet(f'{data_path}/clickstream.pq')
+            events = pl.scan_parquet(f'{data_path}/events.pq')
             
             return {
                 'clickstream': clickstream,
@@ -52,91 +198,401 @@ class TrainingService:
         except Exception as e:
             raise Exception(f"Error loading data: {e}")
     
-    def preprocess_data(self, data: Dict[str, pl.DataFrame], eval_days: int = 14) -> Dict[str, pl.DataFrame]:
-        """Preprocess data for training"""
+    def input_rows(self, data_path: str) -> Dict[str, int]:
+        """Row counts of the input parquet files, read from their footers"""
+        return {name: pq.ParquetFile(os.path.join(data_path, name)).metadata.num_rows for name in DATA_FILES}
+    
+    def preprocess_data(self, data: Dict[str, pl.LazyFrame], eval_days: int = 14,
+                        train_columns: Sequence[str] = TRAIN_COLUMNS, streaming: bool = True) -> Dict[str, pl.DataFrame]:
+        """Preprocess data for training.
+
+        The split is one lazy plan over the parquet scans. Only the max date is
+        computed up front; the date predicates and the column projection reach
+        the reader, and both frames are collected together so the common
+        subplans are evaluated once. streaming runs the plan in batches
+        instead of materializing every intermediate frame.
+        """
         clickstream = data['clickstream']
         events = data['events']
         
         # Split into train/eval
-        threshold = clickstream['event_date'].max() - timedelta(days=eval_days)
+        max_date = clickstream.select(pl.col('event_date').max()).collect().item()
+        threshold = max_date - timedelta(days=eval_days)
         
-        df_train = clickstream.filter(clickstream['event_date'] <= threshold)
-        df_eval = clickstream.filter(clickstream['event_date'] > threshold)[['cookie', 'node', 'event']]
-        df_eval = df_eval.join(df_train, on=['cookie', 'node'], how='anti')
+        df_train = clickstream.filter(pl.col('event_date') <= threshold).select(train_columns)
+        train_pairs = df_train.select('cookie', 'node')
         
         # Filter evaluation data
-        contact_events = events.filter(pl.col('is_contact') == 1)['event'].unique()
-        df_eval = df_eval.filter(pl.col('event').is_in(contact_events))
-        df_eval = df_eval.filter(pl.col('cookie').is_in(df_train['cookie'].unique()))
-        df_eval = df_eval.filter(pl.col('node').is_in(df_train['node'].unique()))
-        df_eval = df_eval.unique(['cookie', 'node'])
+        contact_events = events.filter(pl.col('is_contact') == 1).select('event')
+        df_eval = (
+            clickstream.filter(pl.col('event_date') > threshold)
+            .select('cookie', 'node', 'event')
+            .join(contact_events, on='event', how='semi')
+            .join(train_pairs, on=['cookie', 'node'], how='anti')
+            .join(train_pairs.select('cookie').unique(), on='cookie', how='semi')
+            .join(train_pairs.select('node').unique(), on='node', how='semi')
+            .unique(['cookie', 'node'])
+        )
         
+        df_train, df_eval = pl.collect_all([df_train, df_eval], engine='streaming' if streaming else 'auto')
         return {
             'train': df_train,
             'eval': df_eval
         }
     
-    def train_popular_model(self, df_train: pl.DataFrame, df_eval: pl.DataFrame) -> Dict[str, float]:
-        """Train simple popular items model"""
-        popular_nodes = df_train.group_by('node').agg(pl.col('cookie').count()).sort('cookie').tail(40)['node'].to_list()
-        eval_users = df_eval['cookie'].unique().to_list()
+    def load_split(self, data_path: str, eval_days: int = 14,
+                   train_columns: Sequence[str] = TRAIN_COLUMNS,
+                   checkpoint: Optional[Checkpoint] = None) -> Dict[str, Any]:
+        """Train/eval split and encoded train matrix of data_path, from the split cache when possible.
+
+        Without a split cache the split is kept in the job's checkpoint instead.
+        """
+        fingerprint = None
+        cache = self.split_cache if self.split_cache is not None or checkpoint is None else checkpoint.splits
+        if cache is not None:
+            fingerprint = dataset_fingerprint(data_path, eval_days, train_columns)
+            split = cache.get(fingerprint)
+            if split is not None:
+                print(f"Split cache hit for {data_path} ({fingerprint})")
+                return split
         
-        df_pred_pop = pl.DataFrame({
-            'node': [popular_nodes for _ in range(len(eval_users))], 
-            'cookie': eval_users
-        })
-        df_pred_pop = df_pred_pop.explode('node')
+        processed_data = self.preprocess_data(self.load_data(data_path), eval_days, train_columns)
+        encoding = encode_interactions(processed_data['train'], 'cookie', 'node')
+        if fingerprint is not None:
+            cache.put(fingerprint, data_path, processed_data['train'], processed_data['eval'], encoding)
         
-        metrics = self.calculate_metrics(df_eval, df_pred_pop, k=40)
-        return metrics
+        return {
+            'train': processed_data['train'],
+            'eval': processed_data['eval'],
+            'encoding': encoding
+        }
+    
+    def train_popular_model(self, df_train: pl.DataFrame, df_eval: pl.DataFrame,
+                            half_life_days: Optional[float] = None, segment: Optional[str] = None,
+                            cat_features: Optional[pl.LazyFrame] = None) -> Dict[str, Any]:
+        """Train the most popular nodes model, optionally time-decayed and per user segment.
+
+        With half_life_days an interaction's weight halves every half_life_days
+        before the last train day. With segment (a cat_features.pq column) each
+        train user is assigned the segment of most of its nodes and gets the
+        list of its segment; users without one get the global list. Every
+        user of a list gets the same nodes, so metrics come from the list
+        ranks of the eval nodes instead of a copy of the list per user.
+        """
+        size = max(max(self.metric_ks), self.materialize_k)
+        weighted = interaction_weights(df_train, half_life_days)
+        popular = ranked_lists(weighted, size)
+        catalog_size = df_train['node'].n_unique()
+        model_data = {
+            'popular_nodes': popular['node'].to_numpy(),
+            'popular_scores': popular['score'].to_numpy(),
+            'params': {'half_life_days': half_life_days, 'segment': segment, 'size': size}
+        }
+        
+        if segment is None:
+            metrics = self.calculate_list_metrics(df_eval, popular, k=40, catalog_size=catalog_size)
+        else:
+            if segment not in SEGMENTS:
+                raise ValueError(f"Unknown segment {segment}, expected one of {', '.join(SEGMENTS)}")
+            users = user_segments(df_train, node_segments(cat_features, segment))
+            lists = ranked_lists(weighted.join(users.lazy(), on='cookie'), size, by='segment')
+            # The global list under a null segment, for users without one
+            lists = pl.concat([lists, popular.select(pl.lit(None, dtype=lists['segment'].dtype).alias('segment'), pl.all())])
+            df_true = df_eval.join(users, on='cookie', how='left')
+            metrics = self.calculate_list_metrics(df_true, lists, k=40, catalog_size=catalog_size, list_col='segment')
+            model_data.update(segment_lists=lists, user_segments=users.sort('cookie'))
+        
+        return {
+            'metrics': metrics,
+            'model_data': model_data
+        }
     
     def train_als_model(self, df_train: pl.DataFrame, df_eval: pl.DataFrame, 
-                       iterations: int = 10, factors: int = 60) -> Dict[str, Any]:
-        """Train ALS collaborative filtering model"""
-        users = df_train["cookie"]
-        nodes = df_train["node"]
-        eval_users = df_eval['cookie'].unique().to_list()
+                       iterations: int = 10, factors: int = 60, regularization: float = 0.01,
+                       alpha: float = 1.0, num_threads: int = 0,
+                       encoding: Optional[InteractionEncoding] = None, callback=None,
+                       checkpoint: Optional[Checkpoint] = None) -> Dict[str, Any]:
+        """Train ALS collaborative filtering model; callback(iteration, elapsed, loss) follows the fit.
+
+        With a checkpoint the factors are saved every few iterations and the
+        fit continues from the latest saved ones.
+        """
+        from implicit.als import AlternatingLeastSquares
+
+        if encoding is None:
+            encoding = encode_interactions(df_train, 'cookie', 'node')
+        sparse_matrix = encoding.matrix
         
-        # Create mappings
-        user_ids = users.unique().to_list()
-        item_ids = nodes.unique().to_list()
+        # Train model
+        model = AlternatingLeastSquares(iterations=iterations, factors=factors, regularization=regularization,
+                                        alpha=alpha, num_threads=num_threads)
+        start = 0
+        if checkpoint is not None:
+            resumed = checkpoint.load_factors('als', *sparse_matrix.shape, factors)
+            if resumed is not None:
+                start, model.user_factors, model.item_factors = resumed
+                print(f"Resuming ALS from the factors after iteration {start}")
+            callback = checkpoint.als_callback('als', model, start, iterations, callback)
+        if start < iterations:
+            # fit keeps factors that are already set
+            model.iterations = iterations - start
+            model.fit(sparse_matrix, callback=callback)
+            model.iterations = iterations
         
-        user_id_to_index = {user_id: idx for idx, user_id in enumerate(user_ids)}
-        item_id_to_index = {item_id: idx for idx, item_id in enumerate(item_ids)}
-        index_to_item_id = {v: k for k, v in item_id_to_index.items()}
+        metrics = self.evaluate_als_model(model, encoding, df_eval)
         
-        # Create sparse matrix
-        rows = users.replace_strict(user_id_to_index).to_list()
-        cols = nodes.replace_strict(item_id_to_index).to_list()
-        values = [1] * len(users)
+        # Save model
+        model_data = {
+            'model': model,
+            'user_ids': encoding.user_ids,
+            'item_ids': encoding.item_ids,
+            'sparse_matrix': sparse_matrix,
+            'params': {'factors': factors, 'iterations': iterations, 'regularization': regularization, 'alpha': alpha}
+        }
         
-        sparse_matrix = csr_matrix((values, (rows, cols)), shape=(len(user_ids), len(item_ids)))
+        return {
+            'metrics': metrics,
+            'model_data': model_data
+        }
+    
+    def evaluate_als_model(self, model, encoding: InteractionEncoding, df_eval: pl.DataFrame) -> Dict[str, float]:
+        """Ranking metrics of the model's top-K, seen nodes excluded, for the eval users it knows"""
+        user4pred = encoding.encode_users(df_eval['cookie'].unique().to_numpy())
+        user4pred = user4pred[user4pred >= 0]
+        recommendations, scores = model.recommend(user4pred, encoding.matrix[user4pred], N=max(self.metric_ks),
+                                                filter_already_liked_items=True)
+        df_pred = encoding.recommendations_frame(user4pred, recommendations, scores)
+        return self.calculate_metrics(df_eval, df_pred, k=40, catalog_size=encoding.shape[1])
+    
+    def train_als_incremental(self, df_train: pl.DataFrame, df_eval: pl.DataFrame, base_data: Dict[str, Any],
+                              iterations: int = 2, num_threads: int = 0, callback=None) -> Dict[str, Any]:
+        """Warm-start ALS: update a previous model with the interactions added since it was trained.
+
+        The id maps of the base model are extended with the new cookies and
+        nodes and the train window is encoded against them. Only users and
+        nodes whose matrix rows differ from the base model's matrix, new ones
+        included, are recomputed: each round solves those users against the
+        fixed item factors, then those nodes against the updated user factors
+        (implicit's partial_fit_users / partial_fit_items). Everyone else keeps
+        the base factors, including ids that left the train window.
+        """
+        from implicit.als import AlternatingLeastSquares
+
+        base_users = np.asarray(base_data['user_ids'])
+        base_items = np.asarray(base_data['item_ids'])
+        encoding = encode_interactions(
+            df_train, 'cookie', 'node',
+            user_ids=np.union1d(base_users, df_train['cookie'].unique().to_numpy()),
+            item_ids=np.union1d(base_items, df_train['node'].unique().to_numpy()),
+        )
+        matrix = encoding.matrix
+        user_map = encoding.encode_users(base_users)
+        item_map = encoding.encode_items(base_items)
         
-        # Train model
-        model = implicit.als.AlternatingLeastSquares(iterations=iterations, factors=factors)
-        model.fit(sparse_matrix)
+        # The base matrix in the new codes; users and nodes whose rows changed are refitted
+        base_matrix = base_data['sparse_matrix'].tocoo()
+        remapped = csr_matrix((base_matrix.data, (user_map[base_matrix.row], item_map[base_matrix.col])),
+                              shape=matrix.shape, dtype=np.float32)
+        diff = (matrix - remapped).tocoo()
+        changed = diff.data != 0
+        active_users = np.diff(matrix.indptr) > 0
+        active_items = np.bincount(matrix.indices, minlength=matrix.shape[1]) > 0
+        users = np.unique(diff.row[changed])
+        users = users[active_users[users]]
+        items = np.unique(diff.col[changed])
+        items = items[active_items[items]]
+        
+        user_factors, item_factors = als_factors(base_data)
+        params = {'regularization': 0.01, 'alpha': 1.0, **base_data.get('params', {})}
+        model = AlternatingLeastSquares(factors=user_factors.shape[1], regularization=params['regularization'],
+                                        alpha=params['alpha'], num_threads=num_threads)
+        model.user_factors = np.zeros((matrix.shape[0], user_factors.shape[1]), dtype=np.float32)
+        model.user_factors[user_map] = user_factors
+        model.item_factors = np.zeros((matrix.shape[1], item_factors.shape[1]), dtype=np.float32)
+        model.item_factors[item_map] = item_factors
+        
+        item_users = matrix.T.tocsr()
+        for iteration in range(iterations):
+            started = time.time()
+            if len(users):
+                model.partial_fit_users(users, matrix[users])
+            if len(items):
+                model.partial_fit_items(items, item_users[items])
+            if callback is not None:
+                callback(iteration, time.time() - started, None)
+        
+        metrics = self.evaluate_als_model(model, encoding, df_eval)
+        metrics.update(refit_users=int(len(users)), refit_nodes=int(len(items)),
+                       new_users=int(matrix.shape[0] - len(base_users)), new_nodes=int(matrix.shape[1] - len(base_items)))
+        
+        model_data = {
+            'model': model,
+            'user_ids': encoding.user_ids,
+            'item_ids': encoding.item_ids,
+            'sparse_matrix': matrix,
+            'params': {**params, 'factors': int(user_factors.shape[1]), 'incremental_iterations': iterations}
+        }
+        
+        return {
+            'metrics': metrics,
+            'model_data': model_data
+        }
+    
+    def calculate_metrics(self, df_true: pl.DataFrame, df_pred: pl.DataFrame, k: int = 40,
+                          catalog_size: Optional[int] = None) -> Dict[str, float]:
+        """Calculate ranking metrics for every configured K.
+
+        recall_at_k, precision_at_k and f1_at_k repeat the values for k.
+        """
+        metrics = ranking_metrics(df_true, df_pred, ks=set(self.metric_ks) | {k}, catalog_size=catalog_size,
+                                  processes=self.metric_processes)
+        return self._with_k_aliases(metrics, k)
+    
+    def calculate_list_metrics(self, df_true: pl.DataFrame, lists: pl.DataFrame, k: int = 40,
+                               catalog_size: Optional[int] = None, list_col: Optional[str] = None) -> Dict[str, float]:
+        """calculate_metrics for shared ranked lists, see list_metrics"""
+        metrics = list_metrics(df_true, lists, ks=set(self.metric_ks) | {k}, catalog_size=catalog_size,
+                               list_col=list_col)
+        return self._with_k_aliases(metrics, k)
+    
+    @staticmethod
+    def _with_k_aliases(metrics: Dict[str, float], k: int) -> Dict[str, float]:
+        for name in ('recall', 'precision', 'f1'):
+            metrics[f'{name}_at_k'] = metrics[f'{name}_at_{k}']
+        return metrics
+    
+    def train_two_stage_model(self, df_train: pl.DataFrame, df_eval: pl.DataFrame, data_path: str,
+                              hyperparams: Optional[Dict] = None,
+                              encoding: Optional[InteractionEncoding] = None, callback=None) -> Dict[str, Any]:
+        """ALS candidates re-ranked by a CatBoost ranker (the model.ipynb recipe, on CPU).
+
+        A first ALS is fitted on the train window without its last ranker_days
+        days; its candidates for the users active in those days, labelled with
+        their contacts, train the ranker. The final ALS is fitted on the whole
+        train window and its candidates for the eval users are re-ranked.
+        Candidates are generated, featurized and scored per batch of users, so
+        only one chunk of the users x n_candidates frame is held at a time.
+        Ranker training keeps only users with a contact among their candidates
+        (the pairwise loss learns nothing from the others), up to
+        ranker_max_rows rows.
+        """
+        from catboost import CatBoost, Pool
+        from implicit.als import AlternatingLeastSquares
+
+        hyperparams = hyperparams or {}
+        n_candidates = int(hyperparams.get('n_candidates', 300))
+        ranker_days = int(hyperparams.get('ranker_days', 7))
+        batch_users = int(hyperparams.get('batch_users', 20_000))
+        max_rows = int(hyperparams.get('ranker_max_rows', 5_000_000))
+        threads = int(hyperparams.get('threads') or self.ranker_threads)
+        seed = int(hyperparams.get('seed', 42))
+        als_params = {
+            'iterations': int(hyperparams.get('iterations', 10)),
+            'factors': int(hyperparams.get('factors', 60)),
+            'num_threads': threads,
+            'random_state': seed,
+        }
+        
+        contact_events = pl.scan_parquet(f'{data_path}/events.pq').filter(pl.col('is_contact') == 1) \
+            .select('event').collect()['event']
+        cat_features = pl.scan_parquet(f'{data_path}/cat_features.pq')
+        categories = node_categories(cat_features)
+        df_train = df_train.with_columns(is_target=pl.col('event').is_in(contact_events.implode()).cast(pl.Int8))
+        
+        # Stage one on the older history, labels from the last ranker_days days
+        ranker_threshold = df_train['event_date'].max() - timedelta(days=ranker_days)
+        df_cand = df_train.filter(pl.col('event_date') <= ranker_threshold)
+        df_ranker = df_train.filter(pl.col('event_date') > ranker_threshold)
+        targets = df_ranker.group_by('cookie', 'node').agg(pl.col('is_target').max())
+        
+        cand_encoding = encode_interactions(df_cand, 'cookie', 'node')
+        cand_model = AlternatingLeastSquares(**als_params)
+        cand_model.fit(cand_encoding.matrix)
+        cand_features = cookie_category_features(df_cand, cat_features)
+        
+        ranker_users = cand_encoding.encode_users(df_ranker['cookie'].unique().to_numpy())
+        ranker_users = ranker_users[ranker_users >= 0]
+        np.random.default_rng(seed).shuffle(ranker_users)
         
-        # Generate predictions
-        user4pred = np.array([user_id_to_index[i] for i in eval_users])
-        recommendations, scores = model.recommend(user4pred, sparse_matrix[user4pred], N=40, filter_already_liked_items=True)
+        chunks, rows = [], 0
+        for candidates in candidate_batches(cand_model, cand_encoding, ranker_users, n_candidates, batch_users):
+            chunk = (
+                add_features(candidates, categories, cand_features)
+                .join(targets, on=['cookie', 'node'], how='left')
+                .with_columns(pl.col('is_target').fill_null(0))
+                .filter(pl.col('is_target').max().over('cookie') > 0)
+                .select('cookie', *FEATURES, 'is_target')
+            )
+            chunks.append(chunk)
+            rows += chunk.height
+            if rows >= max_rows:
+                break
+        del cand_model, cand_encoding, cand_features, df_cand, df_ranker, targets
+        if rows == 0:
+            raise ValueError("No contacts among the ranker candidates, nothing to train the ranker on")
         
-        df_pred = pl.DataFrame({
-            'node': [[index_to_item_id[i] for i in rec] for rec in recommendations.tolist()],
-            'cookie': list(eval_users),
-            'scores': scores.tolist()
+        # CatBoost wants the rows of a group next to each other
+        ranker_data = pl.concat(chunks).sort('cookie')
+        del chunks
+        is_eval = ranker_data.select(user_fold('cookie', 10, seed) == 0).to_series()
+        
+        def pool(df: pl.DataFrame) -> Pool:
+            return Pool(data=feature_matrix(df), label=df['is_target'].to_numpy(), group_id=df['cookie'].to_numpy())
+        
+        train_pool = pool(ranker_data.filter(~is_eval))
+        eval_part = ranker_data.filter(is_eval)
+        eval_pool = pool(eval_part) if eval_part.height else None
+        del ranker_data, eval_part
+        
+        ranker = CatBoost(params={
+            'loss_function': 'PairLogitPairwise',
+            'eval_metric': 'RecallAt:top=40',
+            'iterations': int(hyperparams.get('num_trees', 500)),
+            'learning_rate': float(hyperparams.get('learning_rate', 0.1)),
+            'early_stopping_rounds': 50,
+            'nan_mode': 'Min',
+            'random_seed': seed,
+            'thread_count': threads,
+            'task_type': 'CPU',
+            'allow_writing_files': False,
+            'verbose': 100,
         })
-        df_pred = df_pred.explode(['node', 'scores'])
+        ranker.fit(train_pool, eval_set=eval_pool)
+        del train_pool, eval_pool
         
-        # Calculate metrics
-        metrics = self.calculate_metrics(df_eval, df_pred, k=40)
+        # Stage two: candidates of the full train window for the eval users
+        if encoding is None:
+            encoding = encode_interactions(df_train, 'cookie', 'node')
+        model = AlternatingLeastSquares(**als_params)
+        model.fit(encoding.matrix, callback=callback)
+        features = cookie_category_features(df_train, cat_features)
+        
+        eval_users = encoding.encode_users(df_eval['cookie'].unique().to_numpy())
+        eval_users = eval_users[eval_users >= 0]
+        k = max(self.metric_ks)
+        preds, als_preds = [], []
+        for candidates in candidate_batches(model, encoding, eval_users, n_candidates, batch_users):
+            chunk = add_features(candidates, categories, features)
+            chunk = chunk.with_columns(ranker_score=ranker.predict(feature_matrix(chunk), thread_count=threads))
+            preds.append(top_k(chunk.select('cookie', 'node', 'ranker_score'), 'ranker_score', k))
+            als_preds.append(top_k(candidates, 'scores', k))
+        
+        metrics = self.calculate_metrics(df_eval, pl.concat(preds), k=40, catalog_size=encoding.shape[1])
+        # Plain ALS on the same candidates, to see what the ranker adds
+        als_metrics = self.calculate_metrics(df_eval, pl.concat(als_preds), k=40, catalog_size=encoding.shape[1])
+        metrics['als_baseline'] = {key: value for key, value in als_metrics.items() if not key.endswith('_at_k')}
+        metrics['ranker_trees'] = ranker.tree_count_
         
-        # Save model
         model_data = {
             'model': model,
-            'user_id_to_index': user_id_to_index,
-            'item_id_to_index': item_id_to_index,
-            'index_to_item_id': index_to_item_id,
-            'sparse_matrix': sparse_matrix
+            'ranker': ranker,
+            'user_ids': encoding.user_ids,
+            'item_ids': encoding.item_ids,
+            'sparse_matrix': encoding.matrix,
+            'node_categories': categories,
+            'cookie_category_features': features,
+            'features': FEATURES,
+            'n_candidates': n_candidates
         }
         
         return {
@@ -144,93 +600,246 @@ class TrainingService:
             'model_data': model_data
         }
     
-    def calculate_metrics(self, df_true: pl.DataFrame, df_pred: pl.DataFrame, k: int = 40) -> Dict[str, float]:
-        """Calculate Recall@K, Precision@K, and F1@K metrics"""
-        # Recall@K
-        recall_at_k = df_true[['node', 'cookie']].join(
-            df_pred.group_by('cookie').head(k).with_columns(value=1)[['node', 'cookie', 'value']],
-            how='left',
-            on=['cookie', 'node']
-        ).select([
-            pl.col('value').fill_null(0), 'cookie'
-        ]).group_by('cookie').agg([
-            pl.col('value').sum() / pl.col('value').count()
-        ])['value'].mean()
-        
-        # Precision@K
-        precision_at_k = df_true[['node', 'cookie']].join(
-            df_pred.group_by('cookie').head(k).with_columns(value=1)[['node', 'cookie', 'value']],
-            how='left',
-            on=['cookie', 'node']
-        ).select([
-            pl.col('value').fill_null(0), 'cookie'
-        ]).group_by('cookie').agg([
-            pl.col('value').sum() / k
-        ])['value'].mean()
-        
-        # F1@K
-        f1_at_k = 2 * (precision_at_k * recall_at_k) / (precision_at_k + recall_at_k)
+    def train_als_sweep(self, job_id: int, session: Session, data_path: str, processed_data: Dict[str, Any],
+                        hyperparams: Optional[Dict] = None, eval_days: int = 14, cpus: Optional[int] = None,
+                        check_cancelled: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+        """Fit a grid or random search over ALS parameters on one loaded split.
+
+        The configurations run in a process pool that maps the split from the
+        split cache (a temporary one when the cache is disabled). Metrics of
+        every finished configuration are written to the job as they arrive and
+        only the artifact of the best configuration is kept. The pool shares
+        cpus CPUs (all of them by default), and check_cancelled runs after
+        every configuration.
+        """
+        hyperparams = hyperparams or {}
+        configs = expand_space(hyperparams.get('space'), hyperparams.get('search', 'grid'),
+                               int(hyperparams.get('n_trials', 10)), hyperparams.get('seed'))
+        if not configs:
+            raise ValueError("The sweep search space is empty")
+        metric = hyperparams.get('metric', 'recall_at_40')
+        if metric not in {f'{name}_at_{k}' for name in METRIC_NAMES for k in self.metric_ks}:
+            raise ValueError(f"Unknown sweep metric: {metric}")
+        processes = max(1, min(int(hyperparams.get('processes') or self.sweep_processes), len(configs)))
+        
+        cache = self.split_cache
+        if cache is None:
+            cache = SplitCache(tempfile.mkdtemp(prefix='.sweep_split_', dir=self.models_dir), max_bytes=2 ** 62)
+        fingerprint = dataset_fingerprint(data_path, eval_days, TRAIN_COLUMNS)
+        cache.put(fingerprint, data_path, processed_data['train'], processed_data['eval'], processed_data['encoding'])
         
+        def on_trial(trials, best_index):
+            best = trials[best_index]['metrics'] if best_index is not None else {}
+            self.update_training_job(job_id, "training", session,
+                                     {**best, 'metric': metric, 'best_index': best_index, 'trials': trials})
+            if check_cancelled is not None:
+                check_cancelled()
+        
+        try:
+            sweep = run_sweep(cache.root, fingerprint, configs, processes,
+                              f"{self.models_dir}/.als_sweep_{job_id}", metric, on_trial, cpus)
+        finally:
+            if cache is not self.split_cache:
+                shutil.rmtree(cache.root, ignore_errors=True)
+        
+        best = sweep['trials'][sweep['best_index']]
+        model_path = self.model_path(f"als_sweep_{job_id}")
+        os.replace(sweep['best_artifact'], model_path)
+        metrics = {**best['metrics'], 'metric': metric, 'best_index': sweep['best_index'],
+                   'best_config': best['config'], 'trials': sweep['trials']}
         return {
-            'recall_at_k': float(recall_at_k),
-            'precision_at_k': float(precision_at_k),
-            'f1_at_k': float(f1_at_k)
+            'metrics': metrics,
+            'model_path': model_path
         }
     
-    def save_model(self, model_data: Dict[str, Any], model_name: str) -> str:
-        """Save trained model to disk"""
+    def load_base_model(self, base_job_id: Optional[int], session: Session) -> Dict[str, Any]:
+        """Model data of the completed factor model job an incremental job starts from"""
+        base_job = self.get_training_job(base_job_id, session) if base_job_id is not None else None
+        if base_job is None or base_job.status != "completed" or not base_job.model_path:
+            raise ValueError(f"Base job {base_job_id} is not a completed training job")
+        if base_job.model_type not in FACTOR_MODEL_TYPES:
+            raise ValueError(f"Base job {base_job_id} is a {base_job.model_type} model, not an ALS model")
+        if not is_artifact(base_job.model_path):
+            raise ValueError(f"Base job {base_job_id} was saved as a pickle; retrain it to warm-start from it")
+        return load_artifact(base_job.model_path)
+    
+    def materialize_recommendations(self, job_id: int, model_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Top-K of every training user from the ALS factors, published as the active set of the job"""
+        user_factors, item_factors = als_factors(model_data)
+        version = f"job{job_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        return materialize_top_k(
+            self.recommendations_dir, job_set_name(job_id), version,
+            user_factors, item_factors, model_data['user_ids'], model_data['item_ids'],
+            seen=model_data['sparse_matrix'], k=self.materialize_k, memory_mb=self.materialize_memory_mb,
+            extra={'job_id': job_id}
+        )
+    
+    def checkpoint_path(self, job_id: int) -> str:
+        return f"{self.models_dir}/{CHECKPOINT_DIR}/job_{job_id}"
+    
+    def model_path(self, model_name: str) -> str:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        model_path = f"{self.models_dir}/{model_name}_{timestamp}.pkl"
-        
-        joblib.dump(model_data, model_path)
-        return model_path
+        return f"{self.models_dir}/{model_name}_{timestamp}"
+    
+    def save_model(self, model_data: Dict[str, Any], model_name: str, model_type: str) -> str:
+        """Save trained model to disk as a memory-mappable artifact directory"""
+        return save_artifact(self.model_path(model_name), model_data, model_type)
     
     def train_model(self, job_id: int, session: Session, 
                    model_type: str, data_path: str, 
-                   hyperparams: Optional[Dict] = None) -> Dict[str, Any]:
-        """Main training function"""
+                   hyperparams: Optional[Dict] = None, threads: int = 0,
+                   should_stop: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+        """Main training function.
+
+        threads caps the ALS and ranker threads (0 keeps their defaults).
+        should_stop is polled between phases and ALS iterations; the job then
+        ends cancelled with TrainingCancelled.
+
+        Every completed phase is recorded as the job's last_phase, with the
+        split and the ALS factors checkpointed along the way. A job that is
+        run again after its worker died restores the split from the
+        checkpoint (or the split cache), continues ALS from the latest saved
+        factors and skips the phases that saved their results to the job.
+        The checkpoint is removed once the job ends.
+        """
+        job = self.get_training_job(job_id, session)
+        resume_phase = job.last_phase if job else None
+        checkpoint = Checkpoint(self.checkpoint_path(job_id), self.checkpoint_iterations)
+        telemetry = Telemetry(on_update=lambda snapshot: self.update_training_telemetry(job_id, snapshot, session),
+                              should_stop=should_stop,
+                              on_phase=lambda phase: self.update_last_phase(job_id, phase, session))
+        if resume_phase:
+            print(f"Resuming training job {job_id} after {resume_phase}")
+            if job.telemetry:
+                telemetry.restore(json.loads(job.telemetry))
+            telemetry.record(resumed_after=resume_phase)
+        
+        def done(phase: str) -> bool:
+            return resume_phase is not None and PHASES.index(resume_phase) >= PHASES.index(phase)
+        
         try:
             # Update job status
             self.update_training_job(job_id, "loading_data", session)
             
-            # Load data
-            data = self.load_data(data_path)
-            
             # Update job status
             self.update_training_job(job_id, "preprocessing", session)
             
-            # Preprocess data
-            processed_data = self.preprocess_data(data)
-            
-            # Update job status
-            self.update_training_job(job_id, "training", session)
-            
-            # Train model based on type
-            if model_type == "popular":
-                metrics = self.train_popular_model(processed_data['train'], processed_data['eval'])
-                model_path = None  # Popular model doesn't need saving
-            elif model_type == "als":
-                hyperparams = hyperparams or {}
-                result = self.train_als_model(
-                    processed_data['train'], 
-                    processed_data['eval'],
-                    iterations=hyperparams.get('iterations', 10),
-                    factors=hyperparams.get('factors', 60)
+            # Load and preprocess data, or take the split from the cache
+            with telemetry.phase("preprocessing"):
+                processed_data = self.load_split(
+                    data_path, train_columns=TWO_STAGE_COLUMNS if model_type == "two_stage" else TRAIN_COLUMNS,
+                    checkpoint=checkpoint
                 )
-                metrics = result['metrics']
-                model_path = self.save_model(result['model_data'], f"als_model_{job_id}")
+                matrix = processed_data['encoding'].matrix
+                telemetry.record(input_rows=self.input_rows(data_path),
+                                 train_rows=processed_data['train'].height,
+                                 eval_rows=processed_data['eval'].height,
+                                 matrix_shape=list(matrix.shape), matrix_nnz=int(matrix.nnz))
+            
+            model_data = None
+            if done("saving"):
+                metrics, model_path = json.loads(job.metrics), job.model_path
             else:
-                raise ValueError(f"Unknown model type: {model_type}")
+                # Update job status
+                self.update_training_job(job_id, "training", session)
+                
+                # Train model based on type
+                with telemetry.phase("training"):
+                    if model_type == "popular":
+                        hyperparams = hyperparams or {}
+                        segment = hyperparams.get('segment')
+                        result = self.train_popular_model(
+                            processed_data['train'],
+                            processed_data['eval'],
+                            half_life_days=hyperparams.get('half_life_days'),
+                            segment=segment,
+                            cat_features=pl.scan_parquet(f'{data_path}/cat_features.pq') if segment else None
+                        )
+                        metrics, model_data = result['metrics'], result['model_data']
+                    elif model_type == "als":
+                        hyperparams = hyperparams or {}
+                        result = self.train_als_model(
+                            processed_data['train'], 
+                            processed_data['eval'],
+                            iterations=hyperparams.get('iterations', 10),
+                            factors=hyperparams.get('factors', 60),
+                            num_threads=threads,
+                            encoding=processed_data['encoding'],
+                            callback=telemetry.als_callback(),
+                            checkpoint=checkpoint
+                        )
+                        metrics, model_data = result['metrics'], result['model_data']
+                    elif model_type == "two_stage":
+                        result = self.train_two_stage_model(
+                            processed_data['train'],
+                            processed_data['eval'],
+                            data_path,
+                            {**(hyperparams or {}), 'threads': threads} if threads else hyperparams,
+                            encoding=processed_data['encoding'],
+                            callback=telemetry.als_callback()
+                        )
+                        metrics, model_data = result['metrics'], result['model_data']
+                    elif model_type == "als_incremental":
+                        hyperparams = hyperparams or {}
+                        result = self.train_als_incremental(
+                            processed_data['train'],
+                            processed_data['eval'],
+                            self.load_base_model(hyperparams.get('base_job_id'), session),
+                            iterations=hyperparams.get('iterations', 2),
+                            num_threads=threads,
+                            callback=telemetry.als_callback()
+                        )
+                        result['metrics']['base_job_id'] = hyperparams['base_job_id']
+                        metrics, model_data = result['metrics'], result['model_data']
+                    elif model_type == "als_sweep":
+                        result = self.train_als_sweep(job_id, session, data_path, processed_data, hyperparams,
+                                                      cpus=threads or None, check_cancelled=telemetry.check_cancelled)
+                        metrics = result['metrics']
+                        model_path = result['model_path']
+                    else:
+                        raise ValueError(f"Unknown model type: {model_type}")
+                
+                # The metrics and model path go to the job before saving counts as done
+                with telemetry.phase("saving"):
+                    if model_data is not None:
+                        model_name = "als_model" if model_type == "als" else f"{model_type}_model"
+                        model_path = self.save_model(model_data, f"{model_name}_{job_id}", model_type)
+                    self.update_training_job(job_id, "training", session, metrics, model_path)
+            
+            if model_type in FACTOR_MODEL_TYPES and model_data is None:
+                model_data = load_artifact(model_path)
+            
+            # Index the item factors for approximate top-K and similar-node serving
+            if self.ann_index and model_type in FACTOR_MODEL_TYPES and not done("indexing"):
+                with telemetry.phase("indexing"):
+                    user_factors, item_factors = als_factors(model_data)
+                    metrics['ann'] = build_ann_index(model_path, user_factors, item_factors,
+                                                     target=self.ann_recall_target)
+                    self.update_training_job(job_id, "training", session, metrics)
+            
+            # Precompute the recommendations of factor models for lookup serving
+            if self.recommendations_dir and model_type in FACTOR_MODEL_TYPES and not done("materializing"):
+                self.update_training_job(job_id, "materializing", session)
+                with telemetry.phase("materializing"):
+                    metrics['recommendations'] = self.materialize_recommendations(job_id, model_data)
+                    self.update_training_job(job_id, "materializing", session, metrics)
             
             # Update job status
-            self.update_training_job(job_id, "completed", session, metrics, model_path)
+            self.update_training_job(job_id, "completed", session, metrics, model_path, telemetry.snapshot())
+            checkpoint.clear()
             
             return {
                 'status': 'success',
                 'metrics': metrics,
-                'model_path': model_path
+                'model_path': model_path,
+                'telemetry': telemetry.snapshot()
             }
             
+        except TrainingCancelled:
+            checkpoint.clear()
+            self.update_training_job(job_id, "cancelled", session, telemetry=telemetry.snapshot())
+            raise
         except Exception as e:
-            self.update_training_job(job_id, "failed", session)
+            checkpoint.clear()
+            self.update_training_job(job_id, "failed", session, telemetry=telemetry.snapshot())
             raise Exception(f"Training failed: {e}") 
\ No newline at end of file
@@ -1,5 +1,9 @@
 from models.all_models import Transaction, User
 from typing import List, Optional
+from sqlmodel import select
+from sqlalchemy import case, func
+from services.crud.pagination import filter_dates, keyset_page, page_response
+import datetime
 
 
 def get_all_transactions(session) -> List[Transaction]:
@@ -50,3 +54,29 @@ def withdraw_balance(user: User, amount: float, session):
 def get_transaction_history(user: User, session):
     transactions = session.query(Transaction).filter(Transaction.user_id == user.id).all()
     return [{"transaction_type": t.transaction_type, "amount": t.amount, "timestamp": t.created_at} for t in transactions]
+
+
+async def create_transaction_async(new_transaction: Transaction, session) -> None:
+    session.add(new_transaction)
+    await session.commit()
+    await session.refresh(new_transaction)
+
+async def get_transaction_history_page_async(user: User, session, limit: Optional[int] = None, cursor: Optional[str] = None,
+                                            date_from: Optional[datetime.date] = None, date_to: Optional[datetime.date] = None) -> dict:
+    statement = filter_dates(select(Transaction).where(Transaction.user_id == user.id), Transaction.created_at, date_from, date_to)
+    transactions, next_cursor = await keyset_page(session, statement, Transaction.created_at, Transaction.id, limit, cursor)
+
+    summary = filter_dates(
+        select(
+            Transaction.transaction_type,
+            func.count(),
+            func.coalesce(func.sum(case((Transaction.transaction_status == 'success', Transaction.amount), else_=0)), 0)
+        ).where(Transaction.user_id == user.id).group_by(Transaction.transaction_type),
+        Transaction.created_at, date_from, date_to
+    )
+    totals = {t_type: {"count": count, "amount": amount} for t_type, count, amount in (await session.exec(summary)).all()}
+    return page_response(
+        [{"transaction_type": t.transaction_type, "amount": t.amount, "timestamp": t.created_at} for t in transactions],
+        next_cursor,
+        totals
+    )
@@ -1,4 +1,5 @@
 from models.all_models import User
+from sqlmodel import select
 from typing import List, Optional
 import bcrypt
 
@@ -32,4 +33,17 @@ def hash_password(password: str) -> str:
 def create_user(new_user: User, session) -> None:
     session.add(new_user) 
     session.commit() 
-    session.refresh(new_user)
\ No newline at end of file
+    session.refresh(new_user)
+
+
+async def get_user_by_id_async(id: int, session) -> Optional[User]:
+    return await session.get(User, id)
+
+async def get_user_by_email_async(email: str, session) -> Optional[User]:
+    result = await session.exec(select(User).where(User.email == email))
+    return result.first()
+
+async def create_user_async(new_user: User, session) -> None:
+    session.add(new_user)
+    await session.commit()
+    await session.refresh(new_user)
@@ -0,0 +1,301 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional
+
+import pika
+
+
+RECONNECT_DELAY = 2.0
+
+
+def get_connection_params(host: str = "rabbitmq") -> pika.ConnectionParameters:
+    """Connection parameters shared by the API publisher and the workers"""
+    return pika.ConnectionParameters(
+        host=host,
+        port=5672,
+        virtual_host='/',
+        credentials=pika.PlainCredentials(
+            username='rmuser',
+            password='rmpassword'
+        ),
+        heartbeat=30,
+        blocked_connection_timeout=2
+    )
+
+
+class PublishError(Exception):
+    pass
+
+
+class _Message:
+    __slots__ = ("queue_name", "body", "properties", "future", "created_at")
+
+    def __init__(self, queue_name: str, body: bytes, properties: pika.BasicProperties):
+        self.queue_name = queue_name
+        self.body = body
+        self.properties = properties
+        self.future: Future = Future()
+        self.created_at = time.perf_counter()
+
+
+class _PooledChannel:
+    def __init__(self, channel):
+        self.channel = channel
+        self.declared = set()
+        self.next_tag = 1
+        self.unconfirmed: Dict[int, _Message] = {}
+
+
+class QueuePublisher:
+    """Long-lived RabbitMQ publisher shared by the whole API process.
+
+    A single IO thread owns one connection with a small pool of channels in
+    confirm mode. Messages are handed over to the IO thread, published without
+    waiting and resolved when the broker acks them, so a batch of messages
+    costs one round trip instead of one connection per message. When the
+    connection drops, unconfirmed messages are republished after reconnect.
+    """
+
+    def __init__(self, params: pika.ConnectionParameters, pool_size: int = 4,
+                 confirm_timeout: float = 5.0, stats_window: int = 1000):
+        self.params = params
+        self.pool_size = pool_size
+        self.confirm_timeout = confirm_timeout
+
+        self._lock = threading.Lock()
+        self._backlog: deque = deque()
+        self._channels: List[_PooledChannel] = []
+        self._next_channel = 0
+        self._connection = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+        self._latencies_ms: deque = deque(maxlen=stats_window)
+        self._counters = {"published": 0, "confirmed": 0, "nacked": 0, "timeouts": 0, "reconnects": 0}
+
+    # Public API
+
+    def publish(self, queue_name: str, message: Dict[str, Any],
+                properties: Optional[pika.BasicProperties] = None) -> None:
+        self.publish_many(queue_name, [message], properties)
+
+    def publish_many(self, queue_name: str, messages: List[Dict[str, Any]],
+                     properties: Optional[pika.BasicProperties] = None) -> None:
+        """Publish messages and block until the broker confirms all of them.
+
+        On a timeout or a rejected message the messages still waiting are
+        cancelled, so they are not sent after a reconnect. A message that
+        already reached the broker unconfirmed may still be delivered, so
+        consumers must tolerate that.
+        """
+        futures = self._submit(queue_name, messages, properties)
+        deadline = time.monotonic() + self.confirm_timeout
+        try:
+            for future in futures:
+                future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            self._timed_out(queue_name, futures)
+        except PublishError:
+            self._cancel(futures)
+            raise
+
+    async def publish_async(self, queue_name: str, message: Dict[str, Any],
+                            properties: Optional[pika.BasicProperties] = None) -> None:
+        await self.publish_many_async(queue_name, [message], properties)
+
+    async def publish_many_async(self, queue_name: str, messages: List[Dict[str, Any]],
+                                 properties: Optional[pika.BasicProperties] = None) -> None:
+        """Same as publish_many, but waits for confirms without blocking the event loop"""
+        futures = self._submit(queue_name, messages, properties)
+        try:
+            await asyncio.wait_for(asyncio.gather(*[asyncio.wrap_future(f) for f in futures]),
+                                   timeout=self.confirm_timeout)
+        except asyncio.TimeoutError:
+            self._timed_out(queue_name, futures)
+        except PublishError:
+            self._cancel(futures)
+            raise
+
+    @staticmethod
+    def _cancel(futures: List[Future]) -> None:
+        """Withdraw the messages not confirmed yet; _drain_backlog skips them"""
+        for future in futures:
+            future.cancel()
+
+    def _timed_out(self, queue_name: str, futures: List[Future]) -> None:
+        """Cancel the unconfirmed messages and raise, unless all of them were confirmed meanwhile"""
+        self._cancel(futures)
+        if all(not future.cancelled() and future.exception() is None for future in futures):
+            return
+        self._count("timeouts")
+        raise PublishError(f"Broker did not confirm {queue_name} messages within {self.confirm_timeout}s")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = sorted(self._latencies_ms)
+            counters = dict(self._counters)
+
+        def percentile(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)], 3)
+
+        return {
+            **counters,
+            "pending": len(self._backlog) + sum(len(c.unconfirmed) for c in self._channels),
+            "open_channels": len(self._channels),
+            "latency_ms": {
+                "samples": len(latencies),
+                "mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+                "p50": percentile(0.50),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": round(latencies[-1], 3) if latencies else None,
+            },
+        }
+
+    def close(self) -> None:
+        self._stopping = True
+        connection = self._connection
+        if connection is not None:
+            connection.ioloop.add_callback_threadsafe(self._close_connection)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _count(self, name: str) -> None:
+        # Counters are updated from the caller and the IO threads
+        with self._lock:
+            self._counters[name] += 1
+
+    # Caller side
+
+    def _submit(self, queue_name: str, messages: List[Dict[str, Any]],
+                properties: Optional[pika.BasicProperties]) -> List[Future]:
+        properties = properties or pika.BasicProperties(delivery_mode=2)
+        batch = [_Message(queue_name, json.dumps(m).encode(), properties) for m in messages]
+        with self._lock:
+            self._backlog.extend(batch)
+            self._ensure_started()
+            connection = self._connection
+        if connection is not None and self._channels:
+            connection.ioloop.add_callback_threadsafe(self._drain_backlog)
+        return [m.future for m in batch]
+
+    def _ensure_started(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="queue-publisher", daemon=True)
+            self._thread.start()
+
+    # IO thread
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self._connection = pika.SelectConnection(
+                self.params,
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_lost,
+                on_close_callback=self._on_connection_lost,
+            )
+            self._connection.ioloop.start()
+            self._connection = None
+            if not self._stopping:
+                self._count("reconnects")
+                time.sleep(RECONNECT_DELAY)
+
+    def _on_connection_open(self, connection) -> None:
+        for _ in range(self.pool_size):
+            connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel) -> None:
+        pooled = _PooledChannel(channel)
+        channel.confirm_delivery(ack_nack_callback=lambda frame: self._on_confirm(pooled, frame))
+        channel.add_on_close_callback(lambda ch, reason: self._on_channel_closed(pooled))
+        self._channels.append(pooled)
+        self._drain_backlog()
+
+    def _on_channel_closed(self, pooled: _PooledChannel) -> None:
+        if pooled in self._channels:
+            self._channels.remove(pooled)
+        self._requeue(pooled)
+        connection = self._connection
+        if connection is not None and connection.is_open and not self._stopping:
+            connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_lost(self, connection, reason) -> None:
+        if not self._stopping:
+            print(f"RabbitMQ publisher connection lost: {reason}")
+        for pooled in self._channels:
+            self._requeue(pooled)
+        self._channels = []
+        connection.ioloop.stop()
+
+    def _requeue(self, pooled: _PooledChannel) -> None:
+        """Unconfirmed messages go back to the head of the backlog to be republished"""
+        with self._lock:
+            self._backlog.extendleft(reversed(list(pooled.unconfirmed.values())))
+        pooled.unconfirmed.clear()
+
+    def _close_connection(self) -> None:
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    def _drain_backlog(self) -> None:
+        while self._channels:
+            with self._lock:
+                if not self._backlog:
+                    return
+                message = self._backlog.popleft()
+            if message.future.done():
+                # Confirmed, rejected or cancelled by a caller that gave up on it
+                continue
+            pooled = self._channels[self._next_channel % len(self._channels)]
+            self._next_channel += 1
+
+            if message.queue_name not in pooled.declared:
+                # Frames on a channel are processed in order, so the declare
+                # is guaranteed to complete before the publish below
+                pooled.channel.queue_declare(queue=message.queue_name, durable=True)
+                pooled.declared.add(message.queue_name)
+
+            pooled.channel.basic_publish(
+                exchange='',
+                routing_key=message.queue_name,
+                body=message.body,
+                properties=message.properties
+            )
+            pooled.unconfirmed[pooled.next_tag] = message
+            pooled.next_tag += 1
+            self._count("published")
+
+    def _on_confirm(self, pooled: _PooledChannel, frame) -> None:
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            tags = [tag for tag in pooled.unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        now = time.perf_counter()
+        for tag in tags:
+            message = pooled.unconfirmed.pop(tag, None)
+            if message is None:
+                continue
+            try:
+                if acked:
+                    message.future.set_result(None)
+                else:
+                    message.future.set_exception(PublishError(f"Broker rejected message for {message.queue_name}"))
+            except InvalidStateError:
+                # The caller cancelled it after a timeout
+                continue
+            if acked:
+                with self._lock:
+                    self._counters["confirmed"] += 1
+                    self._latencies_ms.append((now - message.created_at) * 1000)
+            else:
+                self._count("nacked")
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import pika
+
+from services.queue.publisher import QueuePublisher, RECONNECT_DELAY
+
+
+class ReplyConsumer:
+    """Request-reply over the existing task queues.
+
+    The API process owns one exclusive, server-named reply queue consumed by a
+    background thread. A request is published with reply_to/correlation_id and
+    the caller awaits an asyncio future that the consumer thread resolves when
+    the worker's reply arrives. If the reply queue is not available or the
+    deadline passes, request() returns None and the caller falls back to the
+    asynchronous request_id flow.
+    """
+
+    def __init__(self, params: pika.ConnectionParameters):
+        self.params = params
+        self.queue_name: Optional[str] = None
+        self._waiters: Dict[str, Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+        self._lock = threading.Lock()
+        self._connection = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="reply-consumer", daemon=True)
+            self._thread.start()
+
+    def close(self) -> None:
+        self._stopping = True
+        connection = self._connection
+        if connection is not None:
+            try:
+                connection.add_callback_threadsafe(connection.close)
+            except Exception:
+                pass
+
+    async def request(self, publisher: QueuePublisher, queue_name: str, message: Dict[str, Any],
+                      correlation_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Publish message and wait up to timeout seconds for the reply"""
+        reply_to = self.queue_name
+        if reply_to is None:
+            await publisher.publish_async(queue_name, message)
+            return None
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            self._waiters[correlation_id] = (loop, future)
+        try:
+            properties = pika.BasicProperties(delivery_mode=2, reply_to=reply_to, correlation_id=correlation_id)
+            await publisher.publish_async(queue_name, message, properties)
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self._lock:
+                self._waiters.pop(correlation_id, None)
+
+    def _run(self) -> None:
+        while not self._stopping:
+            try:
+                self._connection = pika.BlockingConnection(self.params)
+                channel = self._connection.channel()
+                result = channel.queue_declare(queue='', exclusive=True, auto_delete=True)
+                channel.basic_consume(queue=result.method.queue, on_message_callback=self._on_reply, auto_ack=True)
+                self.queue_name = result.method.queue
+                print(f"Reply consumer listening on {self.queue_name}")
+                channel.start_consuming()
+            except Exception as e:
+                if not self._stopping:
+                    print(f"Reply consumer connection lost: {e}")
+            finally:
+                self.queue_name = None
+                self._connection = None
+            if not self._stopping:
+                time.sleep(RECONNECT_DELAY)
+
+    def _on_reply(self, ch, method, properties, body) -> None:
+        with self._lock:
+            waiter = self._waiters.pop(properties.correlation_id, None)
+        if waiter is None:
+            # The caller already gave up and will find the result through request_id
+            return
+        loop, future = waiter
+        loop.call_soon_threadsafe(self._resolve, future, json.loads(body))
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, reply: Dict[str, Any]) -> None:
+        if not future.done():
+            future.set_result(reply)
+
+
+def send_reply(channel, properties, reply: Dict[str, Any]) -> None:
+    """Worker side: answer a request published with reply_to"""
+    if not properties or not properties.reply_to:
+        return
+    channel.basic_publish(
+        exchange='',
+        routing_key=properties.reply_to,
+        body=json.dumps(reply),
+        properties=pika.BasicProperties(correlation_id=properties.correlation_id)
+    )
@@ -0,0 +1,124 @@
+import datetime
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+
+
+class _Snapshot:
+    def __init__(self, table: pa.Table, index: Dict[int, int], version: str):
+        self.table = table
+        self.index = index
+        self.version = version
+
+
+class FeatureSnapshot:
+    """Local, memory-mapped copy of the user feature table.
+
+    The table is exported from the database into an Arrow IPC file, which is
+    memory-mapped so that every worker process on the host reads the same
+    pages from the page cache without copying them. Lookups go through a
+    user_id -> row index built once per snapshot. A refresh writes a new file
+    next to the old one and renames it into place, then the in-memory
+    snapshot is swapped with a single attribute assignment, so readers always
+    see either the old or the new version.
+    """
+
+    def __init__(self, path: str, source_engine, table: str = "public.mfdp_user_features",
+                 key: str = "user_id", refresh_interval: int = 3600, chunk_size: int = 100_000):
+        self.path = path
+        self.source_engine = source_engine
+        self.source_table = table
+        self.key = key
+        self.refresh_interval = refresh_interval
+        self.chunk_size = chunk_size
+        self._snapshot: Optional[_Snapshot] = None
+        self._refresh_thread: Optional[threading.Thread] = None
+
+    @property
+    def version(self) -> Optional[str]:
+        snapshot = self._snapshot
+        return snapshot.version if snapshot else None
+
+    def is_stale(self) -> bool:
+        if not os.path.exists(self.path):
+            return True
+        return time.time() - os.path.getmtime(self.path) > self.refresh_interval
+
+    def export(self) -> None:
+        """Stream the source table into a new Arrow file and atomically replace the old one"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        # Unique per writer: replicas sharing the volume all run as PID 1
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(self.path)}.", suffix=".tmp", dir=directory)
+        os.close(fd)
+        version = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+        writer = None
+        schema = None
+        try:
+            for chunk in pd.read_sql(f"SELECT * FROM {self.source_table}", con=self.source_engine,
+                                     chunksize=self.chunk_size):
+                batch = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+                if writer is None:
+                    schema = batch.schema.with_metadata({"version": version})
+                    batch = batch.replace_schema_metadata(schema.metadata)
+                    writer = pa.ipc.new_file(tmp_path, schema)
+                writer.write_table(batch)
+            if writer is None:
+                raise ValueError(f"{self.source_table} is empty, keeping the previous snapshot")
+            writer.close()
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load(self) -> None:
+        """Memory-map the snapshot file and swap it in"""
+        source = pa.memory_map(self.path, 'r')
+        table = pa.ipc.open_file(source).read_all()
+        keys = table.column(self.key).to_numpy()
+        index = dict(zip(keys.tolist(), range(len(keys))))
+        metadata = table.schema.metadata or {}
+        version = metadata.get(b"version", b"unknown").decode()
+        self._snapshot = _Snapshot(table, index, version)
+        print(f"Feature snapshot {version} loaded: {table.num_rows} rows")
+
+    def refresh(self) -> None:
+        if self.is_stale():
+            self.export()
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != self._file_version():
+            self.load()
+
+    def start_background_refresh(self) -> None:
+        if self._refresh_thread is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(self.refresh_interval)
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Feature snapshot refresh failed: {e}")
+
+        self._refresh_thread = threading.Thread(target=loop, name="feature-snapshot-refresh", daemon=True)
+        self._refresh_thread.start()
+
+    def get(self, user_ids: List[int]) -> Tuple[pd.DataFrame, Optional[str]]:
+        """Rows for the known user_ids (unknown ones are skipped) and the snapshot version"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            raise RuntimeError("Feature snapshot is not loaded")
+        rows = [snapshot.index[u] for u in dict.fromkeys(user_ids) if u in snapshot.index]
+        return snapshot.table.take(rows).to_pandas(), snapshot.version
+
+    def _file_version(self) -> Optional[str]:
+        with pa.memory_map(self.path, 'r') as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+        return metadata.get(b"version", b"").decode() or None
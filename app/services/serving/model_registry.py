@@ -0,0 +1,129 @@
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, Hashable, Iterable, Optional
+
+import joblib
+
+from database.config import get_settings
+from services.crud import ml as MlService
+from services.training.artifact import MANIFEST_FILE, artifact_bytes, file_digest, is_artifact, load_artifact
+
+
+class _Entry:
+    def __init__(self, model: Any, path: str, stat: os.stat_result, digest: str, size: int):
+        self.model = model
+        self.path = path
+        self.mtime_ns = stat.st_mtime_ns
+        self.stat_size = stat.st_size
+        self.size = size
+        self.digest = digest
+
+
+class ModelRegistry:
+    """Process-wide LRU cache of deserialized models keyed by MLModel.model_id.
+
+    A cached model is returned as long as its artifact is unchanged: the cheap
+    mtime/size check runs on every lookup, and only when it differs is the
+    file hashed to decide whether the model has to be reloaded. Memory is
+    accounted by artifact size and the least recently used models are evicted
+    once the budget is exceeded. Artifact directories written by
+    save_artifact are watched through their manifest, which holds the
+    checksums of every part, and are always memory-mapped. Pickles above
+    mmap_threshold are loaded with joblib's mmap mode, so their numpy
+    payloads stay in the page cache.
+    """
+
+    def __init__(self, max_bytes: int, mmap_threshold: int = 64 << 20):
+        self.max_bytes = max_bytes
+        self.mmap_threshold = mmap_threshold
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._paths: Dict[int, str] = {}
+        self._lock = threading.RLock()
+        self._stats = {"hits": 0, "loads": 0, "reloads": 0, "evictions": 0}
+
+    def resolve(self, model_id: int, session) -> str:
+        """Artifact path of a registered model"""
+        path = self._paths.get(model_id)
+        if path is None:
+            model = MlService.get_model_by_id(model_id, session)
+            if model is None:
+                raise KeyError(f"Model {model_id} is not registered")
+            path = self._paths[model_id] = model.model_path
+        return path
+
+    def get(self, model_id: Optional[int], model_path: Optional[str] = None, session=None) -> Any:
+        """Loaded model for model_id; unregistered models are keyed by their path"""
+        if model_path is None:
+            model_path = self.resolve(model_id, session)
+        key = model_id if model_id is not None else model_path
+
+        watched = os.path.join(model_path, MANIFEST_FILE) if is_artifact(model_path) else model_path
+        with self._lock:
+            stat = os.stat(watched)
+            entry = self._entries.get(key)
+            if entry is not None and entry.path == model_path:
+                if (entry.mtime_ns, entry.stat_size) != (stat.st_mtime_ns, stat.st_size):
+                    digest = file_digest(watched)
+                    if digest != entry.digest:
+                        self._stats["reloads"] += 1
+                        return self._load(key, model_path, stat, digest)
+                    entry.mtime_ns, entry.stat_size = stat.st_mtime_ns, stat.st_size
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry.model
+            return self._load(key, model_path, stat, file_digest(watched))
+
+    def preload(self, model_ids: Iterable[int], session) -> None:
+        for model_id in model_ids:
+            try:
+                self.get(model_id, session=session)
+                print(f"Model {model_id} preloaded")
+            except Exception as e:
+                print(f"Could not preload model {model_id}: {e}")
+
+    def invalidate(self, model_id: Optional[int] = None) -> None:
+        with self._lock:
+            if model_id is None:
+                self._entries.clear()
+                self._paths.clear()
+            else:
+                self._entries.pop(model_id, None)
+                self._paths.pop(model_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._stats,
+                "models": list(self._entries.keys()),
+                "used_bytes": self._used_bytes(),
+                "max_bytes": self.max_bytes,
+            }
+
+    def _load(self, key: Hashable, path: str, stat: os.stat_result, digest: str) -> Any:
+        self._entries.pop(key, None)
+        if is_artifact(path):
+            model, size = load_artifact(path), artifact_bytes(path)
+        else:
+            mmap_mode = 'r' if stat.st_size >= self.mmap_threshold else None
+            model, size = joblib.load(path, mmap_mode=mmap_mode), stat.st_size
+        self._entries[key] = _Entry(model, path, stat, digest, size)
+        self._stats["loads"] += 1
+        self._evict()
+        return model
+
+    def _evict(self) -> None:
+        # The most recently loaded model is always kept, even if it alone exceeds the budget
+        while len(self._entries) > 1 and self._used_bytes() > self.max_bytes:
+            key, _ = self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+            print(f"Model {key} evicted from registry")
+
+    def _used_bytes(self) -> int:
+        return sum(entry.size for entry in self._entries.values())
+
+
+@lru_cache()
+def get_model_registry() -> ModelRegistry:
+    return ModelRegistry(max_bytes=get_settings().MODEL_CACHE_MAX_MB << 20)
@@ -0,0 +1,87 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from services.training.materialize import MANIFEST_FILE, active_version, partition_of
+
+
+class _Partition:
+    def __init__(self, path: str):
+        table = pq.read_table(path, memory_map=True)
+        self.users = table.column('user_id').to_numpy()
+        self.items = table.column('item_id').to_numpy()
+        self.scores = table.column('score').to_numpy()
+        # Number of rows of the user starting at each row, read at its first row
+        starts = np.flatnonzero(np.r_[True, self.users[1:] != self.users[:-1]])
+        self.lengths = np.zeros(len(self.users), dtype=np.int64)
+        self.lengths[starts] = np.diff(np.r_[starts, len(self.users)])
+
+
+class _ActiveSet:
+    def __init__(self, path: str, version: str):
+        self.path = path
+        self.version = version
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        self.partitions: Dict[int, Optional[_Partition]] = {}
+
+
+class RecommendationStore:
+    """Reads the precomputed top-k sets written by materialize_top_k.
+
+    Lookups binary-search the user's rows in the partition file of its hash,
+    which is loaded once per version and kept in memory. The ACTIVE pointer
+    of a model is re-read at most every check_interval seconds, so a new set
+    is picked up shortly after the training job flips it.
+    """
+
+    def __init__(self, root: str, check_interval: float = 5.0):
+        self.root = root
+        self.check_interval = check_interval
+        self._sets: Dict[str, Tuple[float, Optional[_ActiveSet]]] = {}
+        self._lock = threading.Lock()
+
+    def _active(self, model_name: str) -> Optional[_ActiveSet]:
+        now = time.monotonic()
+        checked_at, current = self._sets.get(model_name, (0.0, None))
+        if now - checked_at < self.check_interval and model_name in self._sets:
+            return current
+        with self._lock:
+            version = active_version(self.root, model_name)
+            if version is None:
+                current = None
+            elif current is None or current.version != version:
+                current = _ActiveSet(os.path.join(self.root, model_name, version), version)
+            self._sets[model_name] = (now, current)
+        return current
+
+    def version(self, model_name: str) -> Optional[str]:
+        active = self._active(model_name)
+        return active.version if active else None
+
+    def get(self, model_name: str, user_id, k: Optional[int] = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """(item_ids, scores) of the user, best first, or None when the user or the model is unknown
+        or the set holds fewer than k items per user"""
+        active = self._active(model_name)
+        if active is None or (k is not None and k > active.manifest['k']):
+            return None
+        part = partition_of(user_id, active.manifest['partitions'])
+        partition = active.partitions.get(part, False)
+        if partition is False:
+            path = os.path.join(active.path, f'part-{part:04d}.parquet')
+            partition = _Partition(path) if os.path.exists(path) else None
+            active.partitions[part] = partition
+        if partition is None:
+            return None
+        lo = int(partition.users.searchsorted(user_id))
+        if lo == len(partition.users) or partition.users[lo] != user_id:
+            return None
+        hi = lo + partition.lengths[lo]
+        if k is not None:
+            hi = min(hi, lo + k)
+        return partition.items[lo:hi], partition.scores[lo:hi]
@@ -0,0 +1,158 @@
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from services.serving.model_registry import get_model_registry
+from services.training.ann import IVFIndex, load_ann_index
+from services.training.artifact import FACTOR_MODEL_TYPES, als_factors
+from services.training.encoding import InteractionEncoding
+from services.training.materialize import top_k_chunk
+
+# Model types /recommend can serve; only factor models have similar nodes
+SERVING_MODEL_TYPES = FACTOR_MODEL_TYPES + ('popular',)
+
+
+class FactorRecommender:
+    """Scores users against the item factors of a trained ALS model.
+
+    The factors are kept as contiguous float32 matrices, so a call is one
+    BLAS product for all the requested users followed by an argpartition per
+    row. Items the user interacted with in training are taken from the
+    stored CSR matrix and never recommended when filter_seen is set. When
+    the artifact has an ANN index, single users and similar nodes are
+    searched through it instead, unless exact is set.
+    """
+
+    def __init__(self, model_data: Dict[str, Any], index: Optional[IVFIndex] = None):
+        user_factors, item_factors = als_factors(model_data)
+        self.user_factors = np.ascontiguousarray(user_factors, dtype=np.float32)
+        self.item_factors = np.ascontiguousarray(item_factors, dtype=np.float32)
+        self.encoding = InteractionEncoding(np.asarray(model_data['user_ids']), np.asarray(model_data['item_ids']),
+                                            model_data['sparse_matrix'])
+        self.index = index
+        self._normalized_items: Optional[np.ndarray] = None
+
+    def _results(self, n: int, known: np.ndarray, top: np.ndarray,
+                 top_scores: np.ndarray) -> List[Optional[Tuple[np.ndarray, np.ndarray]]]:
+        result: List[Optional[Tuple[np.ndarray, np.ndarray]]] = [None] * n
+        for row, position in enumerate(known):
+            valid = top[row] >= 0
+            result[position] = (self.encoding.item_ids[top[row][valid]], top_scores[row][valid])
+        return result
+
+    def recommend(self, user_ids: Sequence[int], k: int = 40, filter_seen: bool = True,
+                  exact: bool = False) -> List[Optional[Tuple[np.ndarray, np.ndarray]]]:
+        """(item_ids, scores) of every user, best first; None for users unknown to the model.
+
+        Batches go through the brute-force product, which is cheaper than
+        per-query index probes once there are a few users to score.
+        """
+        codes = self.encoding.encode_users(np.asarray(user_ids, dtype=self.encoding.user_ids.dtype))
+        known = np.flatnonzero(codes >= 0)
+        if len(known) == 0:
+            return [None] * len(codes)
+        known_codes = codes[known]
+        seen = self.encoding.matrix[known_codes] if filter_seen else None
+        if self.index is not None and not exact and len(known) == 1:
+            top, top_scores = self.index.search(self.user_factors[known_codes], k, exclude=seen)
+        else:
+            top, top_scores = top_k_chunk(self.user_factors[known_codes], self.item_factors, seen, k)
+        return self._results(len(codes), known, top, top_scores)
+
+    def similar(self, item_ids: Sequence[int], k: int = 20,
+                exact: bool = False) -> List[Optional[Tuple[np.ndarray, np.ndarray]]]:
+        """Most similar items (cosine of the item factors) of every item, the item itself excluded"""
+        codes = self.encoding.encode_items(np.asarray(item_ids, dtype=self.encoding.item_ids.dtype))
+        known = np.flatnonzero(codes >= 0)
+        if len(known) == 0:
+            return [None] * len(codes)
+        known_codes = codes[known]
+        itself = csr_matrix((np.ones(len(known_codes), dtype=np.float32), (np.arange(len(known_codes)), known_codes)),
+                            shape=(len(known_codes), self.item_factors.shape[0]))
+        if self.index is not None and not exact:
+            top, top_scores = self.index.search(self.item_factors[known_codes], k, cosine=True, exclude=itself)
+        else:
+            if self._normalized_items is None:
+                norms = np.linalg.norm(self.item_factors, axis=1, keepdims=True)
+                self._normalized_items = self.item_factors / np.maximum(norms, 1e-12)
+            queries = self._normalized_items[known_codes]
+            top, top_scores = top_k_chunk(queries, self._normalized_items, itself, k)
+        return self._results(len(codes), known, top, top_scores)
+
+
+class PopularRecommender:
+    """Serves the ranked lists of a popular model.
+
+    Every user gets the same precomputed list, or the list of its segment
+    when the model is segmented, so a call costs a lookup per user and does
+    not depend on the catalogue. Users the model has no segment for, which
+    includes users it never saw, get the global list; this makes it the
+    cold-start fallback of the factor models. The model keeps no per-user
+    history, so filter_seen and exact have no effect.
+    """
+
+    def __init__(self, model_data: Dict[str, Any]):
+        self.popular = (np.asarray(model_data['popular_nodes']), np.asarray(model_data['popular_scores']))
+        self.lists: Dict[Any, Tuple[np.ndarray, np.ndarray]] = {}
+        self.user_ids = np.empty(0, dtype=np.int64)
+        self.user_segments: List[Any] = []
+        if 'segment_lists' in model_data:
+            lists = model_data['segment_lists'].sort('segment', 'rank')
+            for (segment,), part in lists.partition_by('segment', as_dict=True).items():
+                if segment is not None:
+                    self.lists[segment] = (part['node'].to_numpy(), part['score'].to_numpy())
+            self.user_ids = model_data['user_segments']['cookie'].to_numpy()
+            self.user_segments = model_data['user_segments']['segment'].to_list()
+
+    def recommend(self, user_ids: Sequence[int], k: int = 40, filter_seen: bool = True,
+                  exact: bool = False) -> List[Optional[Tuple[np.ndarray, np.ndarray]]]:
+        """(item_ids, scores) of every user, best first"""
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        positions = np.searchsorted(self.user_ids, user_ids)
+        result: List[Optional[Tuple[np.ndarray, np.ndarray]]] = []
+        for user_id, position in zip(user_ids, positions):
+            nodes, scores = self.popular
+            if position < len(self.user_ids) and self.user_ids[position] == user_id:
+                nodes, scores = self.lists.get(self.user_segments[position], self.popular)
+            result.append((nodes[:k], scores[:k]))
+        return result
+
+
+Recommender = Union[FactorRecommender, PopularRecommender]
+
+
+class _Loaded:
+    def __init__(self, model_data: Dict[str, Any], model_path: str):
+        self.model_data = model_data
+        if model_data.get('manifest', {}).get('model_type') == 'popular':
+            self.recommender: Recommender = PopularRecommender(model_data)
+        else:
+            self.recommender = FactorRecommender(model_data, load_ann_index(model_path))
+
+
+_recommenders: Dict[str, _Loaded] = {}
+_lock = threading.Lock()
+
+
+def get_recommender(model_path: str) -> Recommender:
+    """Recommender of the artifact at model_path, built once per process.
+
+    The artifact itself comes from the model registry, which reloads it when
+    the file changes; the recommender is rebuilt whenever the registry hands
+    back a different object.
+    """
+    registry = get_model_registry()
+    model_data = registry.get(None, model_path=model_path)
+    loaded = _recommenders.get(model_path)
+    if loaded is None or loaded.model_data is not model_data:
+        with _lock:
+            loaded = _recommenders.get(model_path)
+            if loaded is None or loaded.model_data is not model_data:
+                loaded = _recommenders[model_path] = _Loaded(model_data, model_path)
+                # Follow the registry's evictions, so evicted factors are not kept alive here
+                cached = set(registry.stats()['models'])
+                for path in [path for path in _recommenders if path not in cached]:
+                    del _recommenders[path]
+    return loaded.recommender
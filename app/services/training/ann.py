@@ -0,0 +1,195 @@
+import math
+import os
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from services.training.artifact import is_artifact, load_artifact, save_artifact
+
+ANN_DIR = 'ann'
+NPROBE_STEPS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _kmeans(vectors: np.ndarray, clusters: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    """Lloyd's k-means; empty clusters are re-seeded with random vectors"""
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    sq_norms = np.einsum('ij,ij->i', vectors, vectors)
+    for _ in range(iterations):
+        assignment = _assign(vectors, sq_norms, centroids)
+        counts = np.bincount(assignment, minlength=clusters)
+        members = csr_matrix((np.ones(len(vectors), dtype=np.float32), (assignment, np.arange(len(vectors)))),
+                             shape=(clusters, len(vectors)))
+        sums = members @ vectors
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def _assign(vectors: np.ndarray, sq_norms: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    """Nearest centroid (L2) of every vector, in chunks to bound the distance matrix"""
+    centroid_sq = np.einsum('ij,ij->i', centroids, centroids)
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_size):
+        block = vectors[start:start + chunk_size]
+        distances = sq_norms[start:start + chunk_size, None] - 2 * block @ centroids.T + centroid_sq
+        assignment[start:start + chunk_size] = distances.argmin(axis=1)
+    return assignment
+
+
+def _top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Positions and values of the k best scores, best first"""
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=scores.dtype)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return top, scores[top]
+
+
+class IVFIndex:
+    """Inverted-file index over item factors for inner-product and cosine search.
+
+    Items are clustered with k-means and stored list by list, so the vectors
+    of a list are one contiguous slice. A query scores the centroids, probes
+    the nprobe best lists and scores only their items exactly, which makes
+    its cost proportional to nprobe / nlist of the catalogue instead of all
+    of it. The vectors are not compressed: at ALS factor sizes the exact
+    rescoring of the probed lists is cheap and keeps the scores identical to
+    brute force for every item that is found.
+    """
+
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray, items: np.ndarray, vectors: np.ndarray,
+                 norms: np.ndarray, nprobe: int = 1, recall: Optional[Dict[str, float]] = None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.items = items
+        self.vectors = vectors
+        self.norms = norms
+        self.nprobe = nprobe
+        self.recall = recall or {}
+        self.centroid_norms = np.linalg.norm(centroids, axis=1)
+        # Position of every item code in the list order, to map exclusions to slots
+        self.positions = np.empty(len(items), dtype=np.int64)
+        self.positions[items] = np.arange(len(items))
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, item_factors: np.ndarray, nlist: Optional[int] = None, iterations: int = 20,
+              sample_size: int = 100_000, seed: int = 0) -> "IVFIndex":
+        """Cluster the item factors into nlist lists (about sqrt(n_items) by default)"""
+        vectors = np.ascontiguousarray(item_factors, dtype=np.float32)
+        n = len(vectors)
+        nlist = min(n, nlist or max(1, int(round(math.sqrt(n)))))
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, min(n, sample_size), replace=False)] if n > sample_size else vectors
+        centroids = _kmeans(sample, nlist, iterations, rng)
+        assignment = _assign(vectors, np.einsum('ij,ij->i', vectors, vectors), centroids)
+        items = np.argsort(assignment, kind='stable').astype(np.int32)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=nlist))
+        ordered = vectors[items]
+        return cls(centroids, offsets, items, ordered, np.linalg.norm(ordered, axis=1))
+
+    def _candidates(self, query: np.ndarray, nprobe: int, cosine: bool) -> np.ndarray:
+        """Slot ranges of the lists closest to the query, as one array of slots"""
+        centroid_scores = self.centroids @ query
+        if cosine:
+            centroid_scores = centroid_scores / np.maximum(self.centroid_norms, 1e-12)
+        lists, _ = _top_k(centroid_scores, nprobe)
+        starts, ends = self.offsets[lists], self.offsets[lists + 1]
+        return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+
+    def search(self, queries: np.ndarray, k: int, nprobe: Optional[int] = None, cosine: bool = False,
+               exclude: Optional[csr_matrix] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Best k item codes and scores for every query row, padded with -1.
+
+        With cosine the scores are cosine similarities, otherwise inner
+        products. Row i of exclude lists item codes never returned for query i.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        nprobe = min(self.nlist, nprobe or self.nprobe)
+        codes = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for row, query in enumerate(queries):
+            slots = self._candidates(query, nprobe, cosine)
+            slot_scores = self.vectors[slots] @ query
+            if cosine:
+                slot_scores /= np.maximum(self.norms[slots] * np.linalg.norm(query), 1e-12)
+            if exclude is not None:
+                seen = exclude.indices[exclude.indptr[row]:exclude.indptr[row + 1]]
+                if len(seen):
+                    slot_scores[np.isin(slots, self.positions[seen])] = -np.inf
+            top, top_scores = _top_k(slot_scores, k)
+            valid = np.isfinite(top_scores)
+            codes[row, :valid.sum()] = self.items[slots[top[valid]]]
+            scores[row, :valid.sum()] = top_scores[valid]
+        return codes, scores
+
+    def measure_recall(self, queries: np.ndarray, k: int = 10, nprobe: Optional[int] = None,
+                       cosine: bool = False) -> float:
+        """Share of the exact top-k found by search, over the given queries"""
+        queries = np.asarray(queries, dtype=np.float32)
+        vectors, norms = self.vectors, self.norms
+        exact_scores = queries @ vectors.T
+        if cosine:
+            exact_scores /= np.maximum(np.outer(np.linalg.norm(queries, axis=1), norms), 1e-12)
+        k = min(k, len(self.items))
+        exact = self.items[np.argpartition(-exact_scores, k - 1, axis=1)[:, :k]]
+        found, _ = self.search(queries, k, nprobe=nprobe, cosine=cosine)
+        hits = sum(len(np.intersect1d(row_exact, row_found)) for row_exact, row_found in zip(exact, found))
+        return hits / max(1, exact.size)
+
+    def tune(self, user_queries: np.ndarray, item_queries: np.ndarray, k: int = 10,
+             target: float = 0.95) -> None:
+        """Pick the smallest nprobe whose recall@k reaches target on both query sets"""
+        for nprobe in NPROBE_STEPS + (self.nlist,):
+            nprobe = min(nprobe, self.nlist)
+            recall = {
+                f'user_recall_at_{k}': self.measure_recall(user_queries, k, nprobe),
+                f'item_recall_at_{k}': self.measure_recall(item_queries, k, nprobe, cosine=True),
+            }
+            if min(recall.values()) >= target or nprobe == self.nlist:
+                break
+        self.nprobe = nprobe
+        self.recall = {key: round(value, 4) for key, value in recall.items()}
+
+    def to_data(self) -> Dict[str, Any]:
+        return {
+            'centroids': self.centroids, 'offsets': self.offsets, 'items': self.items,
+            'vectors': self.vectors, 'norms': self.norms, 'nprobe': int(self.nprobe), 'recall': self.recall,
+        }
+
+    @classmethod
+    def from_data(cls, data: Dict[str, Any]) -> "IVFIndex":
+        return cls(data['centroids'], data['offsets'], data['items'], data['vectors'], data['norms'],
+                   data['nprobe'], data['recall'])
+
+
+def ann_path(model_path: str) -> str:
+    return os.path.join(model_path, ANN_DIR)
+
+
+def build_ann_index(model_path: str, user_factors: np.ndarray, item_factors: np.ndarray,
+                    sample_queries: int = 1000, k: int = 10, target: float = 0.95,
+                    seed: int = 0) -> Dict[str, Any]:
+    """Build and tune the index of a model's item factors and store it inside its artifact"""
+    index = IVFIndex.build(item_factors, seed=seed)
+    rng = np.random.default_rng(seed)
+    users = rng.choice(len(user_factors), min(len(user_factors), sample_queries), replace=False)
+    items = rng.choice(len(item_factors), min(len(item_factors), sample_queries), replace=False)
+    index.tune(np.asarray(user_factors[np.sort(users)]), np.asarray(item_factors[np.sort(items)]), k, target)
+    save_artifact(ann_path(model_path), index.to_data(), 'ivf')
+    return {'nlist': index.nlist, 'nprobe': index.nprobe, **index.recall}
+
+
+def load_ann_index(model_path: str) -> Optional[IVFIndex]:
+    path = ann_path(model_path)
+    if not is_artifact(path):
+        return None
+    return IVFIndex.from_data(load_artifact(path))
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Any, Dict, Tuple
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+from scipy.sparse import csr_matrix
+
+# Bumped whenever the layout changes; load_artifact refuses newer versions
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+CSR_COMPONENTS = ('indptr', 'indices', 'data')
+ID_KEYS = ('user_ids', 'item_ids')
+# Model types whose artifact holds ALS user and item factors
+FACTOR_MODEL_TYPES = ('als', 'als_sweep', 'als_incremental')
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_artifact(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def als_factors(model_data: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """User and item factors of freshly trained model data or of a loaded artifact"""
+    if 'model' in model_data:
+        return model_data['model'].user_factors, model_data['model'].item_factors
+    return model_data['user_factors'], model_data['item_factors']
+
+
+def _write_ids(path: str, ids: np.ndarray) -> None:
+    table = pa.table({'id': np.ascontiguousarray(ids)})
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_ids(path: str) -> np.ndarray:
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all().column('id').combine_chunks().to_numpy()
+
+
+def _read_frame(path: str) -> pl.DataFrame:
+    with pa.memory_map(path) as source:
+        return pl.from_arrow(pa.ipc.open_file(source).read_all())
+
+
+def save_artifact(path: str, model_data: Dict[str, Any], model_type: str) -> str:
+    """Write model_data as a directory of memory-mappable parts and a JSON manifest.
+
+    Factor matrices and CSR components are .npy files, id maps and frames
+    are uncompressed Arrow IPC files and a CatBoost ranker uses its own
+    format. JSON-serializable values go into the manifest, which also lists
+    the size and SHA-256 of every file. The directory is written under a
+    temporary name and renamed into place, so a reader never sees a partial
+    artifact; an existing artifact at path is replaced.
+    """
+    tmp = os.path.join(os.path.dirname(path) or '.', f'.{os.path.basename(path)}.{uuid.uuid4().hex}')
+    os.makedirs(tmp)
+    parts: Dict[str, str] = {}
+    params: Dict[str, Any] = {}
+    try:
+        for key, value in model_data.items():
+            if key == 'model':
+                user_factors, item_factors = als_factors(model_data)
+                np.save(os.path.join(tmp, 'user_factors.npy'), np.ascontiguousarray(user_factors, dtype=np.float32))
+                np.save(os.path.join(tmp, 'item_factors.npy'), np.ascontiguousarray(item_factors, dtype=np.float32))
+                parts['user_factors'] = parts['item_factors'] = 'npy'
+            elif key == 'ranker':
+                value.save_model(os.path.join(tmp, 'ranker.cbm'))
+                parts[key] = 'catboost'
+            elif key in ID_KEYS:
+                _write_ids(os.path.join(tmp, f'{key}.arrow'), value)
+                parts[key] = 'ids'
+            elif isinstance(value, csr_matrix):
+                for name in CSR_COMPONENTS:
+                    np.save(os.path.join(tmp, f'{key}.{name}.npy'), getattr(value, name))
+                params[f'{key}_shape'] = list(value.shape)
+                parts[key] = 'csr'
+            elif isinstance(value, np.ndarray):
+                np.save(os.path.join(tmp, f'{key}.npy'), value)
+                parts[key] = 'npy'
+            elif isinstance(value, pl.DataFrame):
+                value.write_ipc(os.path.join(tmp, f'{key}.arrow'), compression='uncompressed')
+                parts[key] = 'frame'
+            else:
+                json.dumps(value)  # Anything else has to fit in the manifest
+                params[key] = value
+
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'model_type': model_type,
+            'created_at': time.time(),
+            'parts': parts,
+            'params': params,
+            'files': {
+                entry.name: {'bytes': entry.stat().st_size, 'sha256': file_digest(entry.path)}
+                for entry in sorted(os.scandir(tmp), key=lambda entry: entry.name)
+            },
+        }
+        with open(os.path.join(tmp, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f, indent=1)
+        if os.path.exists(path):
+            # Left by an earlier attempt, e.g. of a job resumed after its worker died
+            old = f'{tmp}.old'
+            os.rename(path, old)
+            os.rename(tmp, path)
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            os.rename(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return path
+
+
+def read_manifest(path: str) -> Dict[str, Any]:
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version', 0) > FORMAT_VERSION:
+        raise ValueError(f"Artifact {path} has format version {manifest['format_version']}, "
+                         f"this build reads up to {FORMAT_VERSION}")
+    return manifest
+
+
+def artifact_bytes(path: str) -> int:
+    return sum(file['bytes'] for file in read_manifest(path)['files'].values())
+
+
+def verify_artifact(path: str) -> None:
+    """Raise ValueError unless every file matches the size and checksum in the manifest"""
+    for name, expected in read_manifest(path)['files'].items():
+        file_path = os.path.join(path, name)
+        if not os.path.exists(file_path) or os.path.getsize(file_path) != expected['bytes']:
+            raise ValueError(f"Artifact file {file_path} is missing or truncated")
+        if file_digest(file_path) != expected['sha256']:
+            raise ValueError(f"Artifact file {file_path} does not match its checksum")
+
+
+def load_artifact(path: str, mmap_mode: str = 'r', verify: bool = False) -> Dict[str, Any]:
+    """Model data of an artifact written by save_artifact.
+
+    Arrays and frames are memory-mapped (read-only by default), so opening
+    an artifact reads only the manifest and processes loading the same
+    artifact share its pages. Checksums are only checked with verify=True,
+    which reads every file.
+    """
+    if verify:
+        verify_artifact(path)
+    manifest = read_manifest(path)
+    model_data: Dict[str, Any] = dict(manifest['params'])
+    for key, kind in manifest['parts'].items():
+        if kind == 'npy':
+            model_data[key] = np.load(os.path.join(path, f'{key}.npy'), mmap_mode=mmap_mode)
+        elif kind == 'ids':
+            model_data[key] = _read_ids(os.path.join(path, f'{key}.arrow'))
+        elif kind == 'frame':
+            model_data[key] = _read_frame(os.path.join(path, f'{key}.arrow'))
+        elif kind == 'csr':
+            arrays = [np.load(os.path.join(path, f'{key}.{name}.npy'), mmap_mode=mmap_mode) for name in CSR_COMPONENTS]
+            indptr, indices, data = arrays
+            model_data[key] = csr_matrix((data, indices, indptr), shape=tuple(model_data.pop(f'{key}_shape')))
+        elif kind == 'catboost':
+            from catboost import CatBoost
+            model_data[key] = CatBoost().load_model(os.path.join(path, 'ranker.cbm'))
+        else:
+            raise ValueError(f"Unknown part {kind} of {key} in {path}")
+    model_data['manifest'] = manifest
+    return model_data
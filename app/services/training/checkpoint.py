@@ -0,0 +1,76 @@
+import os
+import shutil
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+from services.training.artifact import is_artifact, load_artifact, save_artifact
+from services.training.split_cache import SplitCache
+
+CHECKPOINT_DIR = '.checkpoints'
+
+
+class Checkpoint:
+    """State a training job resumes from after its worker died, under one directory per job.
+
+    The split holds the preprocessed frames and the encoded matrix (in the
+    split cache format) and the factor checkpoints are artifacts named by
+    the ALS iteration they were taken after. Both are written under a
+    temporary name and renamed into place, so a crash mid-write leaves the
+    previous checkpoint usable; only the latest factors are kept.
+    """
+
+    def __init__(self, root: str, every: int = 5):
+        self.root = root
+        self.every = every
+        os.makedirs(self.root, exist_ok=True)
+
+    @property
+    def splits(self) -> SplitCache:
+        return SplitCache(os.path.join(self.root, 'split'), max_bytes=2 ** 62)
+
+    def _factor_checkpoints(self, name: str) -> List[Tuple[int, str]]:
+        """(iteration, path) of the complete factor checkpoints of name, latest first"""
+        found = []
+        for entry in os.scandir(self.root):
+            prefix, _, iteration = entry.name.rpartition('.')
+            if prefix == name and iteration.isdigit() and is_artifact(entry.path):
+                found.append((int(iteration), entry.path))
+        return sorted(found, reverse=True)
+
+    def save_factors(self, name: str, iteration: int, user_factors: np.ndarray, item_factors: np.ndarray) -> None:
+        path = os.path.join(self.root, f'{name}.{iteration}')
+        if not os.path.exists(path):
+            save_artifact(path, {'user_factors': np.asarray(user_factors), 'item_factors': np.asarray(item_factors),
+                                 'iteration': iteration}, 'checkpoint')
+        for older, older_path in self._factor_checkpoints(name):
+            if older < iteration:
+                shutil.rmtree(older_path, ignore_errors=True)
+
+    def load_factors(self, name: str, n_users: int, n_items: int,
+                     factors: int) -> Optional[Tuple[int, np.ndarray, np.ndarray]]:
+        """Iteration and writable factors of the latest intact checkpoint of name matching the shapes"""
+        for iteration, path in self._factor_checkpoints(name):
+            try:
+                data = load_artifact(path, mmap_mode=None, verify=True)
+            except ValueError as e:
+                print(f"Skipping checkpoint {path}: {e}")
+                continue
+            if data['user_factors'].shape == (n_users, factors) and data['item_factors'].shape == (n_items, factors):
+                return iteration, data['user_factors'], data['item_factors']
+        return None
+
+    def als_callback(self, name: str, model, start: int, iterations: int,
+                     callback: Optional[Callable] = None) -> Callable[[int, float, Optional[float]], None]:
+        """callback for implicit's fit resumed at iteration start: saves the factors every
+        `every` iterations and after the last one, then calls callback with the overall iteration"""
+        def checkpoint_callback(iteration: int, elapsed: float, loss: Optional[float] = None) -> None:
+            done = start + iteration + 1
+            if self.every and (done % self.every == 0 or done == iterations):
+                self.save_factors(name, done, model.user_factors, model.item_factors)
+            if callback is not None:
+                callback(start + iteration, elapsed, loss)
+        return checkpoint_callback
+
+    def clear(self) -> None:
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,103 @@
+from typing import Optional
+
+import numpy as np
+import polars as pl
+from scipy.sparse import csr_matrix
+
+
+class InteractionEncoding:
+    """Dense integer codes for users and items of an interaction table.
+
+    user_ids and item_ids are sorted arrays of the original ids, so the code of
+    an id is its position in the array. Encoding is a searchsorted over the
+    array and decoding is a plain gather, both without Python-level loops.
+    """
+
+    def __init__(self, user_ids: np.ndarray, item_ids: np.ndarray, matrix: csr_matrix,
+                 user_col: str = 'cookie', item_col: str = 'node'):
+        self.user_ids = user_ids
+        self.item_ids = item_ids
+        self.matrix = matrix
+        self.user_col = user_col
+        self.item_col = item_col
+
+    @property
+    def shape(self):
+        return len(self.user_ids), len(self.item_ids)
+
+    @staticmethod
+    def _lookup(ids: np.ndarray, values) -> np.ndarray:
+        values = np.asarray(values)
+        if len(ids) == 0:
+            return np.full(len(values), -1, dtype=np.int32)
+        codes = np.minimum(np.searchsorted(ids, values), len(ids) - 1).astype(np.int32)
+        codes[ids[codes] != values] = -1
+        return codes
+
+    def encode_users(self, user_ids) -> np.ndarray:
+        """Codes of the given users, -1 for users unseen in training"""
+        return self._lookup(self.user_ids, user_ids)
+
+    def encode_items(self, item_ids) -> np.ndarray:
+        """Codes of the given items, -1 for items unseen in training"""
+        return self._lookup(self.item_ids, item_ids)
+
+    def decode_users(self, codes) -> np.ndarray:
+        return self.user_ids[np.asarray(codes)]
+
+    def decode_items(self, codes) -> np.ndarray:
+        return self.item_ids[np.asarray(codes)]
+
+    def recommendations_frame(self, user_codes: np.ndarray, item_codes: np.ndarray,
+                              scores: Optional[np.ndarray] = None) -> pl.DataFrame:
+        """Long (user, item, score) frame from the (n_users, N) output of a recommender.
+
+        Slots the model could not fill are returned as negative codes and dropped.
+        """
+        n = item_codes.shape[1] if item_codes.ndim == 2 else 0
+        users = np.repeat(np.asarray(user_codes), n)
+        items = item_codes.ravel()
+        mask = items >= 0
+        data = {
+            self.item_col: self.decode_items(items[mask]),
+            self.user_col: self.decode_users(users[mask]),
+        }
+        if scores is not None:
+            data['scores'] = scores.ravel()[mask]
+        return pl.DataFrame(data)
+
+
+def _codes(df: pl.DataFrame, col: str, ids: Optional[np.ndarray]) -> tuple:
+    if ids is None:
+        codes = df.select((pl.col(col).rank('dense') - 1).cast(pl.Int32)).to_series().to_numpy()
+        return codes, df[col].unique().sort().to_numpy()
+    return np.searchsorted(ids, df[col].to_numpy()).astype(np.int32), ids
+
+
+def encode_interactions(df: pl.DataFrame, user_col: str = 'cookie', item_col: str = 'node',
+                        weight_col: Optional[str] = None, user_ids: Optional[np.ndarray] = None,
+                        item_ids: Optional[np.ndarray] = None) -> InteractionEncoding:
+    """Encode an interaction table into a users x items CSR matrix.
+
+    Codes are dense ranks computed by Polars over the columnar buffers, which
+    keeps them aligned with the sorted unique ids. Repeated (user, item) pairs
+    are summed, so without weight_col a cell holds the number of interactions.
+    Given user_ids or item_ids (sorted, and a superset of the ids in df), the
+    codes index into them instead, so rows and columns of ids absent from df
+    stay empty.
+    """
+    rows, user_ids = _codes(df, user_col, user_ids)
+    cols, item_ids = _codes(df, item_col, item_ids)
+
+    if weight_col is None:
+        values = np.ones(df.height, dtype=np.float32)
+    else:
+        values = df[weight_col].cast(pl.Float32).to_numpy()
+
+    matrix = csr_matrix(
+        (values, (rows, cols)),
+        shape=(len(user_ids), len(item_ids)),
+        dtype=np.float32,
+    )
+    matrix.sum_duplicates()
+    return InteractionEncoding(user_ids, item_ids, matrix, user_col, item_col)
@@ -0,0 +1,174 @@
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy.sparse import csr_matrix
+
+ACTIVE_FILE = 'ACTIVE'
+MANIFEST_FILE = 'manifest.json'
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+MASK_64 = (1 << 64) - 1
+# Working memory of a chunk row per item: its float32 score and the int64 index argpartition returns
+SCORE_BYTES_PER_ITEM = 4 + 8
+
+
+def job_set_name(job_id: int) -> str:
+    """Name the recommendations of a training job are materialized and served under"""
+    return f'job_{job_id}'
+
+
+def user_partition(user_ids: np.ndarray, partitions: int) -> np.ndarray:
+    """Partition of every user id: a 64-bit multiplicative hash, the same as partition_of"""
+    return (np.asarray(user_ids).astype(np.uint64) * np.uint64(HASH_MULTIPLIER) >> np.uint64(32)) \
+        % np.uint64(partitions)
+
+
+def partition_of(user_id: int, partitions: int) -> int:
+    """user_partition for a single id, without numpy's per-call overhead"""
+    return ((int(user_id) * HASH_MULTIPLIER & MASK_64) >> 32) % partitions
+
+
+def top_k_chunk(user_factors: np.ndarray, item_factors: np.ndarray, seen: Optional[csr_matrix],
+                k: int) -> tuple:
+    """Best k items and their scores for a chunk of users, seen items excluded.
+
+    One matrix product scores the chunk, argpartition selects the k best
+    columns of every row without sorting them all, and only those k are
+    sorted. Rows with fewer than k unseen items are padded with -1.
+    """
+    scores = user_factors @ item_factors.T
+    if seen is not None and seen.nnz:
+        rows = np.repeat(np.arange(seen.shape[0]), np.diff(seen.indptr))
+        scores[rows, seen.indices] = -np.inf
+    k = min(k, scores.shape[1])
+    # The k largest end up in the last k columns, without a negated copy of the scores
+    top = np.argpartition(scores, -k, axis=1)[:, -k:]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+    top[~np.isfinite(top_scores)] = -1
+    return top, top_scores
+
+
+def chunk_rows(n_items: int, memory_mb: int) -> int:
+    """Users scored per chunk so that the chunk's score and index matrices fit in memory_mb"""
+    return max(1, memory_mb * 2 ** 20 // (max(n_items, 1) * SCORE_BYTES_PER_ITEM))
+
+
+def materialize_top_k(root: str, model_name: str, version: str, user_factors: np.ndarray,
+                      item_factors: np.ndarray, user_ids: np.ndarray, item_ids: np.ndarray,
+                      seen: Optional[csr_matrix] = None, k: int = 100, memory_mb: int = 512,
+                      partitions: int = 16, keep_versions: int = 2, extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Write the top-k of every user as Parquet partitioned by user hash, then make it active.
+
+    Users are scored in chunks sized by chunk_rows, so the dense scores of
+    a chunk stay within memory_mb whatever the catalog size. The version
+    directory is complete before ACTIVE is replaced with os.replace, so
+    readers see either the previous set or the new one. Each partition is
+    sorted by user (and rank), which lets the reader find a user's rows
+    with a binary search.
+    """
+    started = time.time()
+    model_dir = os.path.join(root, model_name)
+    version_dir = os.path.join(model_dir, version)
+    tmp_dir = os.path.join(model_dir, f'.{version}.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    user_factors = np.asarray(user_factors, dtype=np.float32)
+    item_factors = np.asarray(item_factors, dtype=np.float32)
+    parts = user_partition(user_ids, partitions)
+    # Users in partition order, so every chunk appends to few partition files in sorted order
+    order = np.lexsort((user_ids, parts))
+    chunk_size = chunk_rows(len(item_factors), memory_mb)
+
+    schema = pa.schema([('user_id', pa.from_numpy_dtype(np.asarray(user_ids).dtype)),
+                        ('rank', pa.int16()),
+                        ('item_id', pa.from_numpy_dtype(np.asarray(item_ids).dtype)),
+                        ('score', pa.float32())])
+    writers: Dict[int, pq.ParquetWriter] = {}
+    rows = 0
+    try:
+        for start in range(0, len(order), chunk_size):
+            codes = order[start:start + chunk_size]
+            top, top_scores = top_k_chunk(user_factors[codes], item_factors,
+                                          seen[codes] if seen is not None else None, k)
+            width = top.shape[1]
+            valid = top >= 0
+            chunk_users = np.repeat(codes, width).reshape(-1, width)
+            ranks = np.broadcast_to(np.arange(width, dtype=np.int16), top.shape)
+
+            chunk_parts = parts[chunk_users[valid]]
+            table_users = np.asarray(user_ids)[chunk_users[valid]]
+            table = {
+                'user_id': table_users,
+                'rank': ranks[valid],
+                'item_id': np.asarray(item_ids)[top[valid]],
+                'score': top_scores[valid].astype(np.float32),
+            }
+            for part in np.unique(chunk_parts):
+                mask = chunk_parts == part
+                writer = writers.get(int(part))
+                if writer is None:
+                    writer = writers[int(part)] = pq.ParquetWriter(
+                        os.path.join(tmp_dir, f'part-{int(part):04d}.parquet'), schema)
+                writer.write_table(pa.table({name: values[mask] for name, values in table.items()}, schema=schema))
+            rows += int(valid.sum())
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    manifest = {
+        'model_name': model_name,
+        'version': version,
+        'k': k,
+        'partitions': partitions,
+        'users': int(len(user_ids)),
+        'rows': rows,
+        'created_at': time.time(),
+        **(extra or {}),
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+    shutil.rmtree(version_dir, ignore_errors=True)
+    os.rename(tmp_dir, version_dir)
+    activate(root, model_name, version)
+    _prune(model_dir, keep_versions)
+
+    manifest['seconds'] = round(time.time() - started, 2)
+    return manifest
+
+
+def activate(root: str, model_name: str, version: str) -> None:
+    """Atomically point the model's ACTIVE file at version"""
+    model_dir = os.path.join(root, model_name)
+    tmp = os.path.join(model_dir, f'.{ACTIVE_FILE}.{os.getpid()}')
+    with open(tmp, 'w') as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(model_dir, ACTIVE_FILE))
+
+
+def active_version(root: str, model_name: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, model_name, ACTIVE_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _prune(model_dir: str, keep: int) -> None:
+    """Remove old versions, never the active one"""
+    active = active_version(os.path.dirname(model_dir), os.path.basename(model_dir))
+    versions = sorted(
+        (entry for entry in os.scandir(model_dir)
+         if entry.is_dir() and not entry.name.startswith('.') and entry.name != active),
+        key=lambda entry: entry.stat().st_mtime, reverse=True,
+    )
+    for entry in versions[max(0, keep - 1):]:
+        shutil.rmtree(entry.path, ignore_errors=True)
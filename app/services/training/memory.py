@@ -0,0 +1,60 @@
+import os
+import resource
+import threading
+from typing import Optional
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on Linux; without /proc the lifetime peak is the best we have
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakMemory:
+    """Samples the RSS in a background thread while the block runs.
+
+    ru_maxrss only ever grows over the life of the long-running training
+    worker, so it cannot tell how much one job used. Sampling gives the peak
+    of the block itself.
+
+        with PeakMemory() as mem:
+            ...
+        mem.peak_mb
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.start_bytes = 0
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "PeakMemory":
+        self.start_bytes = self.peak_bytes = current_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="peak-memory", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, current_rss())
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, current_rss())
+
+    @property
+    def peak_mb(self) -> float:
+        return round(self.peak_bytes / 2 ** 20, 1)
+
+    @property
+    def growth_mb(self) -> float:
+        return round((self.peak_bytes - self.start_bytes) / 2 ** 20, 1)
@@ -0,0 +1,155 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import polars as pl
+
+METRIC_NAMES = ('recall', 'precision', 'f1', 'ndcg', 'map', 'hit_rate', 'coverage')
+
+
+def _shard_sums(df_true: pl.DataFrame, df_pred: pl.DataFrame, ks: Sequence[int],
+                user_col: str, item_col: str) -> Dict[str, object]:
+    """Per-K metric sums over the users of one shard, from a single hits pass.
+
+    df_pred rows are expected in rank order within each user. Only the users
+    present in df_true are evaluated.
+    """
+    max_k = max(ks)
+    truth = df_true.select(user_col, item_col).unique()
+    users = truth[user_col].unique().sort()
+    n_users = len(users)
+
+    # Integer user codes shared by the truth and the predictions
+    user_codes = pl.DataFrame({user_col: users, '_u': np.arange(n_users, dtype=np.int32)})
+    n_true = np.bincount(truth.join(user_codes, on=user_col)['_u'].to_numpy(), minlength=n_users)
+
+    pred = (
+        df_pred.select(user_col, item_col)
+        .with_columns(_rank=pl.int_range(pl.len(), dtype=pl.Int32).over(user_col))
+        .filter(pl.col('_rank') < max_k)
+        .join(user_codes, on=user_col)
+    )
+    hits = pred.join(truth, on=[user_col, item_col], how='semi').sort('_u', '_rank')
+    hit_user = hits['_u'].to_numpy()
+    hit_rank = hits['_rank'].to_numpy()
+
+    pred_rank = pred['_rank'].to_numpy()
+    pred_items = pred[item_col]
+    sums = _hit_sums(hit_user, hit_rank, n_true, ks)
+    for k in ks:
+        sums[f'items_at_{k}'] = pred_items.filter(pred_rank < k).unique()
+    return sums
+
+
+def _hit_sums(hit_user: np.ndarray, hit_rank: np.ndarray, n_true: np.ndarray,
+              ks: Sequence[int]) -> Dict[str, object]:
+    """Per-K metric sums from the hits sorted by user and rank (0-based) and the truth size of every user"""
+    n_users = len(n_true)
+    max_k = max(ks)
+    # Position of each hit among the hits of its user, 1-based
+    starts = np.searchsorted(hit_user, hit_user, side='left')
+    hit_order = np.arange(len(hit_user)) - starts + 1
+
+    discounts = 1.0 / np.log2(np.arange(max_k) + 2.0)
+    ideal = np.concatenate([[0.0], np.cumsum(discounts)])
+
+    sums: Dict[str, object] = {'users': n_users}
+    for k in ks:
+        in_k = hit_rank < k
+        u = hit_user[in_k]
+        hits_k = np.bincount(u, minlength=n_users)
+        relevant = np.minimum(n_true, k)
+
+        dcg = np.bincount(u, weights=discounts[hit_rank[in_k]], minlength=n_users)
+        ap = np.bincount(u, weights=hit_order[in_k] / (hit_rank[in_k] + 1.0), minlength=n_users)
+
+        sums[f'recall_at_{k}'] = float((hits_k / n_true).sum())
+        sums[f'precision_at_{k}'] = float(hits_k.sum() / k)
+        sums[f'ndcg_at_{k}'] = float((dcg / ideal[relevant]).sum())
+        sums[f'map_at_{k}'] = float((ap / relevant).sum())
+        sums[f'hit_rate_at_{k}'] = float((hits_k > 0).sum())
+    return sums
+
+
+def _combine(parts, ks: Sequence[int], catalog_size: int) -> Dict[str, float]:
+    n_users = sum(part['users'] for part in parts)
+    metrics: Dict[str, float] = {}
+    for k in ks:
+        for name in ('recall', 'precision', 'ndcg', 'map', 'hit_rate'):
+            key = f'{name}_at_{k}'
+            metrics[key] = sum(part[key] for part in parts) / n_users if n_users else 0.0
+        precision, recall = metrics[f'precision_at_{k}'], metrics[f'recall_at_{k}']
+        metrics[f'f1_at_{k}'] = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        items = pl.concat([part[f'items_at_{k}'] for part in parts]).n_unique()
+        metrics[f'coverage_at_{k}'] = items / catalog_size if catalog_size else 0.0
+    return metrics
+
+
+def ranking_metrics(df_true: pl.DataFrame, df_pred: pl.DataFrame, ks: Sequence[int] = (40,),
+                    catalog_size: Optional[int] = None, user_col: str = 'cookie', item_col: str = 'node',
+                    processes: int = 1) -> Dict[str, float]:
+    """Recall, Precision, F1, NDCG, MAP, HitRate and coverage for every K in ks.
+
+    Hits are found once with a single semi join on the top max(ks)
+    predictions, every K is then a masked bincount over the same arrays.
+    Metrics are averaged over the users of df_true, F1 is computed from the
+    averaged precision and recall. Coverage is the share of catalog_size (the
+    number of items in df_true and df_pred by default) recommended to
+    anyone. With processes > 1 users are hashed into shards evaluated in a
+    process pool.
+    """
+    ks = sorted(set(int(k) for k in ks))
+    if processes > 1:
+        shard = pl.col(user_col).hash() % processes
+        true_shards = df_true.with_columns(_shard=shard).partition_by('_shard', as_dict=True)
+        pred_shards = df_pred.with_columns(_shard=shard).partition_by('_shard', as_dict=True)
+        keys = list(true_shards)
+        # Polars keeps its own thread pool, which does not survive fork
+        with ProcessPoolExecutor(max_workers=min(processes, len(keys) or 1),
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            parts = list(pool.map(
+                _shard_sums,
+                [true_shards[key] for key in keys],
+                [pred_shards.get(key, df_pred.clear()) for key in keys],
+                [ks] * len(keys), [user_col] * len(keys), [item_col] * len(keys),
+            ))
+    else:
+        parts = [_shard_sums(df_true, df_pred, ks, user_col, item_col)]
+
+    if catalog_size is None:
+        catalog_size = pl.concat([df_true[item_col], df_pred[item_col]]).n_unique()
+    return _combine(parts, ks, catalog_size)
+
+
+def list_metrics(df_true: pl.DataFrame, lists: pl.DataFrame, ks: Sequence[int] = (40,),
+                 catalog_size: Optional[int] = None, user_col: str = 'cookie', item_col: str = 'node',
+                 list_col: Optional[str] = None) -> Dict[str, float]:
+    """ranking_metrics of recommending shared ranked lists, without expanding them per user.
+
+    lists holds item_col and a 0-based 'rank'. With list_col, lists holds one
+    list per value and every user of df_true, which carries list_col too,
+    gets the list of its value (a null value matches the list under null).
+    A hit is then a join of the truth with the list ranks, so the cost
+    depends on the truth and the lists, not on users x K.
+    """
+    ks = sorted(set(int(k) for k in ks))
+    keys = [list_col] if list_col else []
+    truth = df_true.select(user_col, item_col, *keys).unique([user_col, item_col])
+    users = truth[user_col].unique().sort()
+    user_codes = pl.DataFrame({user_col: users, '_u': np.arange(len(users), dtype=np.int32)})
+    truth = truth.join(user_codes, on=user_col)
+    n_true = np.bincount(truth['_u'].to_numpy(), minlength=len(users))
+
+    ranked = lists.select(*keys, item_col, pl.col('rank').cast(pl.Int32)).filter(pl.col('rank') < max(ks))
+    hits = truth.join(ranked, on=[*keys, item_col], nulls_equal=True).sort('_u', 'rank')
+    sums = _hit_sums(hits['_u'].to_numpy(), hits['rank'].to_numpy(), n_true, ks)
+
+    # Only the lists some user received count towards coverage
+    if list_col:
+        ranked = ranked.join(truth.select(list_col).unique(), on=list_col, how='semi', nulls_equal=True)
+    for k in ks:
+        sums[f'items_at_{k}'] = ranked.filter(pl.col('rank') < k)[item_col].unique()
+    if catalog_size is None:
+        catalog_size = pl.concat([df_true[item_col], lists[item_col]]).n_unique()
+    return _combine([sums], ks, catalog_size)
@@ -0,0 +1,53 @@
+import math
+from typing import Optional
+
+import polars as pl
+
+# cat_features.pq columns a popularity model can be segmented by
+SEGMENTS = ('category', 'location')
+
+
+def node_segments(cat_features: pl.LazyFrame, segment: str) -> pl.DataFrame:
+    """One segment value per node (the smallest one when a node spans several)"""
+    return cat_features.group_by('node').agg(pl.col(segment).min().alias('segment')).collect()
+
+
+def user_segments(df_train: pl.DataFrame, segments: pl.DataFrame) -> pl.DataFrame:
+    """Segment of every train user: the one of most of its interactions, ties to the smallest value"""
+    return (
+        df_train.lazy()
+        .select('cookie', 'node')
+        .join(segments.lazy(), on='node')
+        .group_by('cookie', 'segment')
+        .agg(pl.len().alias('_n'))
+        .sort(['cookie', '_n', 'segment'], descending=[False, True, False])
+        .group_by('cookie', maintain_order=True)
+        .first()
+        .select('cookie', 'segment')
+        .collect()
+    )
+
+
+def interaction_weights(df_train: pl.DataFrame, half_life_days: Optional[float] = None) -> pl.LazyFrame:
+    """Interactions with their weight: 1, or halved every half_life_days before the last train day"""
+    weight = pl.lit(1.0)
+    if half_life_days:
+        age = (pl.col('event_date').max() - pl.col('event_date')).dt.total_days()
+        weight = (-math.log(2) / half_life_days * age).exp()
+    return df_train.lazy().with_columns(weight.cast(pl.Float32).alias('score'))
+
+
+def ranked_lists(weighted: pl.LazyFrame, size: int, by: Optional[str] = None) -> pl.DataFrame:
+    """Top size nodes by summed weight, globally or per value of by, with a 0-based rank"""
+    keys = [by] if by else []
+    rank = pl.int_range(pl.len(), dtype=pl.Int32)
+    ranked = (
+        weighted.group_by(*keys, 'node')
+        .agg(pl.col('score').sum())
+        .sort([*keys, 'score', 'node'], descending=[False] * len(keys) + [True, False])
+    )
+    if keys:
+        ranked = ranked.group_by(*keys, maintain_order=True).head(size).with_columns(rank.over(keys).alias('rank'))
+    else:
+        ranked = ranked.head(size).with_columns(rank.alias('rank'))
+    return ranked.select(*keys, 'rank', 'node', 'score').collect()
@@ -0,0 +1,276 @@
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional
+
+PRIORITIES = ('interactive', 'batch')
+# Peak RSS per clickstream row when no completed job of the type has telemetry yet
+MEMORY_BYTES_PER_ROW = {'popular': 150, 'als': 400, 'als_incremental': 500, 'als_sweep': 600, 'two_stage': 1500}
+BASE_MEMORY_MB = 300
+# Seconds between two cancellation queries of a running job
+CANCEL_POLL_INTERVAL = 2.0
+# Crashes of a job running alone before it is marked failed; each run resumes from the checkpoint
+MAX_ATTEMPTS = 3
+
+
+def job_key(model_type: str, data_path: str, hyperparams: Optional[Dict[str, Any]]) -> str:
+    """Identity of a training run: jobs with the same key produce the same model"""
+    payload = json.dumps([model_type, os.path.normpath(data_path), hyperparams or {}], sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def estimate_resources(model_type: str, hyperparams: Optional[Dict[str, Any]], rows: int,
+                       profile: Optional[Dict[str, float]], job_threads: int, sweep_processes: int,
+                       cpu_budget: int) -> Dict[str, int]:
+    """CPUs and peak memory a job is admitted with.
+
+    Memory scales the peak RSS of the latest completed job of the same type
+    (profile, from its telemetry) by the clickstream rows, falling back to a
+    per-row constant. CPUs are the threads the job is allowed to use: one
+    for popular models, the ranker or ALS threads otherwise and one ALS
+    fit's worth per sweep process.
+    """
+    hyperparams = hyperparams or {}
+    if profile:
+        memory_mb = BASE_MEMORY_MB + max(0.0, profile['peak_rss_mb'] - BASE_MEMORY_MB) * rows / profile['rows']
+    else:
+        memory_mb = BASE_MEMORY_MB + rows * MEMORY_BYTES_PER_ROW.get(model_type, 1000) / 2 ** 20
+    if model_type == 'popular':
+        cpu = 1
+    elif model_type == 'als_sweep':
+        cpu = job_threads * int(hyperparams.get('processes') or sweep_processes)
+    else:
+        cpu = int(hyperparams.get('threads') or job_threads)
+    return {'cpu': max(1, min(cpu, cpu_budget)), 'memory_mb': int(memory_mb)}
+
+
+def run_training_job(task: Dict[str, Any], threads: int) -> str:
+    """Pool worker: train one task and return its final status.
+
+    The job stops cooperatively once it and every job merged into it asked
+    to be cancelled; the flag is read from the database at most every
+    CANCEL_POLL_INTERVAL seconds.
+    """
+    from threadpoolctl import threadpool_limits
+    from database.database import get_session
+    from services.crud.training import TrainingService
+    from services.training.telemetry import TrainingCancelled
+
+    session = next(get_session())
+    service = TrainingService()
+    polled = {'at': 0.0, 'cancelled': False}
+
+    def should_stop() -> bool:
+        now = time.monotonic()
+        if now - polled['at'] >= CANCEL_POLL_INTERVAL:
+            polled['at'] = now
+            polled['cancelled'] = service.run_cancelled(task['job_id'], session)
+        return polled['cancelled']
+
+    try:
+        with threadpool_limits(limits=threads):
+            service.train_model(task['job_id'], session, task['model_type'], task['data_path'],
+                                task.get('hyperparams'), threads=threads, should_stop=should_stop)
+        return 'completed'
+    except TrainingCancelled:
+        print(f"Training job {task['job_id']} cancelled")
+        return 'cancelled'
+    except Exception as e:
+        print(f"Training job {task['job_id']} failed: {e}")
+        return 'failed'
+    finally:
+        session.close()
+
+
+class _Run:
+    """One training run: the leader task and the identical jobs merged into it"""
+
+    def __init__(self, task: Dict[str, Any], key: str, priority: int, order: int, resources: Dict[str, int],
+                 ack: Callable[[], None]):
+        self.task = task
+        self.key = key
+        self.priority = priority
+        self.order = order
+        self.resources = resources
+        self.job_ids = [task['job_id']]
+        self.acks = [ack]
+        self.attempts = 0
+        # Was in a pool that broke, runs alone until it is known whether its process was the one that died
+        self.isolate = False
+        self.future: Optional[Future] = None
+        self.pool: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def leader_id(self) -> int:
+        return self.task['job_id']
+
+
+class TrainingScheduler:
+    """Admits training jobs against a CPU and memory budget and runs them in a process pool.
+
+    Pending runs are ordered by priority (interactive before batch), then by
+    arrival. A run starts when its estimated CPUs and memory fit in what the
+    running ones leave free; a run larger than the whole budget starts alone.
+    The first run that does not fit reserves its share, so smaller runs
+    behind it only fill the remainder and cannot starve it. A job identical
+    to a pending or running one (same job_key) is merged into that run and
+    gets its result instead of training again.
+
+    A process that dies (killed, out of memory) breaks the whole pool and
+    ends every run in it without telling which one it was. Those runs are
+    queued again to resume from their checkpoints, without counting the
+    crash against them, and then run alone one at a time: a run that
+    crashes while alone is charged an attempt and is marked failed after
+    MAX_ATTEMPTS of them.
+
+    The scheduler is driven from one thread: submit() and tick() are called
+    by the consumer, and pool completions are handed back to it through
+    call_soon, the consumer's thread-safe callback hook.
+    """
+
+    def __init__(self, cpu_budget: int, memory_budget_mb: int, max_concurrent: int,
+                 estimate: Callable[[Dict[str, Any]], Dict[str, int]],
+                 service, session_factory: Callable[[], Any],
+                 call_soon: Callable[[Callable[[], None]], None] = lambda callback: callback(),
+                 runner: Callable[[Dict[str, Any], int], str] = run_training_job):
+        self.cpu_budget = cpu_budget
+        self.memory_budget_mb = memory_budget_mb
+        self.max_concurrent = max_concurrent
+        self.estimate = estimate
+        self.service = service
+        self.session_factory = session_factory
+        self.call_soon = call_soon
+        self.runner = runner
+        self.pending: List[_Run] = []
+        self.running: Dict[str, _Run] = {}
+        self._order = itertools.count()
+        self.pool = self._new_pool()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # Fresh process per job, so its memory is returned when it ends
+        return ProcessPoolExecutor(max_workers=self.max_concurrent, mp_context=multiprocessing.get_context('spawn'),
+                                   max_tasks_per_child=1)
+
+    def used(self) -> Dict[str, int]:
+        return {
+            'cpu': sum(run.resources['cpu'] for run in self.running.values()),
+            'memory_mb': sum(run.resources['memory_mb'] for run in self.running.values()),
+        }
+
+    def submit(self, task: Dict[str, Any], ack: Callable[[], None]) -> None:
+        """Queue a task from the broker; ack is called once its job has an outcome"""
+        with self.session_factory() as session:
+            job = self.service.get_training_job(task['job_id'], session)
+            if job is None or job.status in ("completed", "failed", "cancelled"):
+                # Unknown, cancelled while queued or already finished before a redelivery
+                ack()
+                return
+            key = job.job_key or job_key(task['model_type'], task['data_path'], task.get('hyperparams'))
+            priority = PRIORITIES.index(job.priority) if job.priority in PRIORITIES else len(PRIORITIES)
+
+            run = self.running.get(key) or next((run for run in self.pending if run.key == key), None)
+            if run is not None and job.job_id not in run.job_ids:
+                self.service.merge_training_job(job.job_id, run.leader_id, session)
+                run.job_ids.append(job.job_id)
+                run.acks.append(ack)
+                run.priority = min(run.priority, priority)
+                print(f"Training job {job.job_id} merged into job {run.leader_id}")
+                return
+            if run is not None:
+                # Redelivery of a task that is already scheduled
+                ack()
+                return
+        run = _Run(task, key, priority, next(self._order), self.estimate(task), ack)
+        self.pending.append(run)
+        print(f"Training job {run.leader_id} queued with {run.resources}")
+        self.tick()
+
+    def tick(self) -> None:
+        """Drop cancelled pending runs and start every run that fits"""
+        self.pending.sort(key=lambda run: (run.priority, run.order))
+        used = self.used()
+        free_cpu = self.cpu_budget - used['cpu']
+        free_memory = self.memory_budget_mb - used['memory_mb']
+        blocked = False
+        with self.session_factory() as session:
+            cancelled = [run for run in self.pending if self.service.run_cancelled(run.leader_id, session)]
+        for run in cancelled:
+            self.pending.remove(run)
+            self._finish(run)
+        for run in list(self.pending):
+            if any(running.isolate for running in self.running.values()):
+                break
+            if run.isolate:
+                if not self.running:
+                    self.pending.remove(run)
+                    self._start(run)
+                elif not blocked:
+                    # Reserve the whole budget, nothing else starts until it has run alone
+                    blocked = True
+                    free_cpu = free_memory = 0
+                continue
+            fits = run.resources['cpu'] <= free_cpu and run.resources['memory_mb'] <= free_memory
+            if len(self.running) < self.max_concurrent and (fits or (not self.running and not blocked)):
+                self.pending.remove(run)
+                self._start(run)
+            elif not blocked:
+                # Reserve what the first waiting run needs, later runs only backfill the rest
+                blocked = True
+            else:
+                continue
+            free_cpu -= run.resources['cpu']
+            free_memory -= run.resources['memory_mb']
+
+    def _start(self, run: _Run) -> None:
+        print(f"Starting training job {run.leader_id} ({len(run.job_ids)} jobs) with {run.resources}")
+        self.running[run.key] = run
+        run.pool = self.pool
+        run.future = self.pool.submit(self.runner, run.task, run.resources['cpu'])
+        run.future.add_done_callback(lambda future: self.call_soon(lambda: self._done(run)))
+
+    def _done(self, run: _Run) -> None:
+        del self.running[run.key]
+        try:
+            status = run.future.result()
+        except BrokenProcessPool as e:
+            # A dead process breaks the whole pool, every run in it ends here
+            if run.pool is self.pool:
+                self.pool.shutdown(wait=False)
+                self.pool = self._new_pool()
+            if run.isolate:
+                # It ran alone, so its own process died
+                run.attempts += 1
+            run.isolate = True
+            if run.attempts < MAX_ATTEMPTS:
+                print(f"Training job {run.leader_id} crashed ({e}, {run.attempts} attempts charged), "
+                      f"resuming it alone from its checkpoint")
+                self.pending.append(run)
+                self.tick()
+                return
+            status = 'failed'
+        except Exception as e:
+            print(f"Training job {run.leader_id} crashed: {e}")
+            status = 'failed'
+        if status == 'failed':
+            with self.session_factory() as session:
+                job = self.service.get_training_job(run.leader_id, session)
+                if job is not None and job.status != "failed":
+                    # The job record is stuck mid-phase
+                    self.service.update_training_job(run.leader_id, "failed", session)
+        print(f"Training job {run.leader_id} finished: {status}")
+        self._finish(run)
+        self.tick()
+
+    def _finish(self, run: _Run) -> None:
+        with self.session_factory() as session:
+            self.service.finish_merged_jobs(run.leader_id, run.job_ids, session)
+        for ack in run.acks:
+            ack()
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,209 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+from scipy.sparse import csr_matrix
+
+from services.training.encoding import InteractionEncoding
+
+DATA_FILES = ('clickstream.pq', 'events.pq')
+# Bytes hashed from each end of a data file. The parquet footer holds the
+# schema and row group statistics, so a rewrite almost always changes it.
+EDGE_BYTES = 1 << 20
+STATS_FILE = 'stats.json'
+
+
+def _file_fingerprint(path: str) -> Dict[str, Any]:
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        digest.update(f.read(EDGE_BYTES))
+        if stat.st_size > 2 * EDGE_BYTES:
+            f.seek(-EDGE_BYTES, os.SEEK_END)
+        digest.update(f.read(EDGE_BYTES))
+    return {'name': os.path.basename(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'hash': digest.hexdigest()}
+
+
+def dataset_fingerprint(data_path: str, eval_days: int, train_columns: Sequence[str]) -> str:
+    """Key of a split: the input files and every argument of preprocess_data"""
+    key = {
+        'files': [_file_fingerprint(os.path.join(data_path, name)) for name in DATA_FILES],
+        'eval_days': eval_days,
+        'train_columns': list(train_columns),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def _read_arrow(path: str) -> pl.DataFrame:
+    """Memory-mapped, zero-copy read of an uncompressed Arrow IPC file"""
+    with pa.memory_map(path) as source:
+        return pl.from_arrow(pa.ipc.open_file(source).read_all())
+
+
+def _dir_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class SplitCache:
+    """On-disk cache of preprocessed train/eval splits and their encoded matrix.
+
+    Each entry is a directory named by the dataset fingerprint holding the
+    frames as Arrow IPC files, the id maps and the CSR components as .npy
+    files. Everything is memory-mapped on read, so a hit costs no parse and no
+    copy. Entries are written to a temporary directory and renamed into
+    place, the mtime of meta.json records the last use and the least recently
+    used entries are removed once the cache is over max_bytes. Hit and miss
+    counts are kept in stats.json next to the entries, so they add up over
+    every process that uses the cache.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def counters(self) -> Dict[str, int]:
+        try:
+            with open(os.path.join(self.root, STATS_FILE)) as f:
+                return {'hits': 0, 'misses': 0, **json.load(f)}
+        except (OSError, ValueError):
+            return {'hits': 0, 'misses': 0}
+
+    def _count(self, name: str) -> None:
+        # Training workers and sweep processes share the cache, the file lock serializes their updates
+        with open(os.path.join(self.root, f'.{STATS_FILE}.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            counters = self.counters()
+            counters[name] += 1
+            tmp = os.path.join(self.root, f'.{STATS_FILE}.{uuid.uuid4().hex}')
+            with open(tmp, 'w') as f:
+                json.dump(counters, f)
+            os.replace(tmp, os.path.join(self.root, STATS_FILE))
+
+    def _entry(self, fingerprint: str) -> str:
+        return os.path.join(self.root, fingerprint)
+
+    def get(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """The cached split as {'train', 'eval', 'encoding'}, or None"""
+        path = self._entry(fingerprint)
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            self._count('misses')
+            return None
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            train = _read_arrow(os.path.join(path, 'train.arrow'))
+            df_eval = _read_arrow(os.path.join(path, 'eval.arrow'))
+            # Copy-on-write: implicit needs writable buffers, untouched pages stay shared
+            arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='c')
+                      for name in ('indptr', 'indices', 'data')}
+            user_ids = _read_arrow(os.path.join(path, 'user_ids.arrow'))['id'].to_numpy()
+            item_ids = _read_arrow(os.path.join(path, 'item_ids.arrow'))['id'].to_numpy()
+        except (OSError, ValueError, KeyError) as e:
+            # A concurrent eviction removed the entry under us
+            print(f"Split cache entry {fingerprint} unreadable: {e}")
+            self._count('misses')
+            return None
+
+        matrix = csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=tuple(meta['shape']))
+        os.utime(meta_path)
+        self._count('hits')
+        return {
+            'train': train,
+            'eval': df_eval,
+            'encoding': InteractionEncoding(user_ids, item_ids, matrix, meta['user_col'], meta['item_col']),
+        }
+
+    def put(self, fingerprint: str, data_path: str, train: pl.DataFrame, df_eval: pl.DataFrame,
+            encoding: InteractionEncoding) -> None:
+        path = self._entry(fingerprint)
+        if os.path.exists(path):
+            return
+        tmp = os.path.join(self.root, f'.{fingerprint}.{uuid.uuid4().hex}')
+        os.makedirs(tmp)
+        try:
+            train.write_ipc(os.path.join(tmp, 'train.arrow'))
+            df_eval.write_ipc(os.path.join(tmp, 'eval.arrow'))
+            matrix = encoding.matrix
+            np.save(os.path.join(tmp, 'indptr.npy'), matrix.indptr)
+            np.save(os.path.join(tmp, 'indices.npy'), matrix.indices)
+            np.save(os.path.join(tmp, 'data.npy'), matrix.data)
+            pl.DataFrame({'id': encoding.user_ids}).write_ipc(os.path.join(tmp, 'user_ids.arrow'))
+            pl.DataFrame({'id': encoding.item_ids}).write_ipc(os.path.join(tmp, 'item_ids.arrow'))
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump({
+                    'data_path': os.path.abspath(data_path),
+                    'shape': list(matrix.shape),
+                    'user_col': encoding.user_col,
+                    'item_col': encoding.item_col,
+                    'created_at': time.time(),
+                }, f)
+            os.rename(tmp, path)
+        except OSError:
+            # Another job stored the same split first, or the disk is full
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.exists(path):
+                raise
+        self.evict()
+
+    def entries(self) -> List[Dict[str, Any]]:
+        result = []
+        for entry in os.scandir(self.root):
+            meta_path = os.path.join(entry.path, 'meta.json')
+            if entry.name.startswith('.') or not os.path.exists(meta_path):
+                continue
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                result.append({
+                    'fingerprint': entry.name,
+                    'data_path': meta['data_path'],
+                    'bytes': _dir_size(entry.path),
+                    'last_used': os.path.getmtime(meta_path),
+                })
+            except (OSError, ValueError, KeyError):
+                continue
+        return result
+
+    def evict(self) -> None:
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        with self._lock:
+            entries = sorted(self.entries(), key=lambda e: e['last_used'])
+            total = sum(e['bytes'] for e in entries)
+            while entries and total > self.max_bytes:
+                entry = entries.pop(0)
+                shutil.rmtree(self._entry(entry['fingerprint']), ignore_errors=True)
+                total -= entry['bytes']
+                print(f"Split cache evicted {entry['fingerprint']} ({entry['bytes']} bytes)")
+
+    def invalidate(self, data_path: Optional[str] = None) -> int:
+        """Remove the entries built from data_path, or all entries; returns how many were removed"""
+        removed = 0
+        target = os.path.abspath(data_path) if data_path else None
+        with self._lock:
+            for entry in self.entries():
+                if target is None or entry['data_path'] == target:
+                    shutil.rmtree(self._entry(entry['fingerprint']), ignore_errors=True)
+                    removed += 1
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        entries = self.entries()
+        return {
+            'entries': len(entries),
+            'bytes': sum(e['bytes'] for e in entries),
+            'max_bytes': self.max_bytes,
+            **self.counters(),
+        }
@@ -0,0 +1,146 @@
+import itertools
+import math
+import multiprocessing
+import os
+import random
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional
+
+SWEEP_PARAMS = ('factors', 'iterations', 'regularization', 'alpha')
+INT_PARAMS = ('factors', 'iterations')
+DEFAULT_SPACE = {
+    'factors': [32, 64, 128],
+    'iterations': [10, 20],
+    'regularization': [0.01, 0.1],
+    'alpha': [1.0, 10.0],
+}
+
+
+def expand_space(space: Optional[Dict[str, Any]], search: str = 'grid', n_trials: int = 10,
+                 seed: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Configurations of a sweep.
+
+    Every parameter is either a list of values or a {"low", "high", "log"}
+    range. A grid search takes the product of the lists; a random search
+    draws n_trials configurations, picking from lists and sampling ranges
+    uniformly (log-uniformly with "log": true).
+    """
+    space = space or DEFAULT_SPACE
+    if not isinstance(space, dict):
+        raise ValueError("The search space must map parameter names to values")
+    unknown = set(space) - set(SWEEP_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown sweep parameters: {', '.join(sorted(unknown))}")
+    for name, values in space.items():
+        if isinstance(values, dict):
+            if 'low' not in values or 'high' not in values:
+                raise ValueError(f"Range of {name} needs low and high")
+        elif not isinstance(values, list) or not values:
+            raise ValueError(f"{name} needs a non-empty list of values or a range")
+
+    if search == 'grid':
+        if any(isinstance(values, dict) for values in space.values()):
+            raise ValueError("Grid search needs a list of values for every parameter")
+        names = list(space)
+        return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+    if search != 'random':
+        raise ValueError(f"Unknown search: {search}")
+    rng = random.Random(seed)
+    configs = []
+    for _ in range(n_trials):
+        config = {}
+        for name, values in space.items():
+            if isinstance(values, dict):
+                low, high = float(values['low']), float(values['high'])
+                if values.get('log'):
+                    value = math.exp(rng.uniform(math.log(low), math.log(high)))
+                else:
+                    value = rng.uniform(low, high)
+                config[name] = int(round(value)) if name in INT_PARAMS else value
+            else:
+                config[name] = rng.choice(values)
+        configs.append(config)
+    return configs
+
+
+def thread_budget(processes: int, cpus: Optional[int] = None) -> int:
+    """BLAS/ALS threads per process so that the pool does not oversubscribe the CPUs (all of them by default)"""
+    return max(1, (cpus or os.cpu_count() or 1) // max(1, processes))
+
+
+def _fit_trial(cache_root: str, fingerprint: str, config: Dict[str, Any], threads: int,
+               artifact_path: str) -> Dict[str, Any]:
+    """Pool worker: fit one configuration on the memory-mapped split and save its artifact"""
+    from threadpoolctl import threadpool_limits
+    from services.crud.training import TrainingService
+    from services.training.artifact import save_artifact
+    from services.training.split_cache import SplitCache
+
+    with threadpool_limits(limits=threads):
+        split = SplitCache(cache_root, max_bytes=2 ** 62).get(fingerprint)
+        if split is None:
+            raise RuntimeError(f"Split {fingerprint} is missing from the cache")
+        result = TrainingService().train_als_model(
+            split['train'], split['eval'], encoding=split['encoding'], num_threads=threads, **config
+        )
+    save_artifact(artifact_path, result['model_data'], 'als_sweep')
+    return result['metrics']
+
+
+def run_sweep(cache_root: str, fingerprint: str, configs: List[Dict[str, Any]], processes: int,
+              artifact_prefix: str, metric: str, on_trial=None, cpus: Optional[int] = None) -> Dict[str, Any]:
+    """Fit every configuration in a process pool, keeping only the best artifact.
+
+    Workers read the split from the split cache, so all of them share the
+    same page-cache copy of the data instead of each loading its own.
+    on_trial(trials, best_index) is called after every finished configuration
+    with the results so far; when it raises, the configurations that have
+    not started are dropped and the exception propagates.
+    """
+    threads = thread_budget(processes, cpus)
+    trials: List[Dict[str, Any]] = [{'config': config, 'status': 'pending'} for config in configs]
+    best_index = None
+    # Polars and OpenBLAS keep thread pools that do not survive fork
+    try:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = {
+                pool.submit(_fit_trial, cache_root, fingerprint, config, threads, f"{artifact_prefix}.trial{i}"): i
+                for i, config in enumerate(configs)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                path = f"{artifact_prefix}.trial{i}"
+                try:
+                    trials[i].update(status='completed', metrics=future.result())
+                except Exception as e:
+                    trials[i].update(status='failed', error=str(e))
+                    print(f"Sweep trial {trials[i]['config']} failed: {e}")
+                else:
+                    if best_index is None or trials[i]['metrics'][metric] > trials[best_index]['metrics'][metric]:
+                        if best_index is not None:
+                            shutil.rmtree(f"{artifact_prefix}.trial{best_index}", ignore_errors=True)
+                        best_index = i
+                    else:
+                        shutil.rmtree(path, ignore_errors=True)
+                if on_trial is not None:
+                    try:
+                        on_trial(trials, best_index)
+                    except BaseException:
+                        for pending in futures:
+                            pending.cancel()
+                        raise
+    except BaseException:
+        # The pool has drained; drop the artifacts of the trials that did finish
+        for i in range(len(configs)):
+            shutil.rmtree(f"{artifact_prefix}.trial{i}", ignore_errors=True)
+        raise
+
+    if best_index is None:
+        raise RuntimeError("Every sweep configuration failed")
+    return {
+        'trials': trials,
+        'best_index': best_index,
+        'best_artifact': f"{artifact_prefix}.trial{best_index}",
+    }
@@ -0,0 +1,112 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from services.training.memory import PeakMemory
+
+
+def _cpu_seconds() -> Dict[str, float]:
+    times = os.times()
+    return {'self': times.user + times.system, 'children': times.children_user + times.children_system}
+
+
+class TrainingCancelled(Exception):
+    pass
+
+
+class Telemetry:
+    """Per-phase wall and CPU time, peak RSS and counters of one training job.
+
+    Every phase runs under PeakMemory, so its peak is the peak of the phase
+    and not the lifetime maximum of the worker. CPU time is the process's
+    own (all threads) plus that of finished child processes, such as the
+    sweep pool. on_update(snapshot) is called after every phase and, at most
+    every update_interval seconds, on ALS iterations, so the job record
+    shows progress while the model trains. should_stop() is polled when a
+    phase starts and after every ALS iteration; when it returns True the job
+    stops there with TrainingCancelled. on_phase(name) is called when a
+    phase completes without error.
+    """
+
+    def __init__(self, on_update: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 update_interval: float = 2.0, should_stop: Optional[Callable[[], bool]] = None,
+                 on_phase: Optional[Callable[[str], None]] = None):
+        self.on_update = on_update
+        self.should_stop = should_stop
+        self.on_phase = on_phase
+        self.update_interval = update_interval
+        self.phases: Dict[str, Dict[str, Any]] = {}
+        self.counters: Dict[str, Any] = {}
+        self.iterations: List[Dict[str, Any]] = []
+        self.current_phase: Optional[str] = None
+        self._updated_at = 0.0
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        self.check_cancelled()
+        self.current_phase = name
+        wall = time.perf_counter()
+        cpu = _cpu_seconds()
+        failed = True
+        try:
+            with PeakMemory() as memory:
+                yield
+            failed = False
+        finally:
+            cpu_end = _cpu_seconds()
+            self.phases[name] = {
+                'wall_s': round(time.perf_counter() - wall, 3),
+                'cpu_s': round(cpu_end['self'] - cpu['self'], 3),
+                'children_cpu_s': round(cpu_end['children'] - cpu['children'], 3),
+                'peak_rss_mb': memory.peak_mb,
+                'rss_growth_mb': memory.growth_mb,
+                **({'failed': True} if failed else {}),
+            }
+            self.current_phase = None
+            self.update(force=True)
+        if self.on_phase is not None:
+            self.on_phase(name)
+
+    def restore(self, snapshot: Dict[str, Any]) -> None:
+        """Continue from the snapshot of an earlier attempt of the same job"""
+        self.phases.update(snapshot.get('phases', {}))
+        self.counters.update(snapshot.get('counters', {}))
+        self.iterations.extend(snapshot.get('als_iterations', []))
+
+    def record(self, **counters: Any) -> None:
+        self.counters.update(counters)
+
+    def als_callback(self) -> Callable[[int, float, Optional[float]], None]:
+        """callback for implicit's fit: one entry per ALS iteration with its duration"""
+        def callback(iteration: int, elapsed: float, loss: Optional[float] = None) -> None:
+            entry = {'iteration': iteration + 1, 'seconds': round(elapsed, 3)}
+            if loss is not None:
+                entry['loss'] = float(loss)
+            self.iterations.append(entry)
+            self.update()
+            self.check_cancelled()
+        return callback
+
+    def check_cancelled(self) -> None:
+        if self.should_stop is not None and self.should_stop():
+            raise TrainingCancelled(f"Cancelled in {self.current_phase or 'between phases'}")
+
+    def update(self, force: bool = False) -> None:
+        if self.on_update is None:
+            return
+        now = time.monotonic()
+        if force or now - self._updated_at >= self.update_interval:
+            self._updated_at = now
+            self.on_update(self.snapshot())
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'phases': dict(self.phases),
+            'current_phase': self.current_phase,
+            'peak_rss_mb': max((phase['peak_rss_mb'] for phase in self.phases.values()), default=None),
+            'wall_s': round(sum(phase['wall_s'] for phase in self.phases.values()), 3),
+            'cpu_s': round(sum(phase['cpu_s'] + phase['children_cpu_s'] for phase in self.phases.values()), 3),
+            'counters': dict(self.counters),
+            'als_iterations': list(self.iterations),
+        }
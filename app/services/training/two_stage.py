@@ -0,0 +1,68 @@
+from typing import Iterator, Optional
+
+import numpy as np
+import polars as pl
+
+from services.training.encoding import InteractionEncoding
+
+# Ranker inputs, in the order of the model.ipynb recipe
+FEATURES = ['scores', 'num_contacts', 'category', 'num_events', 'surface_unique_counts', 'location_unique_counts']
+
+
+def node_categories(cat_features: pl.LazyFrame) -> pl.DataFrame:
+    """One category per node (the smallest one when a node spans several)"""
+    return cat_features.group_by('node').agg(pl.col('category').min()).collect()
+
+
+def cookie_category_features(clickstream: pl.DataFrame, cat_features: pl.LazyFrame) -> pl.DataFrame:
+    """Per (cookie, category) activity counts, built with one join and one group_by.
+
+    clickstream needs cookie, item, surface and is_target columns.
+    """
+    items = cat_features.select('item', 'location', 'category').collect()
+    return (
+        clickstream.lazy()
+        .select('cookie', 'item', 'surface', 'is_target')
+        .join(items.lazy(), on='item')
+        .group_by('cookie', 'category')
+        .agg(
+            pl.col('is_target').sum().cast(pl.Float32).alias('num_contacts'),
+            pl.len().cast(pl.Float32).alias('num_events'),
+            pl.col('surface').n_unique().cast(pl.Float32).alias('surface_unique_counts'),
+            pl.col('location').n_unique().cast(pl.Float32).alias('location_unique_counts'),
+        )
+        .collect()
+    )
+
+
+def candidate_batches(model, encoding: InteractionEncoding, user_codes: np.ndarray, n: int,
+                      batch_size: int) -> Iterator[pl.DataFrame]:
+    """ALS candidates (cookie, node, scores) for batch_size users at a time"""
+    for start in range(0, len(user_codes), batch_size):
+        batch = user_codes[start:start + batch_size]
+        recommendations, scores = model.recommend(batch, encoding.matrix[batch], N=n,
+                                                  filter_already_liked_items=True)
+        yield encoding.recommendations_frame(batch, recommendations, scores)
+
+
+def add_features(candidates: pl.DataFrame, categories: pl.DataFrame, features: pl.DataFrame) -> pl.DataFrame:
+    """Attach the ranker features to a chunk of candidates; missing counts stay null"""
+    return (
+        candidates.join(categories, on='node', how='left')
+        .join(features, on=['cookie', 'category'], how='left')
+    )
+
+
+def feature_matrix(df: pl.DataFrame) -> np.ndarray:
+    """float32 matrix of FEATURES, nulls as NaN for CatBoost's nan_mode"""
+    return df.select(pl.col(FEATURES).cast(pl.Float32)).to_numpy()
+
+
+def top_k(df: pl.DataFrame, score_col: str, k: int, user_col: str = 'cookie') -> pl.DataFrame:
+    """Best k rows per user, ordered by descending score"""
+    return df.sort([user_col, score_col], descending=[False, True]).group_by(user_col, maintain_order=True).head(k)
+
+
+def user_fold(user_col: str, folds: int, seed: Optional[int] = 0) -> pl.Expr:
+    """Stable pseudo-random fold of every user"""
+    return pl.col(user_col).hash(seed or 0) % folds
@@ -1,12 +1,21 @@
+import asyncio
+import numpy as np
+import pytest
 from fastapi.testclient import TestClient
 from auth.authenticate import authenticate_cookie
-from database.database import get_session
+from database.database import get_async_session
+import main
 from main import app
 from fastapi.testclient import TestClient
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock, MagicMock
 from services.crud import user as UserService
 from services.crud import transaction as TransactionService
 from services.crud import ml as MlService
+from services.crud import billing as BillingService
+from services.queue.publisher import PublishError
+from models.all_models import MLTask
+from services.serving.recommendations import RecommendationStore
+from services.training.materialize import job_set_name, materialize_top_k
 
 
 client = TestClient(app)
@@ -19,15 +28,38 @@ mock_user.email = "test@example.com"
 def mock_authenticate_cookie():
     return "test@example.com"
 
-def mock_get_session():
-    return MagicMock()
+def make_session(*results):
+    """Session mock whose awaited execute() calls return results in order"""
+    session = MagicMock()
+    session.execute = AsyncMock(side_effect=list(results))
+    session.commit = AsyncMock()
+    session.rollback = AsyncMock()
+    session.flush = AsyncMock()
+    return session
+
+
+def make_result(value):
+    result = MagicMock()
+    result.scalar_one.return_value = value
+    result.scalar_one_or_none.return_value = value
+    return result
+
+
+mock_session = make_session()
+
+async def mock_get_session():
+    return mock_session
 
 app.dependency_overrides[authenticate_cookie] = mock_authenticate_cookie
-app.dependency_overrides[get_session] = mock_get_session
+app.dependency_overrides[get_async_session] = mock_get_session
 
-UserService.get_user_by_email = MagicMock(return_value=mock_user)
-MlService.get_task_history = MagicMock(return_value=[{"task": "Task 1"}, {"task": "Task 2"}])
-TransactionService.get_transaction_history = MagicMock(return_value=[{"amount": 100}, {"amount": 200}])
+UserService.get_user_by_email_async = AsyncMock(return_value=mock_user)
+MlService.get_task_history_page_async = AsyncMock(return_value={
+    "items": [{"task": "Task 1"}, {"task": "Task 2"}], "next_cursor": None, "summary": {"tasks": 2}
+})
+TransactionService.get_transaction_history_page_async = AsyncMock(return_value={
+    "items": [{"amount": 100}, {"amount": 200}], "next_cursor": None, "summary": {}
+})
 
 def test_create_user():
     response = client.post("/sign_new_user/", json={"username": "test_user1", "password": "123", "email": "test1@example.com"})
@@ -39,9 +71,81 @@ def test_create_user():
 
 def test_deposit():
     amount = 100.0
+    deposited = MagicMock(id=1, email="test@example.com", balance=amount)
+    mock_session.execute = AsyncMock(return_value=make_result(deposited))
     response = client.post("/deposit/", data={"amount": amount})
     assert response.status_code == 200
-    assert "balance.html" in response.text
+    assert "Your balance: 100.0" in response.text
+    added = mock_session.add.call_args.args[0]
+    assert added.transaction_type == "deposit" and added.amount == amount
+
+
+def test_deposit_rejects_non_positive_amount():
+    response = client.post("/deposit/", data={"amount": 0})
+    assert response.status_code == 400
+
+
+def test_charge_for_task_with_enough_funds():
+    charged = MagicMock(id=1, balance=80)
+    session = make_session(make_result(charged))
+    user, task = asyncio.run(BillingService.charge_for_task(1, 2, 20, "req", session))
+
+    assert user is charged
+    assert task.user_id == 1 and task.model_id == 2 and task.cost == 20
+    statement = session.execute.await_args.args[0]
+    # The balance check is part of the UPDATE itself
+    assert "balance >=" in str(statement)
+    ledger, mapping = session.add_all.call_args.args[0]
+    assert ledger.transaction_type == "withdraw" and ledger.amount == 20
+    assert mapping.request_id == "req"
+    session.commit.assert_awaited_once()
+
+
+def test_charge_for_task_without_enough_funds():
+    session = make_session(make_result(None))
+    with pytest.raises(BillingService.InsufficientFundsError):
+        asyncio.run(BillingService.charge_for_task(1, 2, 20, "req", session))
+
+    session.rollback.assert_awaited_once()
+    session.add.assert_not_called()
+    session.commit.assert_not_awaited()
+
+
+def test_refund_task():
+    refunded = MagicMock(id=1, balance=100)
+    session = make_session(make_result(5), make_result(refunded))
+    task = MLTask(task_id=5, user_id=1, model_id=2, cost=20)
+
+    assert asyncio.run(BillingService.refund_task(task, session)) is refunded
+    mark, credit = [call.args[0] for call in session.execute.await_args_list]
+    assert "status" in str(mark) and "balance" in str(credit)
+    assert session.add.call_args.args[0].transaction_type == "refund"
+    session.commit.assert_awaited_once()
+
+
+def test_refund_task_already_processed():
+    session = make_session(make_result(None))
+    task = MLTask(task_id=5, user_id=1, model_id=2, cost=20)
+
+    assert asyncio.run(BillingService.refund_task(task, session)) is None
+    # The worker claimed the task first: no credit and no ledger row
+    assert session.execute.await_count == 1
+    session.add.assert_not_called()
+    session.rollback.assert_awaited_once()
+
+
+def test_predict_refunds_when_queue_is_unavailable(monkeypatch):
+    task = MLTask(task_id=5, user_id=1, model_id=2, cost=20)
+    charge = AsyncMock(return_value=(mock_user, task))
+    refund = AsyncMock(return_value=mock_user)
+    monkeypatch.setattr(BillingService, "charge_for_task", charge)
+    monkeypatch.setattr(BillingService, "refund_task", refund)
+    monkeypatch.setattr(main, "send_to_queue", AsyncMock(side_effect=PublishError("down")))
+
+    response = client.post("/predict/", data={"model_id": 2})
+    assert response.status_code == 503
+    refund.assert_awaited_once()
+    assert refund.await_args.args[0] is task
 
 
 def test_get_task_history():
@@ -57,4 +161,48 @@ def test_get_transaction_history():
     assert response.status_code == 200
     assert "transaction_history.html" in response.text
     assert "100" in response.text
-    assert "200" in response.text
\ No newline at end of file
+    assert "200" in response.text
+
+def test_recommend_reads_materialized_set(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    user_ids, item_ids = np.arange(100, 110), np.arange(500, 520)
+    user_factors, item_factors = rng.random((10, 4)), rng.random((20, 4))
+    materialize_top_k(str(tmp_path), job_set_name(7), "v1", user_factors, item_factors, user_ids, item_ids, k=5)
+    job = {"user_id": 1, "model_type": "als", "status": "completed", "model_path": "unused"}
+    monkeypatch.setattr(main, "serving_job", AsyncMock(return_value=job))
+    monkeypatch.setattr(main, "recommendation_store", RecommendationStore(str(tmp_path)))
+    scored = MagicMock()
+    monkeypatch.setattr(main, "get_recommender", MagicMock(return_value=scored))
+
+    response = client.get("/recommend/7", params={"user_id": 103, "k": 3})
+    assert response.status_code == 200
+    expected = item_ids[np.argsort(-(user_factors[3] @ item_factors.T))[:3]]
+    assert response.json()["nodes"] == expected.tolist()
+    main.get_recommender.assert_not_called()
+
+    # More than the materialized k is scored from the factors
+    scored.recommend.return_value = [(item_ids[:8], np.zeros(8))]
+    response = client.get("/recommend/7", params={"user_id": 103, "k": 8})
+    assert response.json()["nodes"] == item_ids[:8].tolist()
+    scored.recommend.assert_called_once()
+
+
+def test_recommend_loads_fallback_only_for_unknown_users(monkeypatch):
+    job = {"user_id": 1, "model_type": "als", "status": "completed", "model_path": "unused"}
+    monkeypatch.setattr(main, "serving_job", AsyncMock(return_value=job))
+    monkeypatch.setattr(main, "recommendation_store", None)
+    scored = MagicMock()
+    monkeypatch.setattr(main, "get_recommender", MagicMock(return_value=scored))
+    fallback = MagicMock()
+    fallback.recommend.return_value = [(np.array([9]), np.array([1.0]))]
+    monkeypatch.setattr(main, "fallback_recommender", AsyncMock(return_value=fallback))
+
+    scored.recommend.return_value = [(np.array([1, 2]), np.array([0.5, 0.4]))]
+    response = client.get("/recommend/7", params={"user_id": 103, "fallback_job_id": 8})
+    assert response.json()["nodes"] == [1, 2]
+    main.fallback_recommender.assert_not_awaited()
+
+    scored.recommend.return_value = [None]
+    response = client.get("/recommend/7", params={"user_id": 104, "fallback_job_id": 8})
+    assert response.json()["nodes"] == [9] and response.json()["fallback"] is True
+    main.fallback_recommender.assert_awaited_once()
@@ -0,0 +1,248 @@
+import json
+import os
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+import numpy as np
+import polars as pl
+import pytest
+from unittest.mock import ANY, MagicMock
+from sqlmodel import Session, SQLModel, create_engine
+from models.all_models import TrainingJob
+from services.crud.training import PHASES, TrainingService
+from services.training.ann import ann_path
+from services.training.artifact import is_artifact
+from services.training.encoding import encode_interactions
+from services.training.scheduler import MAX_ATTEMPTS, TrainingScheduler, estimate_resources
+
+
+class WorkerDied(BaseException):
+    """Stands in for the worker process being killed: train_model does not catch it"""
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    service = TrainingService()
+    service.split_cache = None
+    service.ann_index = True
+    service.recommendations_dir = str(tmp_path / "recommendations")
+    service.materialize_k = 5
+
+    rng = np.random.default_rng(0)
+    train = pl.DataFrame({"cookie": rng.integers(0, 60, 2000), "node": rng.integers(0, 300, 2000)})
+    encoding = encode_interactions(train, "cookie", "node")
+    service.load_split = MagicMock(return_value={"train": train, "eval": train, "encoding": encoding})
+    service.input_rows = MagicMock(return_value={"clickstream.pq": train.height})
+    service.train_als_model = MagicMock(return_value={
+        "metrics": {"recall_at_40": 0.5},
+        "model_data": {
+            "user_factors": rng.random((len(encoding.user_ids), 8), dtype=np.float32),
+            "item_factors": rng.random((len(encoding.item_ids), 8), dtype=np.float32),
+            "user_ids": encoding.user_ids,
+            "item_ids": encoding.item_ids,
+            "sparse_matrix": encoding.matrix,
+        },
+    })
+    return service
+
+
+@pytest.mark.parametrize("crash_in", PHASES)
+def test_train_model_resumes_after_worker_died(service, session, crash_in):
+    job = service.create_training_job(TrainingJob(user_id=1, model_type="als", data_path="data"), session)
+    record_phase = service.update_last_phase
+
+    def die_before_recording(job_id, phase, session):
+        # The phase did its work (wrote its files) but the worker died before it was recorded
+        if phase == crash_in:
+            raise WorkerDied()
+        record_phase(job_id, phase, session)
+
+    service.update_last_phase = die_before_recording
+    with pytest.raises(WorkerDied):
+        service.train_model(job.job_id, session, "als", "data", {"iterations": 2})
+    resumed_after = PHASES[PHASES.index(crash_in) - 1] if crash_in != PHASES[0] else None
+    assert service.get_training_job(job.job_id, session).last_phase == resumed_after
+
+    service.update_last_phase = record_phase
+    result = service.train_model(job.job_id, session, "als", "data", {"iterations": 2})
+
+    job = service.get_training_job(job.job_id, session)
+    assert job.status == "completed" and job.last_phase == PHASES[-1]
+    metrics = json.loads(job.metrics)
+    assert "ann" in metrics and metrics["recommendations"]["users"] == 60
+    assert is_artifact(job.model_path) and is_artifact(ann_path(job.model_path))
+    # Training is only repeated when the first run trained but its results never reached the job
+    assert service.train_als_model.call_count == (2 if crash_in in ("training", "saving") else 1)
+    assert result["model_path"] == job.model_path
+    assert not os.path.exists(service.checkpoint_path(job.job_id))
+
+
+def test_admitted_threads_override_hyperparams(service, session):
+    budget = 8
+    resources = estimate_resources("two_stage", {"threads": 32}, 1000, None, job_threads=4, sweep_processes=2,
+                                   cpu_budget=budget)
+    assert resources["cpu"] == budget
+    service.train_two_stage_model = MagicMock(return_value=service.train_als_model.return_value)
+    job = service.create_training_job(TrainingJob(user_id=1, model_type="two_stage", data_path="data"), session)
+
+    service.train_model(job.job_id, session, "two_stage", "data", {"threads": 32}, threads=resources["cpu"])
+    # The ranker and its ALS stage run with the CPUs the scheduler admitted, not the requested ones
+    assert service.train_two_stage_model.call_args.args[3]["threads"] == budget
+
+
+class FakePool:
+    """Executor whose futures the test resolves by hand"""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, fn, task, threads):
+        future = Future()
+        self.submitted.append((task["job_id"], future))
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class FakeScheduler(TrainingScheduler):
+    def _new_pool(self):
+        return FakePool()
+
+
+def fake_runner(task, threads):
+    return "completed"
+
+
+def make_scheduler(cpu_budget=4, memory_budget_mb=1000, max_concurrent=4, cancelled=()):
+    jobs = {}
+    service = MagicMock()
+    service.get_training_job.side_effect = lambda job_id, session: jobs.get(job_id)
+    service.run_cancelled.side_effect = lambda job_id, session: job_id in cancelled
+    scheduler = FakeScheduler(cpu_budget, memory_budget_mb, max_concurrent, estimate=lambda task: task["resources"],
+                              service=service, session_factory=MagicMock, runner=fake_runner)
+
+    def submit(job_id, cpu=1, memory_mb=100, priority="interactive", key=None):
+        jobs[job_id] = SimpleNamespace(job_id=job_id, status="pending", priority=priority, job_key=key or f"key{job_id}")
+        ack = MagicMock()
+        scheduler.submit({"job_id": job_id, "resources": {"cpu": cpu, "memory_mb": memory_mb}}, ack)
+        return ack
+
+    return scheduler, service, submit
+
+
+def running_ids(scheduler):
+    return sorted(run.leader_id for run in scheduler.running.values())
+
+
+def finish(scheduler, job_id, error=None):
+    future = next(run.future for run in scheduler.running.values() if run.leader_id == job_id)
+    if error is None:
+        future.set_result("completed")
+    else:
+        future.set_exception(error)
+
+
+def test_scheduler_admits_within_budget():
+    scheduler, service, submit = make_scheduler(cpu_budget=4, memory_budget_mb=1000)
+    submit(1, cpu=2)
+    submit(2, cpu=2)
+    submit(3, cpu=1)
+    submit(4, memory_mb=900)
+    assert running_ids(scheduler) == [1, 2]
+
+    finish(scheduler, 1)
+    # The first waiting run reserves its memory, the next one only backfills what is left
+    assert running_ids(scheduler) == [2, 3]
+    finish(scheduler, 2)
+    finish(scheduler, 3)
+    assert running_ids(scheduler) == [4]
+
+
+def test_scheduler_orders_by_priority():
+    scheduler, service, submit = make_scheduler(cpu_budget=1)
+    submit(1)
+    submit(2, priority="batch")
+    submit(3, priority="interactive")
+    finish(scheduler, 1)
+    assert running_ids(scheduler) == [3]
+
+
+def test_scheduler_reserves_for_blocked_run():
+    scheduler, service, submit = make_scheduler(cpu_budget=4)
+    submit(1, cpu=3)
+    submit(2, cpu=4)
+    submit(3, cpu=1)
+    # One CPU is free, but it is reserved for job 2
+    assert running_ids(scheduler) == [1]
+    finish(scheduler, 1)
+    assert running_ids(scheduler) == [2]
+
+
+def test_scheduler_starts_oversize_run_alone():
+    scheduler, service, submit = make_scheduler(cpu_budget=4)
+    submit(1, cpu=16)
+    submit(2)
+    assert running_ids(scheduler) == [1]
+    finish(scheduler, 1)
+    assert running_ids(scheduler) == [2]
+
+
+def test_scheduler_merges_identical_jobs():
+    scheduler, service, submit = make_scheduler()
+    first = submit(1, key="same")
+    second = submit(2, key="same")
+
+    service.merge_training_job.assert_called_once_with(2, 1, ANY)
+    assert len(scheduler.pool.submitted) == 1
+    finish(scheduler, 1)
+    service.finish_merged_jobs.assert_called_once_with(1, [1, 2], ANY)
+    first.assert_called_once()
+    second.assert_called_once()
+
+
+def test_scheduler_drops_cancelled_pending_run():
+    cancelled = set()
+    scheduler, service, submit = make_scheduler(cpu_budget=1, cancelled=cancelled)
+    submit(1)
+    ack = submit(2)
+    cancelled.add(2)
+    scheduler.tick()
+
+    assert [run.leader_id for run in scheduler.pending] == []
+    service.finish_merged_jobs.assert_called_once_with(2, [2], ANY)
+    ack.assert_called_once()
+    finish(scheduler, 1)
+    assert [job_id for job_id, _ in scheduler.pool.submitted] == [1]
+
+
+def test_scheduler_charges_crash_to_the_run_alone():
+    scheduler, service, submit = make_scheduler()
+    innocent = submit(1)
+    submit(2)
+    broken = scheduler.pool
+    for job_id in (1, 2):
+        finish(scheduler, job_id, BrokenProcessPool())
+    assert scheduler.pool is not broken
+
+    # Neither is charged: both run again, one at a time
+    assert [run.attempts for run in scheduler.pending + list(scheduler.running.values())] == [0, 0]
+    assert running_ids(scheduler) == [1]
+    finish(scheduler, 1)
+    innocent.assert_called_once()
+    service.update_training_job.assert_not_called()
+
+    for attempt in range(MAX_ATTEMPTS):
+        assert running_ids(scheduler) == [2]
+        finish(scheduler, 2, BrokenProcessPool())
+    service.update_training_job.assert_called_once_with(2, "failed", ANY)
+    assert running_ids(scheduler) == [] and scheduler.pending == []
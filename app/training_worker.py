@@ -1,86 +1,94 @@
 import pika
 import json
+import os
 import traceback
-from database.database import get_session
+from database.config import get_settings
+from database.database import engine
 from services.crud import training as TrainingService
-from models.all_models import TrainingJob
+from services.queue.publisher import get_connection_params
+from services.training.scheduler import TrainingScheduler, estimate_resources
 from sqlmodel import Session
 
 RABBITMQ_HOST = "rabbitmq"
 TRAINING_QUEUE_NAME = "training_tasks"
+# Seconds between scheduler passes that pick up jobs cancelled while pending
+TICK_INTERVAL = 5.0
+
+settings = get_settings()
+training_service = TrainingService.TrainingService()
+cpu_budget = settings.TRAINING_CPU_BUDGET or os.cpu_count() or 1
+scheduler = None
+
+
+def estimate(task: dict) -> dict:
+    """CPUs and memory of a task, from its input size and the telemetry of earlier jobs"""
+    with Session(engine) as session:
+        profile = training_service.resource_profile(task["model_type"], session)
+    rows = training_service.input_rows(task["data_path"])["clickstream.pq"]
+    return estimate_resources(task["model_type"], task.get("hyperparams"), rows, profile,
+                              settings.TRAINING_JOB_THREADS, settings.SWEEP_PROCESSES, cpu_budget)
+
 
 def callback(ch, method, properties, body):
-    """Обработчик сообщений из RabbitMQ для обучения моделей"""
+    """Обработчик сообщений из RabbitMQ: передает задачу обучения планировщику"""
+    job_id = None
     try:
         task = json.loads(body)
         print(f"Received training task: {task}")
-        
         job_id = task.get("job_id")
-        model_type = task.get("model_type")
-        data_path = task.get("data_path")
-        hyperparams = task.get("hyperparams")
-        
-        # Get database session
-        session = next(get_session())
-        
-        # Get training service
-        training_service = TrainingService.TrainingService()
-        
-        # Train model
-        result = training_service.train_model(
-            job_id=job_id,
-            session=session,
-            model_type=model_type,
-            data_path=data_path,
-            hyperparams=hyperparams
-        )
-        
-        print(f"Training completed for job {job_id}: {result}")
-        
-        # Acknowledge message
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        
+
+        # The message is acked once the job has finished, so a crashed worker gets it redelivered
+        scheduler.submit(task, lambda: ch.basic_ack(delivery_tag=method.delivery_tag))
+
     except Exception as e:
         print(f"Error processing training task: {e}")
         print(traceback.format_exc())
-        
+
         # Update job status to failed
         try:
-            session = next(get_session())
-            training_service = TrainingService.TrainingService()
-            training_service.update_training_job(job_id, "failed", session)
+            with Session(engine) as session:
+                training_service.update_training_job(job_id, "failed", session)
         except:
             pass
-        
+
         # Acknowledge message to remove from queue
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
 def start_training_worker():
     """Start the training worker"""
-    connection_params = pika.ConnectionParameters(
-        host='rabbitmq',
-        port=5672,
-        virtual_host='/',
-        credentials=pika.PlainCredentials(
-            username='rmuser',
-            password='rmpassword'
-        ),
-        heartbeat=30,
-        blocked_connection_timeout=2
-    )
-    
-    connection = pika.BlockingConnection(connection_params)
+    global scheduler
+
+    connection = pika.BlockingConnection(get_connection_params(RABBITMQ_HOST))
     channel = connection.channel()
-    
-    # Declare training queue
+
+    scheduler = TrainingScheduler(
+        cpu_budget=cpu_budget,
+        memory_budget_mb=settings.TRAINING_MEMORY_BUDGET_MB,
+        max_concurrent=settings.TRAINING_MAX_CONCURRENT,
+        estimate=estimate,
+        service=training_service,
+        session_factory=lambda: Session(engine),
+        call_soon=connection.add_callback_threadsafe
+    )
+
+    def tick():
+        scheduler.tick()
+        connection.call_later(TICK_INTERVAL, tick)
+
+    # Declare training queue; the prefetch is the backlog the scheduler can reorder
     channel.queue_declare(queue=TRAINING_QUEUE_NAME, durable=True)
-    channel.basic_qos(prefetch_count=1)
+    channel.basic_qos(prefetch_count=settings.TRAINING_PREFETCH)
     channel.basic_consume(queue=TRAINING_QUEUE_NAME, on_message_callback=callback)
+    connection.call_later(TICK_INTERVAL, tick)
 
-    print("Training worker started. Waiting for training tasks...")
-    channel.start_consuming()
+    print(f"Training worker started with {cpu_budget} CPUs and {settings.TRAINING_MEMORY_BUDGET_MB} MB. "
+          f"Waiting for training tasks...")
+    try:
+        channel.start_consuming()
+    finally:
+        scheduler.shutdown()
 
 
 if __name__ == "__main__":
-    start_training_worker() 
\ No newline at end of file
+    start_training_worker()
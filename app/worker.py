@@ -1,15 +1,23 @@
 import pika
 import json
+import time
 import pandas as pd
 
+from database.config import get_settings
 from database.database import get_session
 from services.crud import ml as MlService
-from models.all_models import Prediction, MLModel
-from sqlalchemy import create_engine
+from services.queue.publisher import get_connection_params
+from services.queue.rpc import send_reply
+from services.serving.features import FeatureSnapshot
+from services.serving.model_registry import get_model_registry
+from models.all_models import Prediction
+from sqlalchemy import bindparam, create_engine, text
+from typing import List, Optional, Tuple
 
 
 session = next(get_session())
-model = MLModel(model_path='./ml_models/decision_forest_model.pkl')
+settings = get_settings()
+registry = get_model_registry()
 engine = create_engine(
     "postgresql://robot-startml-ro:pheiph0hahj1Vaif@"
     "postgres.lab.karpov.courses:6432/startml"
@@ -17,12 +25,55 @@ engine = create_engine(
 
 RABBITMQ_HOST = "rabbitmq"
 QUEUE_NAME = "ml_tasks"
+BATCH_SIZE = settings.WORKER_BATCH_SIZE
+BATCH_WAIT_MS = settings.WORKER_BATCH_WAIT_MS
 
-def mock_predict(task, model):
-    input_data = pd.read_sql(f'SELECT * FROM public.mfdp_user_features where user_id == {task["user_id"]};', con=engine)
-    output = float(model.predict(input_data))
-    prediction = Prediction(user_id=task["user_id"], task_id=task["task_id"], output=output)
-    return prediction
+snapshot = FeatureSnapshot(
+    settings.FEATURE_SNAPSHOT_PATH, engine,
+    refresh_interval=settings.FEATURE_SNAPSHOT_REFRESH_S
+) if settings.FEATURE_SNAPSHOT_PATH else None
+
+FEATURES_QUERY = text(
+    'SELECT * FROM public.mfdp_user_features WHERE user_id IN :user_ids'
+).bindparams(bindparam('user_ids', expanding=True))
+
+
+def fetch_features(user_ids: List[int]) -> Tuple[pd.DataFrame, Optional[str]]:
+    """Fetch features for all users of a batch from the local snapshot, or in one query without it"""
+    if snapshot is not None:
+        features, version = snapshot.get(user_ids)
+    else:
+        features, version = pd.read_sql(FEATURES_QUERY, con=engine, params={"user_ids": sorted(set(user_ids))}), None
+    return features.drop_duplicates('user_id').set_index('user_id', drop=False), version
+
+
+def predict_batch(tasks: List[dict]) -> List[Prediction]:
+    """Predict all tasks with one model call per model_id on the stacked feature frame"""
+    features, feature_version = fetch_features([task["user_id"] for task in tasks])
+    known = [task for task in tasks if task["user_id"] in features.index]
+
+    by_model = {}
+    for task in known:
+        by_model.setdefault(task["model_id"], []).append(task)
+
+    outputs = {}
+    for model_id, model_tasks in by_model.items():
+        model = registry.get(model_id, session=session)
+        input_data = features.loc[[task["user_id"] for task in model_tasks]].reset_index(drop=True)
+        for task, output in zip(model_tasks, model.predict(input_data)):
+            outputs[task["task_id"]] = float(output)
+
+    for task in tasks:
+        if task["task_id"] not in outputs:
+            print(f"No features for user {task['user_id']}, task {task['task_id']}")
+    return [
+        Prediction(task_id=task["task_id"], output=outputs.get(task["task_id"]), feature_version=feature_version)
+        for task in tasks
+    ]
+
+
+def mock_predict(task):
+    return predict_batch([task])[0]
 
 
 def callback(ch, method, properties, body):
@@ -32,28 +83,81 @@ def callback(ch, method, properties, body):
 
     request_id = task.get("request_id")
 
-    result = mock_predict(task, model)
+    if not MlService.claim_tasks([task["task_id"]], session):
+        # Refunded because the publish failed, or processed before a redelivery
+        session.rollback()
+        print(f"Skipping task {task['task_id']} for {request_id}: not awaiting processing")
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return
+
+    result = mock_predict(task)
     print(f"Predicted result for {request_id}: {result}")
-    
+
     MlService.create_prediction(result, session)
+    send_reply(ch, properties, {**result.model_dump(), "request_id": request_id})
     ch.basic_ack(delivery_tag=method.delivery_tag)
 
 
+def process_batch(channel, batch: List[tuple]) -> None:
+    """Predict, store and ack a batch of (method, properties, task) messages"""
+    try:
+        # Refunded tasks and ones processed before a redelivery are acked without a prediction
+        claimed = MlService.claim_tasks([task["task_id"] for _, _, task in batch], session)
+        skipped = [task["task_id"] for _, _, task in batch if task["task_id"] not in claimed]
+        if skipped:
+            print(f"Skipping tasks not awaiting processing: {skipped}")
+        claimed_batch = [item for item in batch if item[2]["task_id"] in claimed]
+        tasks = [task for _, _, task in claimed_batch]
+        predictions = MlService.create_predictions(predict_batch(tasks), session) if tasks else []
+    except Exception as e:
+        print(f"Error processing batch of {len(batch)} tasks: {e}")
+        session.rollback()
+        # Give each message one more chance before dropping it
+        for method, _, _ in batch:
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=not method.redelivered)
+        return
+
+    print(f"Predicted {len(predictions)} tasks: {[task.get('request_id') for task in tasks]}")
+    for (_, properties, task), prediction in zip(claimed_batch, predictions):
+        send_reply(channel, properties, {**prediction, "request_id": task.get("request_id")})
+    channel.basic_ack(delivery_tag=batch[-1][0].delivery_tag, multiple=True)
+
+
+def consume_batches(channel) -> None:
+    """Collect up to BATCH_SIZE messages or wait up to BATCH_WAIT_MS, then process them together"""
+    wait = BATCH_WAIT_MS / 1000
+    batch = []
+    deadline = None
+    for method, properties, body in channel.consume(QUEUE_NAME, inactivity_timeout=wait):
+        if method is not None:
+            batch.append((method, properties, json.loads(body)))
+            if deadline is None:
+                deadline = time.monotonic() + wait
+        if batch and (method is None or len(batch) >= BATCH_SIZE or time.monotonic() >= deadline):
+            process_batch(channel, batch)
+            batch = []
+            deadline = None
+
+
 def start_worker():
-    connection_params = pika.ConnectionParameters(
-        host='rabbitmq',
-        port=5672,
-        virtual_host='/',
-        credentials=pika.PlainCredentials(
-            username='rmuser',
-            password='rmpassword'
-        ),
-        heartbeat=30,
-        blocked_connection_timeout=2
-    )
+    if settings.PRELOAD_MODEL_IDS:
+        registry.preload([int(i) for i in settings.PRELOAD_MODEL_IDS.split(',')], session)
+
+    if snapshot is not None:
+        snapshot.refresh()
+        snapshot.start_background_refresh()
+
+    connection_params = get_connection_params(RABBITMQ_HOST)
     connection = pika.BlockingConnection(connection_params)
     channel = connection.channel()
     # channel.queue_declare(queue=QUEUE_NAME, durable=True)
+
+    if BATCH_SIZE > 1:
+        channel.basic_qos(prefetch_count=BATCH_SIZE * 2)
+        print(f"Worker started in batch mode (batch size {BATCH_SIZE}, wait {BATCH_WAIT_MS} ms). Waiting for tasks...")
+        consume_batches(channel)
+        return
+
     # channel.basic_qos(prefetch_count=1)
     channel.basic_consume(queue=QUEUE_NAME, on_message_callback=callback)
 